@@ -0,0 +1,103 @@
+"""Benchmark the streaming SQL extractor against the original regex extractor.
+
+Replays the recorded responses in data/recorded_responses.jsonl token by token,
+the way they arrive from the model, and times:
+
+  legacy  - the original three regex patterns re-run over the whole response
+            after every token (what detecting a closed block used to cost)
+  stream  - SqlStreamExtractor fed one token at a time
+  whole   - extract_sql_from_response on the finished response
+
+Usage: python benchmarks/extractor_bench.py [--repeat N] [--corpus PATH]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import SqlStreamExtractor, extract_sql_from_response  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "recorded_responses.jsonl")
+
+LEGACY_PATTERNS = [
+    r'<final_sql_query_start>(.*?)<final_sql_query_end>',
+    r'```sql\n(.*?)\n```',
+    r'```\n((?:SELECT|INSERT|UPDATE|DELETE|WITH|CREATE|ALTER|DROP).*?)\n```',
+]
+
+# Roughly what llama.cpp emits per step: a word, a run of punctuation or whitespace
+TOKEN_RE = re.compile(r'\s+|\w+|[^\w\s]')
+
+def legacy_extract(response):
+    for pattern in LEGACY_PATTERNS:
+        match = re.search(pattern, response, re.DOTALL | re.IGNORECASE)
+        if match:
+            return match.group(1).strip()
+    for line in response.split('\n'):
+        line = line.strip()
+        if line and line.upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'CREATE', 'ALTER', 'DROP')):
+            return line
+    return None
+
+def legacy_stream(tokens):
+    text = ""
+    for token in tokens:
+        text += token
+        for pattern in LEGACY_PATTERNS[:2]:
+            re.search(pattern, text, re.DOTALL | re.IGNORECASE)
+    return legacy_extract(text)
+
+def new_stream(tokens):
+    extractor = SqlStreamExtractor()
+    for token in tokens:
+        extractor.feed(token)
+    return extractor.finish()
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["response"] for line in f if line.strip()]
+
+def timed(fn, inputs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in inputs:
+            fn(item)
+    return (time.perf_counter() - start) / (repeat * len(inputs))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    responses = load_corpus(args.corpus)
+    tokenized = [TOKEN_RE.findall(response) for response in responses]
+    token_total = sum(len(tokens) for tokens in tokenized)
+
+    # Streaming and whole-text extraction must agree; report where the legacy extractor differed
+    differences = 0
+    for response, tokens in zip(responses, tokenized):
+        streamed = new_stream(tokens)
+        assert streamed == extract_sql_from_response(response), response[:80]
+        if streamed != legacy_extract(response):
+            differences += 1
+            print(f"legacy differs: {legacy_extract(response)!r} -> {streamed!r}")
+
+    results = {
+        "legacy": timed(legacy_stream, tokenized, args.repeat),
+        "stream": timed(new_stream, tokenized, args.repeat),
+        "whole": timed(extract_sql_from_response, responses, args.repeat),
+    }
+    print(f"{len(responses)} responses, {token_total} tokens, {differences} legacy differences")
+    for name, seconds in results.items():
+        per_token = seconds * len(responses) / token_total
+        print(f"{name:>7}: {seconds * 1e6:9.1f} us/response  {per_token * 1e6:7.2f} us/token")
+    print(f"streaming speedup vs legacy: {results['legacy'] / results['stream']:.1f}x")
+
+if __name__ == "__main__":
+    main()
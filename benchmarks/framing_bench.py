@@ -0,0 +1,114 @@
+"""Benchmark websocket frame encodings for query results.
+
+Builds a synthetic result page (integers, numeric, dates, timestamps, UUIDs
+and text, the kinds of values asyncpg returns) and compares:
+
+  baseline  - json.dumps of row dicts, as frames were built before
+  json      - row dicts through the compact JSON encoder (legacy clients)
+  columnar  - the edgequery.json subprotocol: columns once, value arrays
+  msgpack   - the edgequery.msgpack subprotocol (when msgpack is installed)
+
+For each it reports the time to encode, and to encode and deflate, and the
+frame size raw and after permessage-deflate with the configured zlib settings.
+
+Usage: python benchmarks/framing_bench.py [--rows N] [--repeat N]
+"""
+
+import argparse
+import datetime
+import decimal
+import json
+import os
+import sys
+import time
+import uuid
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+COLUMNS = ["sale_id", "region", "volume", "price", "sale_date", "updated_at", "buyer_id", "notes"]
+
+def make_rows(count):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    regions = ["North", "South", "East", "West", "Central"]
+    return [
+        (
+            i,
+            regions[i % len(regions)],
+            decimal.Decimal(i * 37 % 5000) / 4,
+            decimal.Decimal("19.99") + i % 100,
+            (start + datetime.timedelta(days=i % 365)).date(),
+            start + datetime.timedelta(minutes=i * 7),
+            uuid.UUID(int=i * 7919),
+            f"Lot {i % 40} harvested by crew {i % 9}"
+        )
+        for i in range(count)
+    ]
+
+def page(rows):
+    return {
+        "type": "sql_result_chunk",
+        "query": "SELECT * FROM timber_sales",
+        "cursor_id": "0123456789ab",
+        "page": 1,
+        "columns": COLUMNS,
+        "rows": rows,
+        "rows_sent": len(rows),
+        "done": True,
+        "truncated": False
+    }
+
+def baseline_dumps(payload):
+    # The old path had no encoder for these types; stringify them the way callers would have to
+    return json.dumps(payload, default=str)
+
+def deflate(frame):
+    data = frame.encode("utf-8") if isinstance(frame, str) else frame
+    compressor = zlib.compressobj(
+        server.WS_DEFLATE_LEVEL, zlib.DEFLATED, -server.WS_DEFLATE_WINDOW_BITS, server.WS_DEFLATE_MEM_LEVEL
+    )
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def timed(fn, payload, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(payload)
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=server.QUERY_PAGE_SIZE)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    values = make_rows(args.rows)
+    as_dicts = page([dict(zip(COLUMNS, row)) for row in values])
+    as_arrays = page(values)
+
+    cases = {
+        "baseline": (baseline_dumps, as_dicts),
+        "json": (server.LEGACY_FRAME_CODEC.encode, as_dicts),
+        "columnar": (server.FRAME_CODECS["edgequery.json"].encode, as_arrays),
+    }
+    if "edgequery.msgpack" in server.FRAME_CODECS:
+        cases["msgpack"] = (server.FRAME_CODECS["edgequery.msgpack"].encode, as_arrays)
+
+    print(f"{args.rows} rows x {len(COLUMNS)} columns, deflate level {server.WS_DEFLATE_LEVEL}, "
+          f"window {server.WS_DEFLATE_WINDOW_BITS} bits, memLevel {server.WS_DEFLATE_MEM_LEVEL}")
+    base_time = base_size = None
+    for name, (encode, payload) in cases.items():
+        seconds = timed(lambda p: deflate(encode(p)), payload, args.repeat)
+        encode_only = timed(encode, payload, args.repeat)
+        frame = encode(payload)
+        raw = len(frame.encode("utf-8") if isinstance(frame, str) else frame)
+        compressed = len(deflate(frame)) - 4
+        base_time = base_time or seconds
+        base_size = base_size or compressed
+        print(f"{name:>9}: {encode_only * 1e3:6.2f} ms encode  {seconds * 1e3:6.2f} ms +deflate  "
+              f"{raw:8d} B raw  {compressed:7d} B deflated  "
+              f"({base_time / seconds:4.1f}x faster, {base_size / compressed:4.1f}x smaller)")
+
+if __name__ == "__main__":
+    main()
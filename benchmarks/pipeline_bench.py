@@ -0,0 +1,622 @@
+"""Load-test the chat -> SQL pipeline end to end with a stub model and local Postgres.
+
+Runs the websocket server from server.py in-process. A deterministic stub
+takes the place of llama_cpp.Llama: it answers every question with a
+reasoning + SQL response for the question's domain and streams it at a fixed
+token rate. The domain schemas from client/src/domainConfigurations.js are
+loaded into Postgres (one bench_* schema per domain, filled with generated
+rows). N concurrent clients then drive handle_connection over real
+websockets, each sending requests one after another.
+
+Reports throughput, time to first token, end-to-end latency and the SQL phase
+(generation complete -> result) as p50/p95/p99.
+
+Postgres comes from --dsn or POSTGRES_CONNECTION_STRING, or is started with
+the optional pgserver package (--embedded-postgres); without one the SQL
+phase is skipped.
+
+Baselines are JSON files in benchmarks/baselines/: --save-baseline NAME stores
+a run, --compare NAME checks a run against one and exits with status 1 when
+throughput or a p50/p95 latency regressed by more than --tolerance.
+
+Usage: python benchmarks/pipeline_bench.py [--clients N] [--requests N]
+           [--token-rate T] [--compare NAME] [--save-baseline NAME]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+import types
+import zlib
+
+import asyncpg
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DOMAIN_CONFIG_PATH = os.path.join(ROOT, "client", "src", "domainConfigurations.js")
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+# Roughly what llama.cpp emits per step: a word, a run of punctuation or whitespace
+TOKEN_RE = re.compile(r'\s+|\w+|[^\w\s]')
+DOMAIN_LINE_RE = re.compile(r'^Domain:\s*(.+)$', re.MULTILINE)
+
+# Same prompt the bundled client builds (App.js createMessagePayload)
+SYSTEM_PROMPT = (
+    "You are a Text-to-SQL query generator. Use ONLY the provided context and THIS single user prompt "
+    "to reason step-by-step (concise) and produce a correct final SQL query.\n\n"
+    "Context:\nDomain: {name}\nDomain Description: {description}\nDatabase Schema: {schema}"
+)
+
+# Metrics compared against a baseline: (path, higher is better)
+COMPARED_METRICS = [
+    ("throughput_rps", True),
+    ("ttft.p50", False),
+    ("ttft.p95", False),
+    ("e2e.p50", False),
+    ("e2e.p95", False),
+]
+
+class Domain:
+    """One entry of domainConfigurations.js and its benchmark schema"""
+
+    def __init__(self, name: str, description: str, tables: dict, questions: list, schema: dict):
+        self.name = name
+        self.description = description
+        self.tables = tables  # table name -> [(column, type)]
+        self.schema = schema
+        self.pg_schema = "bench_" + re.sub(r'\W+', '_', name.lower()).strip('_')
+        self.questions = questions or [f"How many rows are in {table}?" for table in tables]
+
+    def system_prompt(self) -> str:
+        return SYSTEM_PROMPT.format(
+            name=self.name, description=self.description, schema=json.dumps(self.schema, indent=2)
+        )
+
+def _object_after(text: str, marker: str) -> str:
+    """Return the balanced {...} or [...] literal that follows ``marker``"""
+    start = text.index(marker) + len(marker)
+    while text[start] not in "{[":
+        start += 1
+    opener, closer = text[start], "}" if text[start] == "{" else "]"
+    depth = 0
+    for end in range(start, len(text)):
+        if text[end] == opener:
+            depth += 1
+        elif text[end] == closer:
+            depth -= 1
+            if depth == 0:
+                return text[start:end + 1]
+    raise ValueError(f"Unbalanced literal after {marker!r}")
+
+def load_domains(path: str = DOMAIN_CONFIG_PATH) -> list:
+    """Parse the domain list out of domainConfigurations.js"""
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    domains = []
+    for block in re.split(r'\n  \{\n', source)[1:]:
+        name = re.search(r'name:\s*"([^"]+)"', block).group(1)
+        description = re.search(r'description:\s*"([^"]*)"', block).group(1)
+        schema = json.loads(_object_after(block, "schema:"))
+        questions = json.loads(_object_after(block, "sampleQueries:")) if "sampleQueries:" in block else []
+        tables = {
+            table: [(column["name"], column["type"].upper()) for column in spec["columns"]]
+            for table, spec in schema["database_schema"].items()
+        }
+        domains.append(Domain(name, description, tables, questions, schema))
+    return domains
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+def column_expression(column: str, column_type: str, position: int) -> str:
+    """SQL producing a deterministic value for row ``g`` of a generated table"""
+    base_type = column_type.split("(")[0].strip()
+    if base_type in ("INT", "INTEGER", "BIGINT", "SMALLINT", "SERIAL"):
+        # Later *_id columns reference a small key range so joins and GROUP BYs have work to do
+        return "g" if position == 0 or not column.lower().endswith("id") else "1 + g % 50"
+    if base_type in ("REAL", "FLOAT", "DOUBLE", "DECIMAL", "NUMERIC"):
+        return "round(((g * 37) % 1000)::numeric / 4, 2)"
+    if base_type == "DATE":
+        return "DATE '2024-01-01' + (g % 365)"
+    if base_type in ("TIMESTAMP", "DATETIME"):
+        return "TIMESTAMP '2024-01-01' + g * INTERVAL '37 minutes'"
+    if base_type in ("BOOLEAN", "BOOL"):
+        return "g % 2 = 0"
+    if base_type in ("VARCHAR", "TEXT", "CHAR"):
+        length = re.search(r'\((\d+)\)', column_type)
+        value = f"'{column[:12]} ' || (g % 25)"
+        return f"left({value}, {length.group(1)})" if length else value
+    return "NULL"
+
+def postgres_type(column_type: str) -> str:
+    return "TIMESTAMP" if column_type.startswith("DATETIME") else column_type
+
+async def load_schemas(dsn: str, domains: list, rows: int):
+    """(Re)create one bench_* schema per domain and fill its tables"""
+    connection = await asyncpg.connect(dsn)
+    try:
+        for domain in domains:
+            schema = quote_ident(domain.pg_schema)
+            await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}")
+            for table, columns in domain.tables.items():
+                target = f"{schema}.{quote_ident(table)}"
+                definitions = ", ".join(f"{quote_ident(name)} {postgres_type(kind)}" for name, kind in columns)
+                values = ", ".join(column_expression(name, kind, i) for i, (name, kind) in enumerate(columns))
+                names = ", ".join(quote_ident(name) for name, _ in columns)
+                await connection.execute(f"CREATE TABLE {target} ({definitions})")
+                await connection.execute(
+                    f"INSERT INTO {target} ({names}) SELECT {values} FROM generate_series(1, {int(rows)}) AS g"
+                )
+                await connection.execute(f"ANALYZE {target}")
+    finally:
+        await connection.close()
+
+def start_embedded_postgres():
+    """Start a throwaway Postgres with the optional pgserver package; (dsn, handle) or (None, None)"""
+    try:
+        import pgserver
+    except ImportError:
+        return None, None
+    handle = pgserver.get_server(tempfile.mkdtemp(prefix="edgequery-bench-pg-"), cleanup_mode="delete")
+    return handle.get_uri(), handle
+
+def stub_response(messages: list, domains: dict, length: int) -> str:
+    """The fixed-shape answer the stub model gives: reasoning, then a tagged SQL query"""
+    system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+    match = DOMAIN_LINE_RE.search(system)
+    domain = domains.get(match.group(1).strip()) if match else None
+    if domain is None:
+        return "Reasoning: no schema was provided.\n<final_sql_query_start>\nSELECT 1;\n<final_sql_query_end>"
+
+    choice = zlib.crc32(question.encode("utf-8"))
+    table = sorted(domain.tables)[choice % len(domain.tables)]
+    columns = domain.tables[table]
+    target = f"{quote_ident(domain.pg_schema)}.{quote_ident(table)}"
+    shape = choice // len(domain.tables) % 3
+    if shape == 0:
+        sql = f"SELECT COUNT(*) AS total FROM {target};"
+    elif shape == 1:
+        group = columns[-1][0] if len(columns) > 1 else columns[0][0]
+        sql = (f"SELECT {quote_ident(group)}, COUNT(*) AS total FROM {target} "
+               f"GROUP BY {quote_ident(group)} ORDER BY total DESC;")
+    else:
+        sql = f"SELECT * FROM {target} ORDER BY 1 LIMIT 100;"
+
+    reasoning = [f"Reasoning: the question is about the {table} table in the {domain.name} domain."]
+    while len(TOKEN_RE.findall(" ".join(reasoning))) < length:
+        name, kind = columns[len(reasoning) % len(columns)]
+        reasoning.append(f"Column {name} holds {kind.lower()} values that may matter here.")
+    return " ".join(reasoning) + f"\n<final_sql_query_start>\n{sql}\n<final_sql_query_end>"
+
+class _StubState:
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.llama_state_size = len(tokens) * 4096
+
+class StubGrammar:
+    """Stand-in for llama_cpp.LlamaGrammar; the stub only checks that one was passed"""
+
+    def __init__(self, text):
+        self.text = text
+
+    @classmethod
+    def from_string(cls, grammar, verbose=True):
+        return cls(grammar)
+
+class StubLlama:
+    """Deterministic stand-in for llama_cpp.Llama.
+
+    Prefill costs ``prompt_rate`` tokens per second for the part of the prompt
+    that is not already in its simulated KV cache (0 = free), then the answer
+    streams at ``token_rate`` tokens per second. With a grammar the answer is
+    only the tagged SQL; a stop sequence ends it before the sequence, as
+    llama.cpp does.
+    """
+
+    token_rate = 200.0
+    prompt_rate = 0.0
+    response_tokens = 120
+    domains: dict = {}
+
+    def __init__(self, model_path=None, n_ctx=512):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self._cached = []
+
+    @classmethod
+    def from_pretrained(cls, repo_id=None, filename=None, n_ctx=512, **kwargs):
+        return cls(n_ctx=n_ctx)
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", "ignore")
+        return TOKEN_RE.findall(text)
+
+    def reset(self):
+        self._cached = []
+
+    def save_state(self):
+        return _StubState(list(self._cached))
+
+    def load_state(self, state):
+        self._cached = list(state.tokens)
+
+    def create_chat_completion(self, messages, stream=True, max_tokens=512, stop=None, grammar=None, **kwargs):
+        prompt = self.tokenize("\n".join(f"{m.get('role')}: {m.get('content', '')}" for m in messages))
+        shared = 0
+        for cached, token in zip(self._cached, prompt):
+            if cached != token:
+                break
+            shared += 1
+        if self.prompt_rate > 0:
+            time.sleep((len(prompt) - shared) / self.prompt_rate)
+        self._cached = prompt
+
+        finish_reason = "stop"
+        response = stub_response(messages, self.domains, self.response_tokens)
+        if grammar is not None:
+            response = response[response.find("<final_sql_query_start>"):]
+        else:
+            # Unconstrained models keep talking after the SQL block
+            response += " The query above answers the question." * (self.response_tokens // 30)
+        for marker in stop or []:
+            if marker in response:
+                response = response[:response.index(marker)]
+        for i, token in enumerate(TOKEN_RE.findall(response)):
+            if i >= max_tokens:
+                finish_reason = "length"
+                break
+            if self.token_rate > 0:
+                time.sleep(1.0 / self.token_rate)
+            yield {"choices": [{"delta": {"content": token}, "finish_reason": None}]}
+        yield {"choices": [{"delta": {}, "finish_reason": finish_reason}]}
+
+def install_stub_llama():
+    """Make ``from llama_cpp import Llama`` in server.py pick up the stub"""
+    module = types.ModuleType("llama_cpp")
+    module.Llama = StubLlama
+    module.LlamaGrammar = StubGrammar
+    sys.modules["llama_cpp"] = module
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(-(-p * len(ordered) // 100)) - 1))
+    return ordered[rank]
+
+def distribution(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values)
+    }
+
+def decode(message) -> dict:
+    if isinstance(message, bytes):
+        import msgpack
+        return msgpack.unpackb(message)
+    return json.loads(message)
+
+async def run_request(ws, payload: dict, expect_sql: bool, timeout: float) -> dict:
+    """Send one chat request and time it until its last frame"""
+    sample = {"ttft": None, "e2e": None, "sql": None, "tokens": 0, "queue_wait": None, "error": None}
+    started = time.perf_counter()
+    completed_at = None
+    await ws.send(json.dumps(payload))
+    try:
+        while True:
+            frame = decode(await asyncio.wait_for(ws.recv(), timeout))
+            kind = frame.get("type")
+            now = time.perf_counter()
+            if kind == "warning" and "already being generated" in frame.get("content", ""):
+                # The previous request's task was still wrapping up after its last frame
+                await asyncio.sleep(0.005)
+                await ws.send(json.dumps(payload))
+            elif kind == "chunk" and sample["ttft"] is None:
+                sample["ttft"] = now - started
+            elif kind == "generation_metrics":
+                session = frame["metrics"]["session"]
+                sample["tokens"] = session.get("tokens", 0)
+                sample["queue_wait"] = session.get("queue_wait")
+            elif kind == "error":
+                sample["error"] = frame.get("content")
+                break
+            elif kind == "complete":
+                completed_at = now
+                if not expect_sql:
+                    break
+            elif completed_at is None:
+                continue
+            elif kind == "sql_result_chunk" and (frame.get("done") or frame.get("truncated")):
+                break
+            elif kind == "sql_result":
+                if not frame["result"].get("success"):
+                    sample["error"] = frame["result"].get("error")
+                break
+            elif kind == "sql_error" or (kind == "warning" and "database" in frame.get("content", "").lower()):
+                sample["error"] = frame.get("error") or frame.get("content")
+                break
+    except asyncio.TimeoutError:
+        sample["error"] = f"no response within {timeout}s"
+    finished = time.perf_counter()
+    sample["e2e"] = finished - started
+    if completed_at is not None and expect_sql:
+        sample["sql"] = finished - completed_at
+    return sample
+
+class StartGate:
+    """Holds clients after their warmup requests so timing starts with all of them ready"""
+
+    def __init__(self):
+        self.waiting = 0
+        self.opened = asyncio.Event()
+
+    async def wait(self):
+        self.waiting += 1
+        await self.opened.wait()
+
+async def run_client(index: int, url: str, args, domains: list, expect_sql: bool, start_gate: StartGate) -> list:
+    """One simulated user: a connection sending requests back to back"""
+    domain = domains[index % len(domains)]
+    subprotocols = None if args.framing == "none" else [f"edgequery.{args.framing}"]
+    samples = []
+    async with websockets.connect(url, subprotocols=subprotocols, max_size=None) as ws:
+        for n in range(args.warmup + args.requests):
+            if n == args.warmup:
+                await start_gate.wait()
+            question = domain.questions[(index + n) % len(domain.questions)]
+            payload = {
+                "user_id": f"bench-{index}",
+                "message": question,
+                "messages": [
+                    {"role": "system", "content": domain.system_prompt()},
+                    {"role": "user", "content": question}
+                ]
+            }
+            sample = await run_request(ws, payload, expect_sql, args.timeout)
+            if n >= args.warmup:
+                samples.append(sample)
+            if args.think_time > 0:
+                await asyncio.sleep(args.think_time)
+    return samples
+
+def summarize(samples: list, wall: float, config: dict) -> dict:
+    ok = [s for s in samples if s["error"] is None]
+    errors = {}
+    for s in samples:
+        if s["error"] is not None:
+            errors[s["error"][:120]] = errors.get(s["error"][:120], 0) + 1
+    return {
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "results": {
+            "requests": len(samples),
+            "errors": sum(errors.values()),
+            "error_kinds": errors,
+            "wall_seconds": wall,
+            "throughput_rps": len(ok) / wall if wall > 0 else 0.0,
+            "tokens_per_second": sum(s["tokens"] for s in ok) / wall if wall > 0 else 0.0,
+            "ttft": distribution([s["ttft"] for s in ok if s["ttft"] is not None]),
+            "e2e": distribution([s["e2e"] for s in ok]),
+            "sql": distribution([s["sql"] for s in ok if s["sql"] is not None]),
+            "queue_wait": distribution([s["queue_wait"] for s in ok if s["queue_wait"] is not None])
+        }
+    }
+
+def print_report(summary: dict):
+    config, results = summary["config"], summary["results"]
+    print(f"{config['clients']} clients x {config['requests']} requests, {config['token_rate']} tokens/s stub, "
+          f"{config['slots']} slot(s), framing {config['framing']}, database {'on' if config['database'] else 'off'}")
+    print(f"{results['requests']} requests in {results['wall_seconds']:.2f}s, {results['errors']} errors; "
+          f"{results['throughput_rps']:.2f} req/s, {results['tokens_per_second']:.1f} tokens/s")
+    for error, count in results["error_kinds"].items():
+        print(f"  {count} x {error}")
+    print(f"{'':>11} {'p50':>9} {'p95':>9} {'p99':>9} {'mean':>9}")
+    for name in ("ttft", "e2e", "sql", "queue_wait"):
+        row = results[name]
+        if row["p50"] is None:
+            continue
+        cells = " ".join(f"{row[key] * 1e3:7.1f}ms" for key in ("p50", "p95", "p99", "mean"))
+        print(f"{name:>11} {cells}")
+
+def metric(results: dict, path: str):
+    value = results
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the change against a baseline; False if any compared metric regressed"""
+    differing = [key for key, value in baseline["config"].items() if summary["config"].get(key) != value]
+    if differing:
+        print(f"warning: baseline was recorded with different settings: {', '.join(differing)}")
+    passed = True
+    for path, higher_is_better in COMPARED_METRICS:
+        before, after = metric(baseline["results"], path), metric(summary["results"], path)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        passed = passed and not regressed
+        print(f"{path:>15}: {before:10.4f} -> {after:10.4f} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    if summary["results"]["errors"] > baseline["results"]["errors"]:
+        print(f"{'errors':>15}: {baseline['results']['errors']} -> {summary['results']['errors']}  REGRESSION")
+        passed = False
+    return passed
+
+def configure_server_environment(args, dsn):
+    """Settings server.py reads at import time"""
+    if dsn:
+        os.environ["POSTGRES_CONNECTION_STRING"] = dsn
+    else:
+        os.environ.pop("POSTGRES_CONNECTION_STRING", None)
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["MODEL_EAGER_LOAD"] = "0"
+    os.environ["INFERENCE_SLOTS"] = str(args.slots)
+    os.environ["MAX_QUEUED_REQUESTS"] = str(max(32, args.clients * 2))
+    os.environ.pop("SESSION_STORE_PATH", None)
+    os.environ.pop("RESPONSE_CACHE_PATH", None)
+    if not args.response_cache:
+        # Every repeated question would otherwise skip generation after the warmup
+        os.environ["RESPONSE_CACHE_MAX_ENTRIES"] = "0"
+    if not args.sql_cache:
+        # The stub answers each domain with the same query, so every SQL phase would be a hit
+        os.environ["SQL_CACHE_MAX_ENTRIES"] = "0"
+    os.environ["SCHEMA_SOURCE"] = args.schema_source
+    os.environ["DECODING_MODE"] = args.decoding_mode
+    os.environ["DOMAIN_DB_SCHEMAS"] = json.dumps({domain.name: [domain.pg_schema] for domain in args.loaded_domains})
+
+async def run(args) -> dict:
+    domains = load_domains()
+    if args.domains:
+        wanted = {name.strip().lower() for name in args.domains.split(",")}
+        domains = [domain for domain in domains if domain.name.lower() in wanted]
+    StubLlama.token_rate = args.token_rate
+    StubLlama.prompt_rate = args.prompt_rate
+    StubLlama.response_tokens = args.response_tokens
+    StubLlama.domains = {domain.name: domain for domain in domains}
+
+    embedded = None
+    dsn = args.dsn or os.getenv("POSTGRES_CONNECTION_STRING")
+    if not dsn and args.embedded_postgres:
+        dsn, embedded = start_embedded_postgres()
+        if not dsn:
+            print("warning: pgserver is not installed; running without a database")
+    if dsn and not args.skip_load:
+        await load_schemas(dsn, domains, args.rows)
+
+    args.loaded_domains = domains
+    configure_server_environment(args, dsn)
+    install_stub_llama()
+    import server
+    if not args.verbose:
+        server.logger.setLevel(logging.WARNING)
+        logging.getLogger("websockets").setLevel(logging.WARNING)
+
+    background = []
+    ws_server = None
+    try:
+        if dsn:
+            server.db_manager.ensure_pool_started()
+            if server.DB_POOL_ADAPTIVE:
+                background.append(asyncio.create_task(server.db_manager.adapt_pool_size()))
+            if not await server.db_manager.wait_for_pool(args.timeout):
+                raise RuntimeError("The server could not connect to the benchmark database")
+        await server.load_model()
+        ws_server = await server.serve_websocket("127.0.0.1", 0)
+        url = f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}"
+
+        start_gate = StartGate()
+        clients = [
+            asyncio.create_task(run_client(i, url, args, domains, bool(dsn), start_gate))
+            for i in range(args.clients)
+        ]
+        # Warmup requests run first; the clock starts once every client has finished them
+        while start_gate.waiting < len(clients) and not any(task.done() for task in clients):
+            await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        start_gate.opened.set()
+        samples = [sample for result in await asyncio.gather(*clients) for sample in result]
+        wall = time.perf_counter() - started
+    finally:
+        if ws_server is not None:
+            ws_server.close()
+            await ws_server.wait_closed()
+        for task in background:
+            task.cancel()
+        await server.db_manager.close_pool()
+        server.model_registry.shutdown()
+        if embedded is not None:
+            embedded.cleanup()
+
+    config = {
+        "clients": args.clients,
+        "requests": args.requests,
+        "warmup": args.warmup,
+        "token_rate": args.token_rate,
+        "prompt_rate": args.prompt_rate,
+        "response_tokens": args.response_tokens,
+        "slots": args.slots,
+        "framing": args.framing,
+        "rows": args.rows,
+        "think_time": args.think_time,
+        "response_cache": args.response_cache,
+        "sql_cache": args.sql_cache,
+        "schema_source": args.schema_source,
+        "decoding_mode": args.decoding_mode,
+        "domains": [domain.name for domain in domains],
+        "database": bool(dsn)
+    }
+    return summarize(samples, wall, config)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=8, help="concurrent websocket clients")
+    parser.add_argument("--requests", type=int, default=5, help="measured requests per client")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured requests per client first")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds between a client's requests")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="stub decode speed, tokens/s (0 = no delay)")
+    parser.add_argument("--prompt-rate", type=float, default=0.0, help="stub prefill speed, tokens/s (0 = free)")
+    parser.add_argument("--response-tokens", type=int, default=120, help="approximate length of each answer")
+    parser.add_argument("--slots", type=int, default=1, help="INFERENCE_SLOTS for the server")
+    parser.add_argument("--framing", choices=["none", "json", "msgpack"], default="json",
+                        help="websocket subprotocol the clients ask for")
+    parser.add_argument("--domains", help="comma-separated domain names to use (default: all)")
+    parser.add_argument("--dsn", help="Postgres to load the schemas into (default: POSTGRES_CONNECTION_STRING)")
+    parser.add_argument("--embedded-postgres", action="store_true", help="start a throwaway Postgres with pgserver")
+    parser.add_argument("--rows", type=int, default=1000, help="generated rows per table")
+    parser.add_argument("--skip-load", action="store_true", help="reuse bench_* schemas loaded by an earlier run")
+    parser.add_argument("--response-cache", action="store_true", help="leave the NL->SQL response cache on")
+    parser.add_argument("--sql-cache", action="store_true", help="leave the SQL result cache on")
+    parser.add_argument("--schema-source", choices=["client", "server"], default="client",
+                        help="send the full schema in every prompt, or let the server prune it from the database")
+    parser.add_argument("--decoding-mode", choices=["reasoning", "fast_sql", "full"], default="reasoning",
+                        help="DECODING_MODE for the server")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for any one frame")
+    parser.add_argument("--save-baseline", metavar="NAME", help="store this run in benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="compare with benchmarks/baselines/NAME.json")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    parser.add_argument("--json", metavar="PATH", help="also write the full summary to PATH")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's INFO logging")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    print_report(summary)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"baseline saved to {path}")
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json"), encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(summary, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
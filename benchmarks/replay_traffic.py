@@ -0,0 +1,244 @@
+"""Replay recorded chat traffic against a running server.
+
+Reads a trace written by the server with TRAFFIC_RECORD_PATH set and sends
+every request again at its recorded time offset, scaled by --speed (2 = twice
+as fast, 0 = as fast as each client can go). Each recorded client gets its own
+websocket connection and sends its requests in order, so per-user queueing,
+the generation scheduler, the caches and the connection pool see the recorded
+traffic shape.
+
+The trace holds only message sizes and salted digests. Messages are rebuilt
+as filler text of the recorded length: equal digests give equal text, so
+response-cache and prompt-prefix reuse repeat, and system prompts keep their
+"Domain:" line so routing and per-domain limits apply. Requests the user
+stopped are stopped again after their recorded generation time.
+
+Reports schedule lag (how late requests started against the scaled
+recording) and TTFT, queue wait and end-to-end latency as p50/p95/p99, next
+to the values recorded by the server.
+
+Usage: python benchmarks/replay_traffic.py TRACE [--url ws://127.0.0.1:8000]
+           [--speed N] [--limit N] [--json PATH]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import OrderedDict
+
+import websockets
+
+from pipeline_bench import decode, distribution
+
+WORDS = (
+    "show total count average sales region year month customer order product price volume "
+    "by per with from for each highest lowest last between top list which how many what where"
+).split()
+
+def load_trace(path: str, limit=None) -> list:
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+def filler(digest: str, chars: int, prefix: str = "") -> str:
+    """Deterministic text of ``chars`` characters for a message digest"""
+    rng = random.Random(digest)
+    parts = [prefix] if prefix else []
+    size = len(prefix)
+    while size < chars:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        size += len(word) + 1
+    return " ".join(parts)[:max(chars, len(prefix))]
+
+def build_payload(record: dict, pin_model: bool) -> dict:
+    messages = []
+    for message in record["messages"]:
+        prefix = ""
+        if message["role"] == "system" and record.get("domain"):
+            prefix = f"Context:\nDomain: {record['domain']}\n"
+        messages.append({
+            "role": message["role"],
+            "content": filler(message["digest"], message["chars"], prefix)
+        })
+    question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    payload = {
+        "user_id": f"replay-{record['client']}",
+        "message": question,
+        "messages": messages
+    }
+    if record.get("delta"):
+        payload["delta"] = True
+    if record.get("decoding_mode"):
+        payload["decoding_mode"] = record["decoding_mode"]
+    if pin_model and record.get("model"):
+        payload["model"] = record["model"]
+    return payload
+
+async def replay_request(ws, payload: dict, stop_after, timeout: float, sql_grace: float) -> dict:
+    """Send one request and time it until its last frame.
+
+    After ``complete`` the SQL phase, if any, starts right away; when no
+    frame arrives within ``sql_grace`` seconds the response had no query.
+    """
+    sample = {"ttft": None, "e2e": None, "queue_wait": None, "tokens": 0, "error": None}
+    started = time.perf_counter()
+    completed = False
+    sql_started = False
+    stop_task = None
+    await ws.send(json.dumps(payload))
+    if stop_after is not None:
+        async def stop():
+            await asyncio.sleep(stop_after)
+            await ws.send(json.dumps({"user_id": payload["user_id"], "action": "stop_generation"}))
+        stop_task = asyncio.create_task(stop())
+    try:
+        while True:
+            wait = sql_grace if completed and not sql_started else timeout
+            try:
+                frame = decode(await asyncio.wait_for(ws.recv(), wait))
+            except asyncio.TimeoutError:
+                if completed and not sql_started:
+                    break
+                raise
+            kind = frame.get("type")
+            content = frame.get("content") if isinstance(frame.get("content"), str) else ""
+            if kind == "warning" and "already being generated" in content:
+                await asyncio.sleep(0.005)
+                await ws.send(json.dumps(payload))
+            elif kind == "chunk" and sample["ttft"] is None:
+                sample["ttft"] = time.perf_counter() - started
+            elif kind == "generation_metrics":
+                session = frame["metrics"]["session"]
+                sample["tokens"] = session.get("tokens", 0)
+                sample["queue_wait"] = session.get("queue_wait")
+            elif kind == "error":
+                sample["error"] = content
+                break
+            elif kind == "complete":
+                completed = True
+            elif not completed:
+                continue
+            elif kind in ("status", "hold", "release_hold"):
+                sql_started = True
+            elif kind == "sql_result_chunk" and not (frame.get("done") or frame.get("truncated")):
+                sql_started = True
+            elif kind in ("sql_result", "sql_result_chunk", "sql_error", "warning"):
+                break
+    except asyncio.TimeoutError:
+        sample["error"] = f"no response within {timeout}s"
+    finally:
+        if stop_task is not None:
+            stop_task.cancel()
+    sample["e2e"] = time.perf_counter() - started
+    return sample
+
+async def replay_client(url: str, records: list, origin: float, first_ts: float, args) -> list:
+    """Play one recorded client's requests over a single connection"""
+    samples = []
+    subprotocols = None if args.framing == "none" else [f"edgequery.{args.framing}"]
+    async with websockets.connect(url, subprotocols=subprotocols, max_size=None) as ws:
+        for record in records:
+            due = origin + ((record["ts"] - first_ts) / args.speed if args.speed > 0 else 0.0)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(0.0, time.perf_counter() - due)
+            stop_after = None
+            if record.get("outcome") == "stopped":
+                stop_after = (record.get("generation_time") or 0.0) / (args.speed if args.speed > 0 else 1.0)
+            sample = await replay_request(
+                ws, build_payload(record, args.pin_model), stop_after, args.timeout, args.sql_grace
+            )
+            sample["lag"] = lag
+            samples.append(sample)
+    return samples
+
+async def replay(args) -> dict:
+    records = load_trace(args.trace, args.limit)
+    if not records:
+        raise SystemExit(f"{args.trace} holds no requests")
+    by_client = OrderedDict()
+    for record in records:
+        by_client.setdefault(record["client"], []).append(record)
+
+    first_ts = records[0]["ts"]
+    origin = time.perf_counter() + 0.5
+    started = time.perf_counter()
+    results = await asyncio.gather(*[
+        replay_client(args.url, client_records, origin, first_ts, args) for client_records in by_client.values()
+    ])
+    wall = time.perf_counter() - started
+    samples = [sample for client_samples in results for sample in client_samples]
+    ok = [s for s in samples if s["error"] is None]
+
+    recorded_e2e = [
+        (r.get("generation_time") or 0.0) + ((r.get("sql_execution") or {}).get("time") or 0.0) for r in records
+    ]
+    return {
+        "trace": args.trace,
+        "speed": args.speed,
+        "requests": len(samples),
+        "clients": len(by_client),
+        "errors": len(samples) - len(ok),
+        "recorded_seconds": records[-1]["ts"] - first_ts,
+        "wall_seconds": wall,
+        "throughput_rps": len(ok) / wall if wall > 0 else 0.0,
+        "lag": distribution([s["lag"] for s in samples]),
+        "replayed": {
+            "ttft": distribution([s["ttft"] for s in ok if s["ttft"] is not None]),
+            "queue_wait": distribution([s["queue_wait"] for s in ok if s["queue_wait"] is not None]),
+            "e2e": distribution([s["e2e"] for s in ok])
+        },
+        "recorded": {
+            "ttft": distribution([r["ttft"] for r in records if r.get("ttft") is not None]),
+            "queue_wait": distribution([r["queue_wait"] for r in records if r.get("queue_wait") is not None]),
+            "e2e": distribution(recorded_e2e)
+        }
+    }
+
+def print_report(summary: dict):
+    pace = f"at {summary['speed']}x" if summary["speed"] > 0 else "back to back"
+    print(f"{summary['requests']} requests from {summary['clients']} clients, {summary['errors']} errors; "
+          f"recorded over {summary['recorded_seconds']:.1f}s, replayed {pace} "
+          f"in {summary['wall_seconds']:.1f}s ({summary['throughput_rps']:.2f} req/s)")
+    if summary["speed"] > 0:
+        lag = summary["lag"]
+        print(f"schedule lag: p50 {lag['p50'] * 1e3:.1f}ms, p95 {lag['p95'] * 1e3:.1f}ms, p99 {lag['p99'] * 1e3:.1f}ms")
+    print(f"{'':>22} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name in ("ttft", "queue_wait", "e2e"):
+        for source in ("recorded", "replayed"):
+            row = summary[source][name]
+            if row["p50"] is None:
+                continue
+            cells = " ".join(f"{row[key] * 1e3:7.1f}ms" for key in ("p50", "p95", "p99"))
+            print(f"{name + ' ' + source:>22} {cells}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", help="JSONL written with TRAFFIC_RECORD_PATH")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale; 0 sends each client's requests back to back")
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    parser.add_argument("--framing", choices=["none", "json", "msgpack"], default="json")
+    parser.add_argument("--pin-model", action="store_true", help="send the recorded model instead of letting routing choose")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for any one frame")
+    parser.add_argument("--sql-grace", type=float, default=1.0,
+                        help="seconds to wait after completion for an SQL phase to start")
+    parser.add_argument("--json", metavar="PATH", help="also write the summary to PATH")
+    args = parser.parse_args()
+
+    summary = asyncio.run(replay(args))
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    if summary["errors"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,12 @@ import SqlResultDisplay from './components/SqlResultDisplay';
 import TokenMetricsDisplay from './components/TokenMetricsDisplay';
 import { domainConfigurations } from './domainConfigurations';
 
+// Columnar result frames (edgequery.json subprotocol) carry column names once and
+// each row as a value array; the result views expect one object per row
+const rowsToObjects = (columns, rows) => rows.map(row => (
+  Array.isArray(row) ? Object.fromEntries(columns.map((column, index) => [column, row[index]])) : row
+));
+
 // Responsive sidebar (domain only, closable on all viewports when toggle used)
 const Sidebar = ({ isOpen, onClose, domainSetupComplete, domainName, showDomainForm }) => {
   return (
@@ -173,7 +179,7 @@ function App() {
     if (isConnected || websocketRef.current) return;
     
     try {
-      const ws = new WebSocket('ws://localhost:8000');
+      const ws = new WebSocket('ws://localhost:8000', ['edgequery.json']);
       
       ws.onopen = () => {
         setIsConnected(true);
@@ -234,16 +240,58 @@ function App() {
             });
             break;
             
-          case 'sql_result':
+          case 'sql_result': {
             // Handle SQL execution results
+            const result = data.result && data.result.rows
+              ? { ...data.result, data: rowsToObjects(data.result.columns, data.result.rows), rows: undefined }
+              : data.result;
             setResponses(prev => [...prev, {
               sender: 'system',
               type: 'sql_result',
               query: data.query,
-              result: data.result,
+              result,
               timestamp: new Date().toLocaleTimeString()
             }]);
             break;
+          }
+            
+          case 'sql_result_chunk': {
+            // Paged results from a server-side cursor: merge pages into one result entry
+            const rows = rowsToObjects(data.columns, data.rows);
+            setResponses(prev => {
+              const newResponses = [...prev];
+              const index = newResponses.findIndex(r => r.type === 'sql_result' && r.cursorId === data.cursor_id);
+              if (index === -1) {
+                newResponses.push({
+                  sender: 'system',
+                  type: 'sql_result',
+                  query: data.query,
+                  cursorId: data.cursor_id,
+                  result: {
+                    success: true,
+                    data: rows,
+                    row_count: data.rows_sent,
+                    truncated: data.truncated,
+                    error: null
+                  },
+                  timestamp: new Date().toLocaleTimeString()
+                });
+              } else {
+                const existing = newResponses[index];
+                newResponses[index] = {
+                  ...existing,
+                  result: {
+                    ...existing.result,
+                    data: [...existing.result.data, ...rows],
+                    row_count: data.rows_sent,
+                    truncated: data.truncated
+                  }
+                };
+              }
+              return newResponses;
+            });
+            break;
+          }
             
           case 'generation_metrics':
             // Store token generation performance metrics locally (not in chat)
@@ -285,6 +333,16 @@ function App() {
     }
   }, [isConnected, domainSetupComplete, responses.length, updateStreamingResponse, removeDuplicatedWords]);
 
+  // Ask the server for the next page of a truncated SQL result
+  const fetchNextPage = useCallback((cursorId) => {
+    if (!websocketRef.current || !isConnected) return;
+    websocketRef.current.send(JSON.stringify({
+      user_id: userId,
+      action: 'fetch_next_page',
+      cursor_id: cursorId
+    }));
+  }, [isConnected, userId]);
+
   // Disconnect from WebSocket server
   const disconnectWebSocket = useCallback(() => {
     if (websocketRef.current) {
@@ -391,8 +449,8 @@ function App() {
   const handleDomainSetup = (e) => {
     e.preventDefault();
     
-    if (!domainName.trim() || !domainDescription.trim() || !domainSchema.trim()) {
-      alert('Please provide domain name, description, and database schema - all fields are required');
+    if (!domainName.trim() || !domainDescription.trim()) {
+      alert('Please provide domain name and description - both fields are required');
       return;
     }
     
@@ -452,13 +510,17 @@ function App() {
     });
     
     // Send formatted messages array to server with user ID
-    const payload = JSON.stringify({
+    const payload = {
       user_id: userId,
       message: message,
       messages: messages
-    });
+    };
+    if (!domainSchema.trim()) {
+      // No schema pasted: the server reads it from the database
+      payload.schema_source = 'server';
+    }
     
-    websocketRef.current.send(payload);
+    websocketRef.current.send(JSON.stringify(payload));
     
     // Start streaming state
     setIsStreaming(true);
@@ -726,7 +788,7 @@ function App() {
                 
                 <div>
                   <label htmlFor="domainSchema" className="block text-sm font-semibold text-edge-black dark:text-edge-white mb-2">
-                    <span>🗄️</span> Database Schema <span className="text-edge-red">*</span>
+                    <span>🗄️</span> Database Schema
                   </label>
                   <textarea
                     id="domainSchema"
@@ -734,11 +796,10 @@ function App() {
                     onChange={(e) => setDomainSchema(e.target.value)}
                     placeholder="Provide your database schema in JSON format or describe your table structures..."
                     rows={8}
-                    required
                     className="w-full px-4 py-3 border border-edge-grey-300 dark:border-edge-grey-600 rounded-lg bg-edge-white dark:bg-edge-grey-800 text-edge-black dark:text-edge-white focus:border-edge-blue focus:ring-2 focus:ring-edge-blue focus:ring-opacity-20 transition-colors resize-y font-mono text-sm"
                   />
                   <p className="text-xs text-edge-grey-500 dark:text-edge-grey-400 mt-2">
-                    <strong>Required:</strong> Provide table structures, column names, data types, and relationships to improve query accuracy.
+                    <strong>Optional:</strong> Provide table structures, column names, data types, and relationships. Leave empty to have the server read the schema from the database and send only the tables relevant to each question.
                   </p>
                 </div>
                 
@@ -791,6 +852,7 @@ function App() {
                     query={response.query}
                     result={response.result}
                     timestamp={response.timestamp}
+                    onLoadMore={response.cursorId ? () => fetchNextPage(response.cursorId) : undefined}
                   />
                 ) : response.type === 'sql_warning' ? (
                   <div className="text-xs text-edge-yellow font-medium">{response.content}</div>
@@ -1,6 +1,6 @@
 import React, { useState } from 'react';
 
-const SqlResultDisplay = ({ query, result, timestamp }) => {
+const SqlResultDisplay = ({ query, result, timestamp, onLoadMore }) => {
   const [isQueryExpanded, setIsQueryExpanded] = useState(false);
   const [isResultExpanded, setIsResultExpanded] = useState(true);
 
@@ -227,6 +227,15 @@ const SqlResultDisplay = ({ query, result, timestamp }) => {
                 
                 {result.data && result.data.length > 0 && formatDataTable(result.data)}
                 
+                {result.truncated && onLoadMore && (
+                  <button
+                    onClick={onLoadMore}
+                    className="w-full p-2 text-sm font-semibold text-edge-blue border border-edge-blue rounded-lg hover:bg-edge-blue hover:bg-opacity-10 transition-colors"
+                  >
+                    Load more rows
+                  </button>
+                )}
+                
                 {result.data && result.data.length === 0 && (
                   <div className="p-6 text-center text-edge-grey-500 bg-edge-grey-100 dark:bg-edge-grey-700 rounded-lg">
                     <p>Query executed successfully but returned no data.</p>
@@ -4,15 +4,43 @@ import nest_asyncio
 import gc
 import json
 import re
+import hashlib
+import hmac
+import random
+import bisect
+import sqlite3
 import time
+import datetime
+import decimal
+import uuid
 import statistics
-from collections import defaultdict
+import math
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
 from llama_cpp import Llama
 import asyncpg
 import os
 from typing import Optional, Dict, Any
 import socket
+import signal
+import tempfile
+import multiprocessing
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import Opcode
+
+try:
+    import msgpack  # optional, enables the edgequery.msgpack subprotocol
+except ImportError:
+    msgpack = None
+
+try:
+    from llama_cpp import LlamaGrammar  # GBNF-constrained decoding, used by the fast_sql mode
+except ImportError:
+    LlamaGrammar = None
 
 # Apply nest_asyncio to allow nested event loops (useful in notebooks)
 nest_asyncio.apply()
@@ -21,44 +49,577 @@ nest_asyncio.apply()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global model instance and activity tracker
-llm = None
-last_activity = None
-
-# User context storage - maps user_id to last 5 messages
-user_contexts = defaultdict(lambda: [])
-MAX_CONTEXT_MESSAGES = 5
-
-# Global variables for stopping LLM generation
-stop_generation = defaultdict(bool)
-active_generations = defaultdict(bool)
-
-# Token generation timing metrics
-token_generation_metrics = {
-    "total_tokens": 0,
-    "total_time": 0.0,
-    "session_times": [],
-    "last_session_tokens": 0,
-    "last_session_time": 0.0,
-    "last_session_avg_time_per_token": 0.0
+# Per-client sessions (conversation context plus stop/generation flags), see SessionStore.
+# Sessions idle past SESSION_TTL are dropped and the least recently used idle session is
+# evicted beyond SESSION_MAX_ENTRIES; stored messages are capped in number and length.
+# SESSION_STORE_PATH keeps conversation context in a SQLite file across restarts.
+MAX_CONTEXT_MESSAGES = int(os.getenv('MAX_CONTEXT_MESSAGES', '20'))
+SESSION_MAX_MESSAGE_CHARS = int(os.getenv('SESSION_MAX_MESSAGE_CHARS', '8000'))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+SESSION_TTL = float(os.getenv('SESSION_TTL', '3600'))
+SESSION_STORE_PATH = os.getenv('SESSION_STORE_PATH')
+
+# Server-owned conversation context: a request with "delta": true carries only its new
+# messages and the server adds the stored system prompt plus its stored history. Full and
+# delta requests alike keep as much history as fits in PROMPT_TOKEN_BUDGET (counted with the
+# model's tokenizer), and never more than the context window leaves after the answer's
+# max_tokens. The oldest turns are dropped first and, with CONTEXT_SUMMARIZE, folded into a
+# one-message recap.
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '2048'))
+CONTEXT_SUMMARIZE = os.getenv('CONTEXT_SUMMARIZE', '1') != '0'
+
+# Truncated query results awaiting a fetch_next_page action, keyed by client
+open_result_cursors = {}
+
+# Configuration (models and the idle timeouts can be changed at runtime through the
+# configure_model websocket action)
+device = os.getenv('DEVICE', 'cpu')
+model_repo = os.getenv('MODEL_REPO', "devMubashir/text-to-sql-reasoning-llama3.2-3b")
+model_file = os.getenv('MODEL_FILE', "unsloth.Q8_0.gguf")
+
+# Model registry. "default" is MODEL_REPO/MODEL_FILE and "q4" the smaller Q4_K_M export;
+# MODEL_REGISTRY is a JSON object adding or overriding entries, e.g.
+# {"fast": {"repo": "...", "file": "...", "reasoning": false, "size_mb": 2000}}
+DEFAULT_MODEL_REGISTRY = {
+    "default": {"repo": model_repo, "file": model_file, "reasoning": True},
+    "q4": {"repo": "devMubashir/llama3.2-3b-ttsql-reasoning-v2-gguf", "file": "unsloth.Q4_K_M.gguf", "reasoning": True}
+}
+MODEL_REGISTRY = json.loads(os.getenv('MODEL_REGISTRY', '{}'))
+DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'default')
+# Routing policy for requests that do not name a model: JSON object mapping domain names
+# (or "default") to registry names, e.g. {"Forestry": "q4"}
+MODEL_ROUTES = json.loads(os.getenv('MODEL_ROUTES', '{}'))
+# RAM budget for resident model weights (MB, 0 = unlimited); the least recently used idle
+# models are unloaded to make room for the one a request needs
+MODEL_RAM_BUDGET_MB = float(os.getenv('MODEL_RAM_BUDGET_MB', '6144'))
+
+# Load the model when the server starts instead of on the first connection
+MODEL_EAGER_LOAD = os.getenv('MODEL_EAGER_LOAD', '1') != '0'
+# Memory-map the GGUF weights so a reload is served from the page cache; mlock pins them in RAM
+MODEL_USE_MMAP = os.getenv('MODEL_USE_MMAP', '1') != '0'
+MODEL_USE_MLOCK = os.getenv('MODEL_USE_MLOCK', '0') == '1'
+# Context window (prompt plus answer) each inference slot is created with
+MODEL_N_CTX = int(os.getenv('MODEL_N_CTX', '4096'))
+
+# Idle policy (seconds). After MODEL_SOFT_IDLE_TIMEOUT the extra inference slots and saved
+# prefix states are released while one copy of the weights stays resident; after
+# IDLE_TIMEOUT the weights are unloaded as well.
+IDLE_TIMEOUT = float(os.getenv('IDLE_TIMEOUT', '600'))
+MODEL_SOFT_IDLE_TIMEOUT = float(os.getenv('MODEL_SOFT_IDLE_TIMEOUT', '120'))
+MODEL_IDLE_CHECK_INTERVAL = float(os.getenv('MODEL_IDLE_CHECK_INTERVAL', '30'))
+
+# Inference scheduling: number of model slots decoding in parallel and waiting-room size
+INFERENCE_SLOTS = max(1, int(os.getenv('INFERENCE_SLOTS', '1')))
+MAX_QUEUED_REQUESTS = int(os.getenv('MAX_QUEUED_REQUESTS', '32'))
+
+# Prompt prefix (KV cache) reuse: memory budget for saved llama.cpp states
+PREFIX_CACHE_MAX_BYTES = int(os.getenv('PREFIX_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# NL->SQL response cache: repeated questions against the same schema skip generation. Below 1.0,
+# RESPONSE_CACHE_SIMILARITY also matches questions that differ only in filler words
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '256'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', str(24 * 3600)))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '1.0'))
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH')  # optional SQLite file for persistence
+
+# Decoding modes, chosen per request with "decoding_mode":
+#   reasoning - the model reasons, then generation stops at the <final_sql_query_end> tag
+#   fast_sql  - no reasoning; a GBNF grammar allows exactly one PostgreSQL SELECT, and with
+#               DECODING_GRAMMAR_IDENTIFIERS only the tables and columns of the prompt's
+#               JSON schema may be referenced
+#   full      - unconstrained until end of text or the token budget (the old behaviour)
+# DECODING_TOKEN_BUDGETS sets max_tokens per mode. A DECODING_BASELINE_SAMPLE share of
+# reasoning requests runs unconstrained to estimate how many tokens the modes save.
+DECODING_MODES = ("reasoning", "fast_sql", "full")
+DECODING_MODE = os.getenv('DECODING_MODE', 'reasoning')
+DECODING_TOKEN_BUDGETS = {"reasoning": 2048, "fast_sql": 384, "full": 2048}
+DECODING_TOKEN_BUDGETS.update(json.loads(os.getenv('DECODING_TOKEN_BUDGETS', '{}')))
+DECODING_GRAMMAR_IDENTIFIERS = os.getenv('DECODING_GRAMMAR_IDENTIFIERS', '1') != '0'
+DECODING_BASELINE_SAMPLE = float(os.getenv('DECODING_BASELINE_SAMPLE', '0.02'))
+
+# Start executing a read as soon as the model closes its SQL block, while it keeps streaming
+SQL_SPECULATIVE_EXECUTION = os.getenv('SQL_SPECULATIVE_EXECUTION', '1') != '0'
+
+# Streaming: tokens are coalesced into one chunk frame per time window or byte budget
+STREAM_FLUSH_INTERVAL = float(os.getenv('STREAM_FLUSH_INTERVAL', '0.03'))
+STREAM_FLUSH_BYTES = int(os.getenv('STREAM_FLUSH_BYTES', '512'))
+
+# Websocket framing. Clients choose an encoding through the websocket subprotocol:
+# "edgequery.msgpack" (binary frames, needs the msgpack package) or "edgequery.json".
+# Both send query results column-wise (column names once, then one value array per row);
+# clients that ask for no subprotocol keep getting JSON rows as dicts.
+# permessage-deflate uses a small zlib window and memory level per connection, and frames
+# under WS_COMPRESSION_MIN_BYTES (token chunks, status messages) are sent uncompressed.
+WS_COMPRESSION = os.getenv('WS_COMPRESSION', '1') != '0'
+WS_DEFLATE_LEVEL = int(os.getenv('WS_DEFLATE_LEVEL', '1'))
+WS_DEFLATE_MEM_LEVEL = int(os.getenv('WS_DEFLATE_MEM_LEVEL', '5'))
+WS_DEFLATE_WINDOW_BITS = int(os.getenv('WS_DEFLATE_WINDOW_BITS', '12'))
+WS_COMPRESSION_MIN_BYTES = int(os.getenv('WS_COMPRESSION_MIN_BYTES', '256'))
+
+# Sentinel marking the end of a token stream coming from the inference worker
+_STREAM_END = object()
+
+# SQL result streaming: rows are sent in pages through a server-side cursor
+SQL_STREAM_RESULTS = os.getenv('SQL_STREAM_RESULTS', '1') != '0'
+QUERY_PAGE_SIZE = int(os.getenv('QUERY_PAGE_SIZE', '200'))
+QUERY_MAX_ROWS = int(os.getenv('QUERY_MAX_ROWS', '1000'))
+QUERY_MAX_BYTES = int(os.getenv('QUERY_MAX_BYTES', str(2 * 1024 * 1024)))
+QUERY_CURSOR_IDLE_TIMEOUT = float(os.getenv('QUERY_CURSOR_IDLE_TIMEOUT', '30'))
+
+# Database connection strategies are raced with this delay between starts (seconds)
+DB_CONNECT_STAGGER = float(os.getenv('DB_CONNECT_STAGGER', '0.5'))
+# Remembers which connection strategy worked last time so it is tried first
+DB_STRATEGY_CACHE_PATH = os.getenv(
+    'DB_STRATEGY_CACHE_PATH',
+    os.path.join(os.path.expanduser('~'), '.edgequery_db_strategy.json')
+)
+
+# Background pool maintenance: reconnect backoff, health checks, and how long a ready
+# SQL query waits for the pool before giving up
+DB_RECONNECT_INITIAL_DELAY = float(os.getenv('DB_RECONNECT_INITIAL_DELAY', '2'))
+DB_RECONNECT_MAX_DELAY = float(os.getenv('DB_RECONNECT_MAX_DELAY', '60'))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_HEALTH_CHECK_INTERVAL', '30'))
+DB_READY_TIMEOUT = float(os.getenv('DB_READY_TIMEOUT', '15'))
+
+# Connection pool settings (changeable at runtime through DatabaseManager.reconfigure_pool).
+# DB_POOL_MAX_SIZE is the ceiling; the adaptive policy moves the concurrency limit between
+# min and max from acquire queueing and query latency.
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '5'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '30'))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '256'))
+DB_STATEMENT_CACHE_LIFETIME = float(os.getenv('DB_STATEMENT_CACHE_LIFETIME', '3600'))
+DB_POOL_ADAPTIVE = os.getenv('DB_POOL_ADAPTIVE', '1') != '0'
+DB_POOL_ADAPT_INTERVAL = float(os.getenv('DB_POOL_ADAPT_INTERVAL', '10'))
+# Shared secret for the configure_pool websocket action; the action is disabled when unset
+DB_ADMIN_TOKEN = os.getenv('DB_ADMIN_TOKEN')
+# Shared secret for the configure_model websocket action (defaults to DB_ADMIN_TOKEN)
+MODEL_ADMIN_TOKEN = os.getenv('MODEL_ADMIN_TOKEN', DB_ADMIN_TOKEN)
+
+# Pre-execution gate for model-generated SQL. Limits are per domain: SQL_QUERY_LIMITS is a JSON
+# object mapping domain names (or "default") to any of max_cost, max_rows and
+# statement_timeout_ms, e.g. {"Forestry": {"max_rows": 5000}}
+SQL_COST_GATE = os.getenv('SQL_COST_GATE', '1') != '0'
+SQL_ALLOW_WRITES = os.getenv('SQL_ALLOW_WRITES', '0') == '1'
+SQL_READ_ONLY = os.getenv('SQL_READ_ONLY', '1') != '0'
+DEFAULT_QUERY_LIMITS = {
+    "max_cost": 1_000_000.0,
+    "max_rows": 100_000,
+    "statement_timeout_ms": 10_000
 }
+SQL_QUERY_LIMITS = json.loads(os.getenv('SQL_QUERY_LIMITS', '{}'))
+
+# Result cache for generated reads. Entries are keyed on the normalized SQL plus the domain's
+# limits and remember the tables the query plan reads; a hit skips the gate and the query.
+# Entries reading a table are dropped on a NOTIFY on SQL_CACHE_CHANNEL (payload
+# "schema.table", or "*" for everything) and after a write run by this server. By default a
+# hit also checks a database-wide write watermark (one cheap query) and misses once any
+# write has committed since the result was read. SQL_CACHE_TRIGGERS=1 instead installs
+# statement triggers that send the NOTIFYs (needs the TRIGGER privilege): invalidation is
+# then per table and hits do not touch the database at all.
+SQL_CACHE_MAX_ENTRIES = int(os.getenv('SQL_CACHE_MAX_ENTRIES', '512'))
+SQL_CACHE_MAX_BYTES = int(os.getenv('SQL_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+SQL_CACHE_TTL = float(os.getenv('SQL_CACHE_TTL', '300'))
+SQL_CACHE_TRIGGERS = os.getenv('SQL_CACHE_TRIGGERS', '0') == '1'
+SQL_CACHE_CHANNEL = os.getenv('SQL_CACHE_CHANNEL', 'edgequery_table_change')
 
-# Configuration
-device = "cpu"
-model_repo = "devMubashir/text-to-sql-reasoning-llama3.2-3b"
-model_file = "unsloth.Q8_0.gguf"
+# Server-side schema prompts. With SCHEMA_SOURCE=server (or "schema_source": "server" in a
+# request) the server introspects the database through the pool and replaces the schema the
+# client pasted into the system prompt with the tables and columns relevant to the question.
+# DOMAIN_DB_SCHEMAS maps domain names (or "default") to the Postgres schemas searched, e.g.
+# {"Forestry": ["forestry"], "default": ["public"]}. Introspection is cached for
+# SCHEMA_CACHE_TTL seconds and reloaded in the background after that.
+SCHEMA_SOURCE = os.getenv('SCHEMA_SOURCE', 'client')
+DOMAIN_DB_SCHEMAS = json.loads(os.getenv('DOMAIN_DB_SCHEMAS', '{}'))
+SCHEMA_CACHE_TTL = float(os.getenv('SCHEMA_CACHE_TTL', '300'))
+SCHEMA_MAX_TABLES = int(os.getenv('SCHEMA_MAX_TABLES', '6'))
+SCHEMA_MAX_COLUMNS = int(os.getenv('SCHEMA_MAX_COLUMNS', '24'))
+
+# Opt-in traffic recording for capacity tests: one anonymized JSON line per chat request
+# (message sizes, domain, timings, generated SQL with its literals masked, result sizes) is
+# appended to TRAFFIC_RECORD_PATH; benchmarks/replay_traffic.py plays a recording back.
+# TRAFFIC_RECORD_SAMPLE records that fraction of requests; TRAFFIC_RECORD_SALT keys the
+# hashes of user ids and message text (random per process when unset).
+TRAFFIC_RECORD_PATH = os.getenv('TRAFFIC_RECORD_PATH')
+TRAFFIC_RECORD_SAMPLE = float(os.getenv('TRAFFIC_RECORD_SAMPLE', '1'))
+TRAFFIC_RECORD_SALT = os.getenv('TRAFFIC_RECORD_SALT')
+
+# Websocket listen address
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '8000'))
+
+# Horizontal scaling. With SERVER_WORKERS > 1 a supervisor starts that many worker processes,
+# each with its own models and database pool, accepting on the same port through SO_REUSEPORT.
+# State that must reach whichever worker holds a user (stop requests, generation ownership,
+# conversation context, worker metrics endpoints) lives in the SQLite file CONTROL_STORE_PATH
+# (a temporary file when unset); workers poll it for stop requests every CONTROL_POLL_INTERVAL.
+SERVER_WORKERS = max(1, int(os.getenv('SERVER_WORKERS', '1')))
+CONTROL_STORE_PATH = os.getenv('CONTROL_STORE_PATH')
+CONTROL_POLL_INTERVAL = float(os.getenv('CONTROL_POLL_INTERVAL', '0.1'))
+# Index of this worker process and the pid of its supervisor, set by run_worker
+WORKER_INDEX = 0
+SUPERVISOR_PID = None
+
+# Prometheus-style metrics served over plain HTTP at /metrics (METRICS_PORT=0 disables it).
+# Label values that come from clients (domains) are capped per metric by METRICS_MAX_SERIES.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8001'))
+METRICS_MAX_SERIES = int(os.getenv('METRICS_MAX_SERIES', '200'))
 
-# Idle timeout (seconds)
-IDLE_TIMEOUT = 600
 # PostgreSQL connection string - now from environment variable
 POSTGRES_CONNECTION_STRING = os.getenv(
     'POSTGRES_CONNECTION_STRING'
 )
 
+class Histogram:
+    """Fixed-bucket histogram for latencies in seconds.
+
+    Observations only increment a bucket counter, so recording is cheap and
+    memory is constant; quantiles are estimated from bucket upper bounds.
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+    def merge(self, other: "Histogram"):
+        """Add another histogram with the same buckets into this one"""
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.count += other.count
+        self.sum += other.sum
+
+# Buckets for sub-millisecond work (e.g. SQL extraction per response)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                0.0025, 0.005, 0.01, 0.025, 0.05)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class MetricFamily:
+    """A named counter, gauge or histogram with one series per label combination.
+
+    Series are created on first use and capped at ``max_series``; label
+    values beyond the cap are folded into an "other" series so client
+    supplied values cannot grow memory without bound.
+    """
+
+    def __init__(self, name: str, kind: str, help_text: str, label_names=(),
+                 buckets=Histogram.DEFAULT_BUCKETS, max_series: int = METRICS_MAX_SERIES):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.max_series = max_series
+        self.series: Dict[tuple, Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        if key not in self.series and len(self.series) >= self.max_series:
+            key = ("other",) * len(self.label_names)
+        return key
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.series[key] = self.series.get(key, 0.0) + amount
+
+    def set(self, value: float, **labels):
+        self.series[self._key(labels)] = value
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        histogram = self.series.get(key)
+        if histogram is None:
+            histogram = self.series[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def attach(self, histogram: Histogram, **labels):
+        """Export an existing Histogram (e.g. one owned by DatabaseManager) as a series"""
+        self.series[self._key(labels)] = histogram
+
+    def value(self, **labels):
+        return self.series.get(tuple(str(labels.get(name, "")) for name in self.label_names))
+
+    def total(self) -> float:
+        """Sum of a counter across all series"""
+        return sum(self.series.values())
+
+    def merged(self) -> Histogram:
+        """All series of a histogram combined into one"""
+        combined = Histogram(self.buckets)
+        for histogram in self.series.values():
+            combined.merge(histogram)
+        return combined
+
+    def _labels(self, key: tuple, extra: str = "") -> str:
+        parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(self.label_names, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, series in list(self.series.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{self._labels(key)} {series}")
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(series.buckets, series.counts):
+                cumulative += bucket_count
+                bucket_labels = self._labels(key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = self._labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {series.count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {series.sum}")
+            lines.append(f"{self.name}_count{self._labels(key)} {series.count}")
+        return lines
+
+class MetricsRegistry:
+    """Collection of metric families rendered in the Prometheus text format.
+
+    Recording is a dict lookup plus an add, cheap enough for the per-token
+    path. Collectors run just before rendering to copy live state (pool
+    size, queue depth, cache statistics) into gauges.
+    """
+
+    def __init__(self, namespace: str = "edgequery"):
+        self.namespace = namespace
+        self.families: Dict[str, MetricFamily] = {}
+        self._collectors = []
+
+    def _family(self, name: str, kind: str, help_text: str, labels=(), **kwargs) -> MetricFamily:
+        full_name = f"{self.namespace}_{name}"
+        family = self.families.get(full_name)
+        if family is None:
+            family = self.families[full_name] = MetricFamily(full_name, kind, help_text, labels, **kwargs)
+        return family
+
+    def counter(self, name: str, help_text: str, labels=()) -> MetricFamily:
+        return self._family(name, "counter", help_text, labels)
+
+    def gauge(self, name: str, help_text: str, labels=()) -> MetricFamily:
+        return self._family(name, "gauge", help_text, labels)
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=Histogram.DEFAULT_BUCKETS) -> MetricFamily:
+        return self._family(name, "histogram", help_text, labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        lines = []
+        for family in self.families.values():
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+# Initialize the metrics registry and the metrics recorded by request handling
+metrics = MetricsRegistry()
+REQUESTS = metrics.counter("requests_total", "Chat requests by model, domain and outcome", ("model", "domain", "outcome"))
+TOKENS = metrics.counter("tokens_generated_total", "Tokens generated", ("model",))
+DECODING_REQUESTS = metrics.counter(
+    "decoding_requests_total", "Generations by decoding mode and how they ended", ("model", "mode", "finish")
+)
+CANCELLATIONS = metrics.counter(
+    "cancellations_total", "Work abandoned by a stop, a disconnect or a superseded speculative query",
+    ("phase", "reason")
+)
+WASTED_SECONDS = metrics.counter(
+    "wasted_seconds_total", "Inference slot or database time spent on abandoned work", ("phase", "reason")
+)
+WASTED_TOKENS = metrics.counter("wasted_tokens_total", "Tokens generated for abandoned responses", ("model", "reason"))
+AVOIDED_TOKENS = metrics.counter(
+    "avoided_tokens_total", "Estimated tokens not generated because abandoned responses were cut short",
+    ("model", "reason")
+)
+DECODING_TOKENS_SAVED = metrics.counter(
+    "decoding_tokens_saved_total", "Estimated tokens not generated thanks to the stop tag or the SQL grammar",
+    ("model", "mode")
+)
+ERRORS = metrics.counter("errors_total", "Errors by kind", ("kind",))
+TTFT = metrics.histogram("ttft_seconds", "Time from request to first token", ("model", "domain"))
+INTER_TOKEN = metrics.histogram("inter_token_seconds", "Time between consecutive tokens", ("model",))
+QUEUE_WAIT = metrics.histogram("queue_wait_seconds", "Time spent waiting for an inference slot", ("model",))
+GENERATION_TIME = metrics.histogram("generation_seconds", "Total time to answer a chat request", ("model",))
+SQL_EXTRACTION = metrics.histogram("sql_extraction_seconds", "Time spent extracting SQL per response", buckets=FAST_BUCKETS)
+SQL_EXECUTION = metrics.histogram("sql_execution_seconds", "Generated SQL gate plus execution time", ("domain", "outcome"))
+ACTIVE_CONNECTIONS = metrics.gauge("websocket_connections", "Open websocket connections")
+SCHEMA_PROMPTS = metrics.counter("schema_prompts_total", "Server-built schema prompts by outcome", ("outcome",))
+SCHEMA_PROMPT_CHARS = metrics.histogram(
+    "schema_prompt_chars", "Size of server-built schema prompts",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+)
+SCHEMA_INTROSPECTION = metrics.histogram("schema_introspection_seconds", "Time to introspect a database schema")
+
+# Rolling window behind the rolling_avg_session_time shown by the client
+recent_session_times = deque(maxlen=50)
+
+class ConnectionLimiter:
+    """Adjustable cap on concurrently checked-out pool connections.
+
+    asyncpg pools cannot be resized in place, so the pool is created with the
+    configured maximum and this limiter decides how many connections may be
+    in use at once. Shrinking the limit lets surplus connections go idle and
+    be closed by the pool's inactivity timeout.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.waiters = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            self.waiters += 1
+            try:
+                await self._condition.wait_for(lambda: self.in_use < self.limit)
+            finally:
+                self.waiters -= 1
+            self.in_use += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_use -= 1
+            self._condition.notify()
+
+    async def set_limit(self, limit: int):
+        async with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
 class DatabaseManager:
     def __init__(self, connection_string: str):
         self.connection_string = connection_string
         self.pool: Optional[asyncpg.Pool] = None
+        self.last_error: Optional[str] = None
+        # Single shared pool initialization task; every caller joins the same one
+        self._init_task: Optional[asyncio.Task] = None
+        self._status_listeners = set()
+        # Connection string of the strategy that won, reused when the pool is rebuilt
+        self._active_conn_str: Optional[str] = None
+        self.pool_settings = {
+            "min_size": DB_POOL_MIN_SIZE,
+            "max_size": DB_POOL_MAX_SIZE,
+            "command_timeout": DB_COMMAND_TIMEOUT,
+            "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "max_cached_statement_lifetime": DB_STATEMENT_CACHE_LIFETIME
+        }
+        self.limiter = ConnectionLimiter(DB_POOL_MAX_SIZE)
+        self.acquire_wait = Histogram()
+        self.query_latency = Histogram()
+        # Per-interval samples for the adaptive sizing policy
+        self._window_queries = 0
+        self._window_query_time = 0.0
+        self._window_waiters_peak = 0
+        self._window_in_use_peak = 0
+        self._baseline_query_latency: Optional[float] = None
+
+    def add_status_listener(self, listener):
+        """Register ``async listener(ready: bool, message: str)`` for pool readiness changes"""
+        self._status_listeners.add(listener)
+
+    def remove_status_listener(self, listener):
+        self._status_listeners.discard(listener)
+
+    async def _notify_status(self, ready: bool, message: str):
+        for listener in list(self._status_listeners):
+            try:
+                await listener(ready, message)
+            except Exception as e:
+                logger.debug(f"Failed to deliver database status: {e}")
+
+    @property
+    def is_initializing(self) -> bool:
+        return self._init_task is not None and not self._init_task.done()
+
+    def ensure_pool_started(self) -> Optional[asyncio.Task]:
+        """Start the background pool initialization unless it is ready or already running"""
+        if self.pool is not None or not self.connection_string:
+            return None
+        if not self.is_initializing:
+            self._init_task = asyncio.create_task(self._initialize_with_retry())
+        return self._init_task
+
+    async def _initialize_with_retry(self):
+        """Initialize the pool, retrying with exponential backoff until it succeeds"""
+        delay = DB_RECONNECT_INITIAL_DELAY
+        while self.pool is None:
+            try:
+                await self.initialize_pool()
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning(f"Database initialization failed: {e}. Retrying in {delay:g}s")
+                await self._notify_status(False, f"Database connection failed: {str(e)}. Retrying in {delay:g}s; chat remains available.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, DB_RECONNECT_MAX_DELAY)
+                continue
+            self.last_error = None
+            pool_status = await self.get_pool_status()
+            await self._notify_status(True, f"Database connection established successfully. Pool status: {pool_status['status']}")
+
+    async def wait_for_pool(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds for the pool to become ready"""
+        if self.pool is not None:
+            return True
+        task = self.ensure_pool_started()
+        if task is None:
+            return False
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.pool is not None
+
+    async def monitor_health(self):
+        """Periodically test the pool and rebuild it in the background when it dies"""
+        while True:
+            await asyncio.sleep(DB_HEALTH_CHECK_INTERVAL)
+            if self.pool is None:
+                self.ensure_pool_started()
+                continue
+            if await self.test_connection():
+                continue
+            logger.warning("Database health check failed; reconnecting in the background")
+            pool, self.pool = self.pool, None
+            pool.terminate()
+            await self._notify_status(False, "Database connection lost. Reconnecting...")
+            self.ensure_pool_started()
 
     def parse_connection_string(self, conn_str: str) -> dict:
         """Parse PostgreSQL connection string into components"""
@@ -71,14 +632,6 @@ class DatabaseManager:
             parsed = urllib.parse.urlparse(conn_str)
         else:
             raise ValueError("Invalid connection string format")
-        print ({
-            'user': parsed.username,
-            'password': parsed.password,
-            'host': parsed.hostname,
-            'port': parsed.port or 5432,
-            'database': parsed.path.lstrip('/') if parsed.path else 'postgres',
-            'query': dict(urllib.parse.parse_qsl(parsed.query)) if parsed.query else {}
-        })
         return {
             'user': parsed.username,
             'password': parsed.password,
@@ -171,47 +724,119 @@ class DatabaseManager:
         return strategies
 
     async def initialize_pool(self):
-        """Initialize database connection pool with multiple strategies"""
-        strategies = await self.get_connection_strategies()
-        
-        for i, strategy in enumerate(strategies, 1):
-            try:
-                logger.info(f"Attempting database connection (strategy {i}: {strategy['name']})...")
-                
-                # Create pool with better configuration
-                self.pool = await asyncpg.create_pool(
-                    strategy['conn_str'],
-                    min_size=1,
-                    max_size=5,  # Reduce pool size for stability  
-                    command_timeout=30,
-                    server_settings={
-                        'application_name': 'llama_websocket_server',
-                        'timezone': 'UTC'
-                    },
-                    init=self._init_connection
-                )
-                
-                # Test the connection
-                if await self.test_connection():
-                    logger.info(f"Database connection established successfully using strategy {i}")
-                    return
-                else:
-                    logger.warning(f"Strategy {i} created pool but connection test failed")
-                    await self.pool.close()
-                    self.pool = None
-                    
-            except Exception as e:
-                logger.warning(f"Strategy {i} failed: {e}")
-                if self.pool:
+        """Initialize database connection pool by racing the connection strategies.
+
+        Strategies start staggered, happy-eyeballs style: the next one starts
+        as soon as the previous attempt fails or ``DB_CONNECT_STAGGER`` seconds
+        pass, whichever comes first. The first pool that passes the connection
+        test wins and the remaining attempts are cancelled. The winning
+        strategy is remembered on disk and tried first on the next startup.
+        """
+        if not self.connection_string:
+            raise Exception("POSTGRES_CONNECTION_STRING is not set")
+        strategies = self._order_by_cached_winner(await self.get_connection_strategies())
+
+        pending = {}
+        next_index = 0
+        try:
+            while next_index < len(strategies) or pending:
+                if next_index < len(strategies):
+                    strategy = strategies[next_index]
+                    next_index += 1
+                    logger.info(f"Attempting database connection (strategy {next_index}: {strategy['name']})...")
+                    pending[asyncio.create_task(self._try_strategy(strategy))] = (next_index, strategy)
+
+                timeout = DB_CONNECT_STAGGER if next_index < len(strategies) else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, strategy = pending.pop(task)
                     try:
-                        await self.pool.close()
-                    except:
-                        pass
-                    self.pool = None
-                continue
+                        pool = task.result()
+                    except Exception as e:
+                        logger.warning(f"Strategy {index} failed: {e}")
+                        continue
+                    if self.pool is None:
+                        self.pool = pool
+                        self._active_conn_str = strategy['conn_str']
+                        logger.info(f"Database connection established successfully using strategy {index} ({strategy['name']})")
+                        self._save_cached_winner(strategy['name'])
+                    else:
+                        await pool.close()
+                if self.pool is not None:
+                    return
+        finally:
+            await self._cancel_attempts(pending)
 
         raise Exception("All connection strategies failed")
 
+    async def _create_pool(self, conn_str: str) -> asyncpg.Pool:
+        """Create a connection pool with the server's standard settings"""
+        settings = self.pool_settings
+        return await asyncpg.create_pool(
+            conn_str,
+            min_size=settings["min_size"],
+            max_size=settings["max_size"],
+            command_timeout=settings["command_timeout"],
+            # asyncpg keeps an LRU of prepared statements per connection, so repeated
+            # identical SQL (e.g. cached NL->SQL answers) skips parse and plan
+            statement_cache_size=settings["statement_cache_size"],
+            max_cached_statement_lifetime=settings["max_cached_statement_lifetime"],
+            server_settings={
+                'application_name': 'llama_websocket_server',
+                'timezone': 'UTC'
+            },
+            init=self._init_connection
+        )
+
+    async def _try_strategy(self, strategy: dict) -> asyncpg.Pool:
+        """Create and test a pool for one strategy; raises if it does not work"""
+        pool = await self._create_pool(strategy['conn_str'])
+        try:
+            if await self.test_connection(pool):
+                return pool
+        except BaseException:
+            await pool.close()
+            raise
+        await pool.close()
+        raise Exception("pool created but connection test failed")
+
+    async def _cancel_attempts(self, pending: dict):
+        """Cancel losing attempts and close any pool they managed to open"""
+        for task in pending:
+            task.cancel()
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        for result in results:
+            if isinstance(result, asyncpg.Pool):
+                await result.close()
+
+    def _strategy_cache_key(self) -> str:
+        # Never store the connection string itself: it contains credentials
+        return hashlib.sha256((self.connection_string or "").encode("utf-8")).hexdigest()
+
+    def _order_by_cached_winner(self, strategies: list) -> list:
+        """Move the strategy that won last time to the front"""
+        try:
+            with open(DB_STRATEGY_CACHE_PATH) as f:
+                winner = json.load(f).get(self._strategy_cache_key())
+        except (OSError, ValueError):
+            return strategies
+        if not winner:
+            return strategies
+        return sorted(strategies, key=lambda strategy: strategy['name'] != winner)
+
+    def _save_cached_winner(self, name: str):
+        try:
+            try:
+                with open(DB_STRATEGY_CACHE_PATH) as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+            cache[self._strategy_cache_key()] = name
+            with open(DB_STRATEGY_CACHE_PATH, "w") as f:
+                json.dump(cache, f)
+        except OSError as e:
+            logger.warning(f"Could not save winning connection strategy: {e}")
+
     async def _init_connection(self, connection):
         """Initialize individual connections in the pool"""
         try:
@@ -220,7 +845,177 @@ class DatabaseManager:
         except Exception as e:
             logger.warning(f"Failed to initialize connection: {e}")
 
-    async def execute_query(self, query: str) -> Dict[str, Any]:
+    @asynccontextmanager
+    async def acquire(self):
+        """Check out a pooled connection under the adaptive limit, recording the wait"""
+        started = time.perf_counter()
+        await self.limiter.acquire()
+        self._record_pressure()
+        try:
+            async with self.pool.acquire() as connection:
+                self.acquire_wait.observe(time.perf_counter() - started)
+                yield connection
+        finally:
+            await self.limiter.release()
+
+    def _record_pressure(self):
+        self._window_waiters_peak = max(self._window_waiters_peak, self.limiter.waiters)
+        self._window_in_use_peak = max(self._window_in_use_peak, self.limiter.in_use)
+
+    def _record_query(self, elapsed: float):
+        self.query_latency.observe(elapsed)
+        self._window_queries += 1
+        self._window_query_time += elapsed
+
+    async def reconfigure_pool(self, **settings):
+        """Change pool settings at runtime, rebuilding the pool if it is running"""
+        unknown = set(settings) - set(self.pool_settings)
+        if unknown:
+            raise ValueError(f"Unknown pool settings: {', '.join(sorted(unknown))}")
+        new_settings = {**self.pool_settings, **settings}
+        if not 0 <= new_settings["min_size"] <= new_settings["max_size"] or new_settings["max_size"] < 1:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
+        self.pool_settings = new_settings
+        await self.limiter.set_limit(min(max(self.limiter.limit, new_settings["min_size"], 1), new_settings["max_size"]))
+
+        if self.pool is None or not self._active_conn_str:
+            return
+        new_pool = await self._create_pool(self._active_conn_str)
+        old_pool, self.pool = self.pool, new_pool
+        logger.info(f"Database pool rebuilt with settings {new_settings}")
+        # Let in-flight queries finish on the old pool before it closes
+        asyncio.create_task(old_pool.close())
+
+    async def adapt_pool_size(self):
+        """Grow or shrink the connection limit from queueing and query latency.
+
+        Grow by one when requests queued for a connection while query latency
+        stayed near its low-load baseline (the database has headroom). Shrink by
+        one when latency degraded under load (the database is the bottleneck)
+        or when the limit sits well above peak usage.
+        """
+        while True:
+            await asyncio.sleep(DB_POOL_ADAPT_INTERVAL)
+            queries, query_time = self._window_queries, self._window_query_time
+            waiters_peak, in_use_peak = self._window_waiters_peak, self._window_in_use_peak
+            self._window_queries = 0
+            self._window_query_time = 0.0
+            self._window_waiters_peak = self.limiter.waiters
+            self._window_in_use_peak = self.limiter.in_use
+            if self.pool is None or not queries:
+                continue
+
+            mean_latency = query_time / queries
+            if waiters_peak == 0 and in_use_peak <= 1:
+                # Low load: track what an uncontended query costs
+                baseline = self._baseline_query_latency
+                self._baseline_query_latency = mean_latency if baseline is None else 0.8 * baseline + 0.2 * mean_latency
+            baseline = self._baseline_query_latency or mean_latency
+
+            limit = self.limiter.limit
+            floor = max(1, self.pool_settings["min_size"])
+            ceiling = self.pool_settings["max_size"]
+            if waiters_peak > 0 and mean_latency <= 1.5 * baseline and limit < ceiling:
+                new_limit = limit + 1
+            elif waiters_peak > 0 and mean_latency > 2 * baseline and limit > floor:
+                new_limit = limit - 1
+            elif waiters_peak == 0 and in_use_peak < limit - 1 and limit > floor:
+                new_limit = limit - 1
+            else:
+                continue
+            logger.info(f"Adjusting database concurrency limit {limit} -> {new_limit} "
+                        f"(waiters peak {waiters_peak}, mean latency {mean_latency:.3f}s, baseline {baseline:.3f}s)")
+            await self.limiter.set_limit(new_limit)
+
+    async def explain_query(self, query: str, statement_timeout_ms: Optional[int] = None) -> Dict[str, Any]:
+        """Return the planner's top-level estimates for a query (EXPLAIN without ANALYZE)
+        and the "schema.table" names of the relations its plan touches"""
+        async with self.acquire() as connection:
+            async with connection.transaction(readonly=True):
+                if statement_timeout_ms:
+                    await connection.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+                raw_plan = await connection.fetchval(f"EXPLAIN (FORMAT JSON, VERBOSE) {query}")
+        plan = (json.loads(raw_plan) if isinstance(raw_plan, str) else raw_plan)[0]["Plan"]
+        relations = set()
+        writes = False
+        nodes = [plan]
+        while nodes:
+            node = nodes.pop()
+            if "Relation Name" in node:
+                relations.add(f"{node.get('Schema', 'public')}.{node['Relation Name']}")
+            writes = writes or node.get("Node Type") == "ModifyTable"
+            nodes.extend(node.get("Plans", ()))
+        return {
+            "cost": plan.get("Total Cost", 0.0),
+            "rows": plan.get("Plan Rows", 0),
+            "relations": sorted(relations),
+            "writes": writes
+        }
+
+    async def write_watermark(self) -> str:
+        """The current transaction snapshot. It stays the same until a transaction that writes
+        starts or finishes, so an unchanged watermark means no change has been committed since"""
+        async with self.acquire() as connection:
+            return await connection.fetchval("SELECT pg_current_snapshot()::text")
+
+    async def connect_dedicated(self) -> asyncpg.Connection:
+        """A connection outside the pool (for LISTEN), using the strategy that opened the pool"""
+        return await asyncpg.connect(
+            self._active_conn_str or self.connection_string,
+            server_settings={'application_name': 'llama_websocket_server'}
+        )
+
+    async def check_query(self, query: str, limits: Dict[str, Any]) -> Dict[str, Any]:
+        """Vet a generated query before it runs.
+
+        Rejects multi-statement input and anything other than reads (unless
+        SQL_ALLOW_WRITES), then asks the planner for estimates. Data-modifying
+        CTEs, SELECT INTO and plans with a ModifyTable node count as writes. A
+        read whose estimated row count exceeds ``max_rows`` is wrapped in a
+        LIMIT; a query whose estimated cost exceeds ``max_cost`` (after any
+        rewrite) is rejected. Raises QueryRejected, or asyncpg errors for
+        invalid SQL.
+        """
+        statement, keyword = classify_sql(query)
+        is_read = keyword in READ_STATEMENTS
+        checked = {
+            "query": statement,
+            "is_read": is_read,
+            "read_only": is_read and SQL_READ_ONLY,
+            "rewritten": False,
+            "estimated_cost": None,
+            "estimated_rows": None,
+            "relations": None
+        }
+        if not SQL_COST_GATE:
+            return checked
+
+        estimate = await self.explain_query(statement, limits.get("statement_timeout_ms"))
+        if is_read and estimate["writes"]:
+            # The plan modifies a table the keyword scan did not catch
+            if not SQL_ALLOW_WRITES:
+                raise QueryRejected("Data-modifying statements are disabled on this server (read-only mode)")
+            is_read = False
+            checked.update(is_read=False, read_only=False)
+        checked["estimated_cost"] = estimate["cost"]
+        checked["estimated_rows"] = estimate["rows"]
+        checked["relations"] = estimate["relations"]
+        max_rows = limits.get("max_rows")
+        if is_read and max_rows and estimate["rows"] > max_rows:
+            # Wrapped rather than appended, so a statement with its own LIMIT, OFFSET or FETCH still parses
+            limited = f"SELECT * FROM (\n{statement.rstrip().rstrip(';')}\n) AS limited LIMIT {int(max_rows)}"
+            estimate = await self.explain_query(limited, limits.get("statement_timeout_ms"))
+            checked.update(query=limited, rewritten=True, estimated_cost=estimate["cost"])
+        max_cost = limits.get("max_cost")
+        if max_cost and estimate["cost"] > max_cost:
+            raise QueryRejected(
+                f"Estimated query cost {estimate['cost']:.0f} exceeds this domain's budget of {max_cost:.0f}. "
+                "Try a more selective question."
+            )
+        return checked
+
+    async def execute_query(self, query: str, statement_timeout_ms: Optional[int] = None,
+                            read_only: bool = False) -> Dict[str, Any]:
         """Execute a database query"""
         if not self.pool:
             return {
@@ -230,22 +1025,31 @@ class DatabaseManager:
             }
 
         try:
-            async with self.pool.acquire() as connection:
+            async with self.acquire() as connection, connection.transaction(readonly=read_only):
                 query = query.strip()
+                if statement_timeout_ms:
+                    await connection.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+                started = time.perf_counter()
                 
                 # Handle SELECT queries
-                if query.upper().startswith(('SELECT', 'WITH')):
+                if query.upper().startswith(READ_STATEMENTS):
                     rows = await connection.fetch(query)
-                    result_data = [dict(row) for row in rows]
+                    self._record_query(time.perf_counter() - started)
+                    # Records are shaped into dicts or value arrays by the connection's FrameCodec
                     return {
                         "success": True,
-                        "data": result_data,
-                        "row_count": len(result_data),
+                        "columns": list(rows[0].keys()) if rows else [],
+                        "data": rows,
+                        "row_count": len(rows),
                         "error": None
                     }
                 # Handle modification queries  
                 else:
-                    result = await connection.execute(query)
+                    # Prepared rather than sent as a simple query, which would run every command in the string
+                    statement = await connection.prepare(query)
+                    await statement.fetch()
+                    result = statement.get_statusmsg()
+                    self._record_query(time.perf_counter() - started)
                     return {
                         "success": True,
                         "data": None,
@@ -253,7 +1057,12 @@ class DatabaseManager:
                         "error": None
                     }
                     
-        except asyncpg.PostgresError as e:
+        except Exception as e:
+            return self.error_result(e)
+
+    def error_result(self, e: Exception) -> Dict[str, Any]:
+        """Turn a query failure into a result payload with a user-friendly message"""
+        if isinstance(e, asyncpg.PostgresError):
             logger.error(f"PostgreSQL error: {e}")
             error_message = f"Database Error: {str(e)}"
             
@@ -272,22 +1081,62 @@ class DatabaseManager:
                 "error": error_message,
                 "data": None
             }
-        except Exception as e:
-            logger.error(f"Database query error: {e}")
-            return {
-                "success": False,
-                "error": f"❌ Database connection error: {str(e)}. Please verify your PostgreSQL connection string.",
-                "data": None
-            }
+        logger.error(f"Database query error: {e}")
+        return {
+            "success": False,
+            "error": f"❌ Database connection error: {str(e)}. Please verify your PostgreSQL connection string.",
+            "data": None
+        }
+
+    async def open_cursor(self, query: str, statement_timeout_ms: Optional[int] = None,
+                          read_only: bool = False) -> "ResultCursor":
+        """Open a server-side cursor for a SELECT inside a transaction on a dedicated connection"""
+        if not self.pool:
+            raise RuntimeError("Database connection not available")
+        pool = self.pool
+        started = time.perf_counter()
+        await self.limiter.acquire()
+        self._record_pressure()
+        try:
+            connection = await pool.acquire()
+        except BaseException:
+            await self.limiter.release()
+            raise
+        self.acquire_wait.observe(time.perf_counter() - started)
+
+        async def release():
+            try:
+                await pool.release(connection)
+            finally:
+                await self.limiter.release()
+
+        transaction = connection.transaction(readonly=read_only)
+        try:
+            started = time.perf_counter()
+            await transaction.start()
+            if statement_timeout_ms:
+                await connection.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+            cursor = await connection.cursor(query.strip())
+            self._record_query(time.perf_counter() - started)
+        except BaseException:
+            try:
+                await transaction.rollback()
+            except Exception:
+                pass
+            finally:
+                await release()
+            raise
+        return ResultCursor(query, release, connection, transaction, cursor)
 
-    async def test_connection(self) -> bool:
+    async def test_connection(self, pool: Optional[asyncpg.Pool] = None) -> bool:
         """Test database connection"""
+        pool = pool or self.pool
         try:
-            if not self.pool:
+            if not pool:
                 return False
                 
             async with asyncio.timeout(10):  # 10 second timeout
-                async with self.pool.acquire() as connection:
+                async with pool.acquire() as connection:
                     result = await connection.fetchval("SELECT 1")
                     return result == 1
                     
@@ -308,11 +1157,20 @@ class DatabaseManager:
             "size": self.pool.get_size(),
             "min_size": self.pool.get_min_size(),
             "max_size": self.pool.get_max_size(),
-            "idle_size": self.pool.get_idle_size()
+            "idle_size": self.pool.get_idle_size(),
+            "concurrency_limit": self.limiter.limit,
+            "in_use": self.limiter.in_use,
+            "waiters": self.limiter.waiters,
+            "settings": dict(self.pool_settings),
+            "acquire_wait": self.acquire_wait.snapshot(),
+            "query_latency": self.query_latency.snapshot()
         }
 
     async def close_pool(self):
         """Close the database connection pool"""
+        if self.is_initializing:
+            self._init_task.cancel()
+            await asyncio.gather(self._init_task, return_exceptions=True)
         if self.pool:
             try:
                 await self.pool.close()
@@ -322,226 +1180,3015 @@ class DatabaseManager:
             finally:
                 self.pool = None
 
-# Initialize database manager
-db_manager = DatabaseManager(POSTGRES_CONNECTION_STRING)
+class ResultCursor:
+    """A server-side cursor that pages through a query result.
 
-def extract_sql_from_response(response: str) -> Optional[str]:
-    """Extract SQL query from LLM response"""
-    # Try different patterns to extract SQL
-    patterns = [
-        r'<final_sql_query_start>(.*?)<final_sql_query_end>',
-        r'```sql\n(.*?)\n```',
-        r'```\n((?:SELECT|INSERT|UPDATE|DELETE|WITH|CREATE|ALTER|DROP).*?)\n```',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, response, re.DOTALL | re.IGNORECASE)
-        if match:
-            return match.group(1).strip()
-    
-    # Fallback: look for SQL keywords at line start
-    lines = response.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line and line.upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'CREATE', 'ALTER', 'DROP')):
-            return line
+    Holds its pooled connection and transaction until the result is exhausted,
+    closed explicitly, or left idle past ``QUERY_CURSOR_IDLE_TIMEOUT``.
+    """
 
-    return None
+    def __init__(self, query: str, release, connection, transaction, cursor):
+        self.cursor_id = hashlib.sha1(f"{id(self)}-{time.time()}".encode()).hexdigest()[:12]
+        self.query = query
+        self._release = release
+        self.connection = connection
+        self.transaction = transaction
+        self.cursor = cursor
+        self.columns: Optional[list] = None
+        self.rows_sent = 0
+        self.pages_sent = 0
+        self.exhausted = False
+        self.closed = False
+        self.last_used = time.time()
+
+    async def fetch_page(self, page_size: int) -> list:
+        """Fetch up to ``page_size`` records"""
+        self.last_used = time.time()
+        records = await self.cursor.fetch(page_size)
+        if len(records) < page_size:
+            self.exhausted = True
+        if records and self.columns is None:
+            self.columns = list(records[0].keys())
+        return records
 
-async def load_model():
-    """Load the LLM model"""
-    global llm, last_activity
-    if llm is None:
-        logger.info("Loading model into memory...")
+    async def close(self):
+        """End the cursor's transaction and return the connection to the pool"""
+        if self.closed:
+            return
+        self.closed = True
         try:
-            llm = Llama.from_pretrained(
-                repo_id=model_repo,
-                filename=model_file
-            )
-            last_activity = asyncio.get_event_loop().time()
-            logger.info("Model loaded and ready for inference.")
+            # Read-only work, so there is nothing to commit
+            await self.transaction.rollback()
         except Exception as e:
-            logger.error(f"Failed to load model: {e}")
-            raise
-    else:
-        logger.info("Model already loaded.")
+            logger.warning(f"Error closing result cursor: {e}")
+        finally:
+            await self._release()
 
-async def unload_model():
-    """Unload the LLM model to free memory"""
-    global llm
-    if llm is not None:
-        logger.info("Unloading model to free memory...")
-        del llm
-        llm = None
-        gc.collect()
-        logger.info("Model unloaded.")
+# Initialize database manager
+db_manager = DatabaseManager(POSTGRES_CONNECTION_STRING)
 
-async def monitor_idle_time():
-    """Monitor and unload model after idle timeout"""
-    global last_activity
-    while True:
-        await asyncio.sleep(60)
-        if llm and last_activity and (asyncio.get_event_loop().time() - last_activity) > IDLE_TIMEOUT:
-            await unload_model()
+READ_STATEMENTS = ('SELECT', 'WITH', 'VALUES', 'TABLE')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'MERGE')
 
-async def handle_connection(websocket):
-    """Handle WebSocket connections"""
-    global last_activity
-    user_id = None
+class QueryRejected(Exception):
+    """Raised when a generated query is not allowed to run"""
+
+def split_sql_statements(query: str) -> list:
+    """Split SQL on top-level semicolons, dropping comments and empty statements"""
+    statements = []
+    current = []
+    i = 0
+    length = len(query)
+    while i < length:
+        char = query[i]
+        if char == '-' and query.startswith('--', i):
+            end = query.find('\n', i)
+            i = length if end == -1 else end
+            continue
+        if char == '/' and query.startswith('/*', i):
+            end = query.find('*/', i + 2)
+            i = length if end == -1 else end + 2
+            current.append(' ')
+            continue
+        if char in ("'", '"'):
+            # In an E'...' escape string a backslash escapes the next character, quotes included
+            escapes = (char == "'" and i > 0 and query[i - 1] in 'eE'
+                       and (i == 1 or not (query[i - 2].isalnum() or query[i - 2] in '_$')))
+            end = i + 1
+            while end < length:
+                if escapes and query[end] == '\\':
+                    end += 2
+                    continue
+                if query[end] == char:
+                    if end + 1 < length and query[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            current.append(query[i:end + 1])
+            i = end + 1
+            continue
+        if char == '$':
+            match = re.match(r'\$[A-Za-z_]*\$', query[i:])
+            if match:
+                tag = match.group(0)
+                end = query.find(tag, i + len(tag))
+                end = length if end == -1 else end + len(tag)
+                current.append(query[i:end])
+                i = end
+                continue
+        if char == ';':
+            statement = ''.join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    statement = ''.join(current).strip()
+    if statement:
+        statements.append(statement)
+    return statements
+
+# Quoted strings and identifiers (skipped), bare words and parentheses
+_SQL_WORD_RE = re.compile(
+    r"[eE]'(?:[^'\\]|''|\\.)*'|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|(\$[A-Za-z_]*\$).*?\1|([A-Za-z_][A-Za-z0-9_$]*)|([()])",
+    re.DOTALL
+)
+# Words after which INSERT/UPDATE/DELETE name a lock strength or a foreign key action
+_SQL_NON_DML_PREFIXES = ('FOR', 'KEY', 'ON')
+
+def data_modifying_keyword(statement: str) -> Optional[str]:
+    """The write hidden in a statement that starts like a read: the DML keyword of a
+    data-modifying CTE, or "SELECT INTO" for a top-level INTO that creates a table"""
+    depth = 0
+    previous = None
+    for match in _SQL_WORD_RE.finditer(statement):
+        _, word, paren = match.groups()
+        if paren:
+            depth += 1 if paren == '(' else -1
+            continue
+        if not word:
+            continue
+        word = word.upper()
+        if word in WRITE_STATEMENTS and previous not in _SQL_NON_DML_PREFIXES:
+            return word
+        if word == 'INTO' and depth == 0:
+            return 'SELECT INTO'
+        previous = word
+    return None
+
+def classify_sql(query: str) -> tuple:
+    """Return (single statement, leading keyword) or raise QueryRejected. A read that
+    writes (a data-modifying CTE, SELECT INTO) is classified by its write keyword"""
+    statements = split_sql_statements(query)
+    if not statements:
+        raise QueryRejected("No SQL statement found")
+    if len(statements) > 1:
+        raise QueryRejected("Only a single SQL statement can be executed at a time")
+    statement = statements[0]
+    keyword = statement.split(None, 1)[0].upper().lstrip('(')
+    if keyword in READ_STATEMENTS:
+        keyword = data_modifying_keyword(statement) or keyword
+    if keyword in READ_STATEMENTS:
+        return statement, keyword
+    if keyword in WRITE_STATEMENTS or keyword == 'SELECT INTO':
+        if not SQL_ALLOW_WRITES:
+            raise QueryRejected(f"{keyword} statements are disabled on this server (read-only mode)")
+        return statement, keyword
+    raise QueryRejected(f"{keyword} statements are not allowed")
 
+def is_read_statement(query: str) -> bool:
+    """Whether classify_sql accepts a query as a single read"""
     try:
-        # Load model for local chat
-        await load_model()
-        await websocket.send(json.dumps({"type": "status", "content": "Model loaded and ready for inference."}))
+        return classify_sql(query)[1] in READ_STATEMENTS
+    except QueryRejected:
+        return False
 
-        # Initialize database if not already done
-        if db_manager.pool is None:
+def query_limits_for(domain: Optional[str]) -> Dict[str, Any]:
+    """Resolve the execution budget for a domain"""
+    limits = dict(DEFAULT_QUERY_LIMITS)
+    limits.update(SQL_QUERY_LIMITS.get("default", {}))
+    if domain:
+        limits.update(SQL_QUERY_LIMITS.get(domain, {}))
+    return limits
+
+_SQL_TOKEN_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\s+|[^'\"\s]+|['\"]")
+# Functions whose value changes between calls; queries using them are never cached
+_VOLATILE_SQL_RE = re.compile(
+    r"\b(?:now|random|clock_timestamp|statement_timestamp|transaction_timestamp|timeofday|current_date|"
+    r"current_time|current_timestamp|localtime|localtimestamp|nextval|currval|lastval|setval|"
+    r"gen_random_uuid|uuid_generate_\w+|txid_\w+|pg_\w+)\b",
+    re.IGNORECASE
+)
+
+def normalize_sql(query: str) -> str:
+    """Canonical text of a statement for cache keys: whitespace collapsed, unquoted words
+    lowercased, string literals and quoted identifiers untouched"""
+    query = query.strip().rstrip(";").strip()
+    if "$" in query or "\\" in query:
+        # Dollar quoting and escape strings are not tokenized; only exact repeats match
+        return query
+    parts = []
+    for token in _SQL_TOKEN_RE.findall(query):
+        if token[0].isspace():
+            parts.append(" ")
+        elif token[0] in "'\"":
+            parts.append(token)
+        else:
+            parts.append(token.lower())
+    return "".join(parts)
+
+def _quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+class _SqlCacheEntry:
+    """A cached result with the tables it was read from"""
+
+    __slots__ = ("query", "columns", "rows", "size", "tables", "watermark", "created_at")
+
+    def __init__(self, query: str, columns: list, rows: list, size: int, tables: tuple,
+                 watermark: Optional[str], created_at: float):
+        self.query = query
+        self.columns = columns
+        self.rows = rows
+        self.size = size
+        self.tables = tables
+        self.watermark = watermark
+        self.created_at = created_at
+
+class SqlResultCache:
+    """Results of generated reads, keyed on normalized SQL and the domain's limits.
+
+    Each entry records the tables its plan reads. NOTIFYs on ``channel``
+    (from triggers, other workers or any writer) and this server's writes
+    drop the entries reading a changed table. Without ``triggers`` a hit is
+    also checked against the database's write watermark taken before the
+    query ran, so a write the cache was not told about is never missed.
+    With ``triggers``, statement triggers that NOTIFY are installed on each
+    table before its first result is cached, and nothing is served while
+    the LISTEN connection is down.
+    Entries are evicted least recently used beyond ``max_entries`` or
+    ``max_bytes`` (sent frame size) and expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, database: DatabaseManager, max_entries: int, max_bytes: int, ttl: float,
+                 triggers: bool, channel: str):
+        self.db = database
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.triggers = triggers
+        self.channel = channel
+        self._entries: "OrderedDict[str, _SqlCacheEntry]" = OrderedDict()
+        self._by_table: Dict[str, set] = {}
+        # Bumped on every invalidation so a result read before a change is not stored after it
+        self._versions: Dict[str, int] = {}
+        self._epoch = 0
+        self._watched = set()
+        self._unwatchable = set()
+        self.listening = False
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def cacheable(query: str) -> bool:
+        return not _VOLATILE_SQL_RE.search(query)
+
+    @staticmethod
+    def key_for(query: str, limits: Dict[str, Any]) -> str:
+        return normalize_sql(query) + "\x00" + json.dumps(limits, sort_keys=True)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        for table in entry.tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    async def get(self, key: str) -> Optional[_SqlCacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl > 0 and time.time() - entry.created_at > self.ttl:
+            self._drop(key)
+            entry = None
+        if entry is None or (self.triggers and not self.listening):
+            self.misses += 1
+            return None
+        if not self.triggers:
             try:
-                await db_manager.initialize_pool()
-                pool_status = await db_manager.get_pool_status()
-                await websocket.send(json.dumps({
-                    "type": "status",
-                    "content": f"Database connection established successfully. Pool status: {pool_status['status']}"
-                }))
+                watermark = await self.db.write_watermark()
             except Exception as e:
-                logger.warning(f"Database initialization failed: {e}")
-                await websocket.send(json.dumps({
-                    "type": "warning", 
-                    "content": f"Database connection failed: {str(e)}. Server will continue without database functionality."
-                }))
+                logger.warning(f"Could not check the write watermark for a cached result: {e}")
+                self.misses += 1
+                return None
+            if watermark != entry.watermark:
+                self._drop(key)
+                self.stale += 1
+                return None
+        if self._entries.get(key) is not entry:
+            # Invalidated while the watermark was read
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
 
-        # Handle messages
-        async for message in websocket:
+    async def begin(self, tables: Optional[list]) -> Optional[tuple]:
+        """State to hand to put() for a query about to run on ``tables``; None when its
+        result cannot be cached"""
+        if tables is None:
+            return None
+        tables = tuple(tables)
+        if self.triggers:
+            if not self.listening or not await self._watch(tables):
+                return None
+            watermark = None
+        else:
             try:
-                data = json.loads(message)
-                
-                if "user_id" in data:
-                    user_id = data["user_id"]
+                watermark = await self.db.write_watermark()
+            except Exception as e:
+                logger.warning(f"Could not read the write watermark: {e}")
+                return None
+        versions = tuple(self._versions.get(table, 0) for table in tables)
+        return self._epoch, tables, versions, watermark
 
-                if data.get("action") == "stop_generation":
-                    if user_id:
-                        stop_generation[user_id] = True
-                        await websocket.send(json.dumps({
-                            "type": "status",
-                            "content": "Generation stopped by user request"
-                        }))
-                    continue
+    def put(self, key: str, token: Optional[tuple], query: str, columns: list, rows: list, size: int):
+        if token is None or size > self.max_bytes:
+            return
+        epoch, tables, versions, watermark = token
+        if epoch != self._epoch or versions != tuple(self._versions.get(table, 0) for table in tables):
+            return
+        self._drop(key)
+        self._entries[key] = _SqlCacheEntry(query, columns, rows, size, tables, watermark, time.time())
+        self.bytes += size
+        for table in tables:
+            self._by_table.setdefault(table, set()).add(key)
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            self._drop(next(iter(self._entries)))
 
-                if "messages" in data:
-                    await handle_chat_request(websocket, data, user_id)
-                    
-            except json.JSONDecodeError as e:
-                await websocket.send(json.dumps({
-                    "type": "error",
-                    "content": f"Invalid JSON: {str(e)}"
-                }))
-            except Exception as e:
-                logger.error(f"Error handling message: {e}")
-                await websocket.send(json.dumps({
-                    "type": "error", 
-                    "content": f"Error processing message: {str(e)}"
-                }))
+    def invalidate(self, tables: Optional[list] = None):
+        """Drop the entries reading any of ``tables``, or everything"""
+        if tables is None:
+            self._epoch += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._by_table.clear()
+            self.bytes = 0
+            return
+        for table in tables:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            for key in list(self._by_table.get(table, ())):
+                self._drop(key)
+                self.invalidations += 1
 
-    except websockets.exceptions.ConnectionClosedOK:
-        logger.info("Client disconnected normally.")
-    except Exception as e:
-        logger.error(f"Connection error: {e}")
+    async def publish(self, tables: Optional[list]):
+        """Invalidate after a write run here, and tell the other workers"""
+        self.invalidate(tables)
         try:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "content": f"Connection error: {str(e)}"
-            }))
-        except:
-            pass
-    finally:
-        if user_id:
-            stop_generation.pop(user_id, None)
-            active_generations.pop(user_id, None)
+            async with self.db.acquire() as connection:
+                for table in tables if tables is not None else ["*"]:
+                    await connection.execute("SELECT pg_notify($1, $2)", self.channel, table)
+        except Exception as e:
+            logger.warning(f"Could not publish table changes: {e}")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.invalidate(None if payload in ("", "*") else [payload])
+
+    async def _watch(self, tables: tuple) -> bool:
+        """Make sure every table has the NOTIFY trigger"""
+        missing = [table for table in tables if table not in self._watched]
+        if any(table in self._unwatchable for table in missing):
+            return False
+        for table in missing:
+            schema, name = table.split(".", 1)
+            try:
+                async with self.db.acquire() as connection, connection.transaction():
+                    if not await connection.fetchval("SELECT 1 FROM pg_proc WHERE proname = 'edgequery_notify_change'"):
+                        await connection.execute(
+                            "CREATE FUNCTION edgequery_notify_change() RETURNS trigger LANGUAGE plpgsql AS $$ "
+                            "BEGIN PERFORM pg_notify(TG_ARGV[0], TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME); "
+                            "RETURN NULL; END $$"
+                        )
+                    exists = await connection.fetchval(
+                        "SELECT 1 FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid "
+                        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                        "WHERE n.nspname = $1 AND c.relname = $2 AND t.tgname = 'edgequery_notify_change'",
+                        schema, name
+                    )
+                    if not exists:
+                        channel = "'" + self.channel.replace("'", "''") + "'"
+                        await connection.execute(
+                            f"CREATE TRIGGER edgequery_notify_change "
+                            f"AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {_quote_ident(schema)}.{_quote_ident(name)} "
+                            f"FOR EACH STATEMENT EXECUTE FUNCTION edgequery_notify_change({channel})"
+                        )
+            except (asyncpg.InsufficientPrivilegeError, asyncpg.WrongObjectTypeError) as e:
+                # No TRIGGER privilege, or a catalog or foreign table; results reading it are not cached
+                logger.warning(f"Cannot install the change trigger on {table}: {e}")
+                self._unwatchable.add(table)
+                return False
+            except Exception as e:
+                logger.warning(f"Could not install the change trigger on {table}: {e}")
+                return False
+            self._watched.add(table)
+        return True
+
+    async def listen(self):
+        """Keep a dedicated connection LISTENing for table changes"""
+        delay = DB_RECONNECT_INITIAL_DELAY
+        while True:
+            if not await self.db.wait_for_pool(DB_READY_TIMEOUT):
+                await asyncio.sleep(delay)
+                continue
+            connection = None
+            try:
+                connection = await self.db.connect_dedicated()
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _connection: closed.set())
+                await connection.add_listener(self.channel, self._on_notify)
+                # Changes made while nobody was listening are unknown
+                self.invalidate()
+                self.listening = True
+                delay = DB_RECONNECT_INITIAL_DELAY
+                logger.info(f"SQL result cache listening for table changes on '{self.channel}'")
+                while not closed.is_set():
+                    try:
+                        await asyncio.wait_for(closed.wait(), DB_HEALTH_CHECK_INTERVAL)
+                    except asyncio.TimeoutError:
+                        await asyncio.wait_for(connection.fetchval("SELECT 1"), 10)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"SQL result cache listener lost: {e}. Retrying in {delay:g}s")
+            finally:
+                self.listening = False
+                if connection is not None and not connection.is_closed():
+                    connection.terminate()
+            self.invalidate()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_RECONNECT_MAX_DELAY)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "listening": self.listening
+        }
+
+sql_result_cache = SqlResultCache(
+    db_manager, SQL_CACHE_MAX_ENTRIES, SQL_CACHE_MAX_BYTES, SQL_CACHE_TTL, SQL_CACHE_TRIGGERS, SQL_CACHE_CHANNEL
+)
+
+_IDENTIFIER_WORD_RE = re.compile(r"[a-z]+|\d+")
+_CAMEL_BOUNDARY_RE = re.compile(r"([a-z0-9])([A-Z])")
+# Words that say nothing about which table a question is about
+_SCHEMA_STOPWORDS = frozenset(
+    "a an and are as at be by did do does each every for from give had has have how i in is it list "
+    "me my of on or per please show tell than that the their them there these this those to was were "
+    "what when where which who whose with".split()
+)
+# Long type names shortened in schema prompts
+_TYPE_ABBREVIATIONS = (
+    ("CHARACTER VARYING", "VARCHAR"),
+    ("TIMESTAMP WITHOUT TIME ZONE", "TIMESTAMP"),
+    ("TIMESTAMP WITH TIME ZONE", "TIMESTAMPTZ"),
+    ("TIME WITHOUT TIME ZONE", "TIME"),
+    ("CHARACTER", "CHAR"),
+)
+
+def schema_terms(text: str) -> list:
+    """Lowercase word stems of an identifier or question (snake_case and camelCase split)"""
+    terms = []
+    for word in _IDENTIFIER_WORD_RE.findall(_CAMEL_BOUNDARY_RE.sub(r"\1 \2", text or "").lower()):
+        if word in _SCHEMA_STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 4 and word.endswith(("sses", "xes", "ches", "shes")):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+class _TableSchema:
+    """One introspected table or view"""
+
+    __slots__ = ("name", "comment", "columns", "primary_key", "foreign_keys", "terms", "length")
+
+    def __init__(self, name: str, comment: Optional[str]):
+        self.name = name
+        self.comment = comment
+        self.columns = []  # (name, type, comment)
+        self.primary_key = ()
+        self.foreign_keys = []  # (columns, referenced table, referenced columns)
+        self.terms: Dict[str, float] = {}
+        self.length = 0.0
+
+    def index(self):
+        """Weighted term frequencies: table name words count most, comments least"""
+        weighted = [(self.name.rsplit(".", 1)[-1], 3.0), (self.comment, 0.5)]
+        for column, _type, comment in self.columns:
+            weighted.append((column, 1.0))
+            weighted.append((comment, 0.5))
+        for text, weight in weighted:
+            for term in schema_terms(text):
+                self.terms[term] = self.terms.get(term, 0.0) + weight
+        self.length = sum(self.terms.values())
+
+class DatabaseSchema:
+    """Introspected tables of a set of Postgres schemas with a BM25 index over their names,
+    column names and comments. ``fingerprint`` changes whenever any definition does."""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, schemas: tuple, tables: list, loaded_at: float):
+        self.schemas = schemas
+        self.tables = tables
+        self.loaded_at = loaded_at
+        self.by_name = {table.name: table for table in tables}
+        canonical = [(t.name, t.columns, t.primary_key, t.foreign_keys) for t in tables]
+        self.fingerprint = hashlib.sha256(json.dumps(canonical, default=str).encode("utf-8")).hexdigest()[:16]
+        self.document_frequency: Dict[str, int] = {}
+        for table in tables:
+            table.index()
+            for term in table.terms:
+                self.document_frequency[term] = self.document_frequency.get(term, 0) + 1
+        self.average_length = sum(t.length for t in tables) / len(tables) if tables else 1.0
+
+    def _query_terms(self, question: str) -> Dict[str, float]:
+        """Question terms with their weight, adding vocabulary terms that share a prefix at half weight"""
+        weights = {}
+        for term in schema_terms(question):
+            weights[term] = 1.0
+            if len(term) < 4:
+                continue
+            for known in self.document_frequency:
+                if known != term and len(known) >= 4 and (known.startswith(term) or term.startswith(known)):
+                    weights[known] = max(weights.get(known, 0.0), 0.5)
+        return weights
+
+    def rank(self, question: str) -> list:
+        """(score, table) for the tables sharing a term with the question, best first"""
+        weights = self._query_terms(question)
+        count = len(self.tables)
+        ranked = []
+        for table in self.tables:
+            score = 0.0
+            for term, weight in weights.items():
+                frequency = table.terms.get(term)
+                if not frequency:
+                    continue
+                df = self.document_frequency[term]
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                norm = frequency + self.K1 * (1 - self.B + self.B * table.length / self.average_length)
+                score += weight * idf * frequency * (self.K1 + 1) / norm
+            if score > 0:
+                ranked.append((score, table))
+        ranked.sort(key=lambda item: -item[0])
+        return ranked
+
+    def select(self, question: str, max_tables: int) -> list:
+        """The tables to describe for a question: the best matches, plus tables that join two of
+        them. When nothing matches, every table"""
+        ranked = self.rank(question)
+        if not ranked:
+            return list(self.tables)
+        best = ranked[0][0]
+        # Drop weak matches that only share a common word with the question
+        chosen = [table for score, table in ranked if score >= best * 0.2][:max_tables]
+        names = {table.name for table in chosen}
+        for table in self.tables:
+            if len(chosen) >= max_tables or table.name in names:
+                continue
+            linked = {reference for _columns, reference, _ref in table.foreign_keys if reference in names}
+            linked |= {t.name for t in chosen if any(ref == table.name for _c, ref, _r in t.foreign_keys)}
+            if len(linked) >= 2:
+                chosen.append(table)
+                names.add(table.name)
+        return chosen
+
+    def prompt(self, tables: list, question: str, max_columns: int) -> str:
+        """Compact JSON in the shape of the client's schema blocks"""
+        wanted = set(self._query_terms(question))
+        described = {}
+        for table in tables:
+            columns = table.columns
+            if len(columns) > max_columns:
+                keys = set(table.primary_key)
+                for fk_columns, _reference, _ref_columns in table.foreign_keys:
+                    keys.update(fk_columns)
+                relevant = {name for name, _type, _comment in columns if keys.__contains__(name)
+                            or wanted.intersection(schema_terms(name))}
+                kept = [c for c in columns if c[0] in relevant][:max_columns]
+                kept += [c for c in columns if c[0] not in relevant][:max_columns - len(kept)]
+                order = {c[0]: i for i, c in enumerate(columns)}
+                columns = sorted(kept, key=lambda c: order[c[0]])
+            entry = {"columns": [{"name": name, "type": column_type} for name, column_type, _comment in columns]}
+            if table.comment:
+                entry["description"] = table.comment
+            links = [
+                f"{', '.join(fk_columns)} -> {reference}({', '.join(ref_columns)})"
+                for fk_columns, reference, ref_columns in table.foreign_keys
+            ]
+            if links:
+                entry["foreign_keys"] = links
+            described[table.name] = entry
+        return json.dumps({"database_schema": described}, ensure_ascii=False, separators=(",", ":"))
+
+class SchemaCatalog:
+    """Database schemas introspected through the pool, cached per set of Postgres schemas.
+
+    A cached schema older than ``ttl`` is still served while a background
+    reload runs; the reload keeps the old index when the fingerprint has not
+    changed.
+    """
+
+    COLUMNS_SQL = (
+        "SELECT n.nspname AS schema, c.relname AS table, obj_description(c.oid, 'pg_class') AS table_comment, "
+        "a.attname AS column, upper(format_type(a.atttypid, a.atttypmod)) AS type, "
+        "col_description(c.oid, a.attnum) AS column_comment "
+        "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped "
+        "WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f') AND NOT c.relispartition "
+        "AND n.nspname = ANY($1::text[]) AND has_table_privilege(c.oid, 'SELECT') "
+        "ORDER BY n.nspname, c.relname, a.attnum"
+    )
+    CONSTRAINTS_SQL = (
+        "SELECT n.nspname AS schema, c.relname AS table, con.contype::text AS kind, "
+        "ARRAY(SELECT a.attname FROM unnest(con.conkey) WITH ORDINALITY k(attnum, ord) "
+        "JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum ORDER BY k.ord) AS columns, "
+        "rn.nspname AS ref_schema, rc.relname AS ref_table, "
+        "ARRAY(SELECT a.attname FROM unnest(con.confkey) WITH ORDINALITY k(attnum, ord) "
+        "JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum ORDER BY k.ord) AS ref_columns "
+        "FROM pg_constraint con JOIN pg_class c ON c.oid = con.conrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "LEFT JOIN pg_class rc ON rc.oid = con.confrelid LEFT JOIN pg_namespace rn ON rn.oid = rc.relnamespace "
+        "WHERE con.contype IN ('p', 'f') AND n.nspname = ANY($1::text[]) "
+        "ORDER BY n.nspname, c.relname, con.conname"
+    )
+
+    def __init__(self, database: DatabaseManager, ttl: float):
+        self.db = database
+        self.ttl = ttl
+        self._schemas: Dict[tuple, DatabaseSchema] = {}
+        self._reloads: Dict[tuple, asyncio.Task] = {}
+
+    @staticmethod
+    def _display_name(schema: str, table: str) -> str:
+        return table if schema == "public" else f"{schema}.{table}"
+
+    @staticmethod
+    def _type_name(type_name: str) -> str:
+        for long_name, short_name in _TYPE_ABBREVIATIONS:
+            if type_name.startswith(long_name):
+                return short_name + type_name[len(long_name):]
+        return type_name
+
+    async def _load(self, schemas: tuple) -> DatabaseSchema:
+        started = time.perf_counter()
+        async with self.db.acquire() as connection:
+            column_rows = await connection.fetch(self.COLUMNS_SQL, list(schemas))
+            constraint_rows = await connection.fetch(self.CONSTRAINTS_SQL, list(schemas))
+        tables: Dict[str, _TableSchema] = {}
+        for row in column_rows:
+            name = self._display_name(row["schema"], row["table"])
+            table = tables.get(name)
+            if table is None:
+                table = tables[name] = _TableSchema(name, row["table_comment"])
+            table.columns.append((row["column"], self._type_name(row["type"]), row["column_comment"]))
+        for row in constraint_rows:
+            table = tables.get(self._display_name(row["schema"], row["table"]))
+            if table is None:
+                continue
+            if row["kind"] == "p":
+                table.primary_key = tuple(row["columns"])
+            else:
+                reference = self._display_name(row["ref_schema"], row["ref_table"])
+                table.foreign_keys.append((tuple(row["columns"]), reference, tuple(row["ref_columns"])))
+        loaded = DatabaseSchema(schemas, list(tables.values()), time.time())
+        SCHEMA_INTROSPECTION.observe(time.perf_counter() - started)
+        return loaded
+
+    async def _reload(self, schemas: tuple):
+        try:
+            loaded = await self._load(schemas)
+        except Exception as e:
+            logger.warning(f"Could not reload the schema of {', '.join(schemas)}: {e}")
+            return
+        finally:
+            self._reloads.pop(schemas, None)
+        current = self._schemas.get(schemas)
+        if current is not None and current.fingerprint == loaded.fingerprint:
+            current.loaded_at = loaded.loaded_at
+        else:
+            self._schemas[schemas] = loaded
+            logger.info(f"Schema of {', '.join(schemas)}: {len(loaded.tables)} tables, fingerprint {loaded.fingerprint}")
+
+    async def get(self, schemas: tuple) -> DatabaseSchema:
+        """The introspected schema, loading it on first use"""
+        cached = self._schemas.get(schemas)
+        if cached is not None:
+            if self.ttl > 0 and time.time() - cached.loaded_at > self.ttl and schemas not in self._reloads:
+                self._reloads[schemas] = asyncio.create_task(self._reload(schemas))
+            return cached
+        reload = self._reloads.get(schemas)
+        if reload is None:
+            reload = self._reloads[schemas] = asyncio.create_task(self._reload(schemas))
+        await asyncio.shield(reload)
+        loaded = self._schemas.get(schemas)
+        if loaded is None:
+            raise RuntimeError(f"schema of {', '.join(schemas)} could not be introspected")
+        return loaded
+
+schema_catalog = SchemaCatalog(db_manager, SCHEMA_CACHE_TTL)
+
+def db_schemas_for(domain: Optional[str]) -> tuple:
+    """Postgres schemas searched for a domain's tables"""
+    schemas = DOMAIN_DB_SCHEMAS.get(domain or "", DOMAIN_DB_SCHEMAS.get("default", ["public"]))
+    return tuple([schemas] if isinstance(schemas, str) else schemas)
+
+_SCHEMA_SECTION_RE = re.compile(r"\n?Database Schema:.*\Z", re.DOTALL)
+
+async def apply_server_schema(messages: list, domain: Optional[str], question: str) -> tuple:
+    """Replace the schema in the system prompt with the introspected tables relevant to the
+    question. Returns the messages and a summary, or the messages unchanged and None when the
+    database schema is not available."""
+    if db_manager.pool is None:
+        SCHEMA_PROMPTS.inc(outcome="unavailable")
+        return messages, None
+    try:
+        database_schema = await schema_catalog.get(db_schemas_for(domain))
+    except Exception as e:
+        logger.warning(f"Schema introspection failed: {e}")
+        SCHEMA_PROMPTS.inc(outcome="unavailable")
+        return messages, None
+    tables = database_schema.select(question, SCHEMA_MAX_TABLES)
+    schema_text = database_schema.prompt(tables, question, SCHEMA_MAX_COLUMNS)
+    SCHEMA_PROMPTS.inc(outcome="pruned" if len(tables) < len(database_schema.tables) else "full")
+    SCHEMA_PROMPT_CHARS.observe(len(schema_text))
+
+    system_index = max((i for i, m in enumerate(messages) if m.get("role") == "system"), default=None)
+    original = messages[system_index]["content"] if system_index is not None else ""
+    system = _SCHEMA_SECTION_RE.sub("", original) + f"\nDatabase Schema: {schema_text}"
+    messages = list(messages)
+    if system_index is None:
+        messages.insert(0, {"role": "system", "content": system.lstrip("\n")})
+    else:
+        messages[system_index] = {"role": "system", "content": system}
+    return messages, {
+        "fingerprint": database_schema.fingerprint,
+        "tables": [table.name for table in tables],
+        "total_tables": len(database_schema.tables),
+        "chars": len(schema_text),
+        "client_chars": len(original) - len(_SCHEMA_SECTION_RE.sub("", original))
+    }
+
+_DOMAIN_LINE_RE = re.compile(r'^Domain:\s*(.+?)\s*$', re.MULTILINE)
+
+def extract_domain_name(messages: list) -> Optional[str]:
+    """Find the domain name the client embedded in the system prompt"""
+    for message in messages:
+        if message.get("role") == "system":
+            match = _DOMAIN_LINE_RE.search(message.get("content", ""))
+            if match:
+                return match.group(1)
+    return None
+
+SQL_KEYWORDS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'CREATE', 'ALTER', 'DROP')
+
+# Markers the fine-tuned model (or a markdown-style answer) uses around the final query
+_SQL_OPENER_RE = re.compile(r'<final_sql_query_start>|```sql\n|```\n', re.IGNORECASE)
+_SQL_TAG_CLOSER_RE = re.compile(r'<final_sql_query_end>', re.IGNORECASE)
+_SQL_FENCE_CLOSER = '\n```'
+_SQL_KEYWORD_RE = re.compile(r'(?:%s)' % '|'.join(SQL_KEYWORDS), re.IGNORECASE)
+_LONGEST_OPENER = len('<final_sql_query_start>')
+_LONGEST_KEYWORD = max(len(keyword) for keyword in SQL_KEYWORDS)
+
+class SqlStreamExtractor:
+    """Incremental extractor for the SQL in a model response.
+
+    Text is fed as it streams in and every character is scanned once: a small
+    state machine looks for block openers, then only for the matching closer,
+    carrying over just enough text to catch markers split across tokens.
+    Results, in order of preference (the same as the original regex
+    patterns): the first ``<final_sql_query_start>`` block, the first
+    ```` ```sql ```` fence, the first plain fence starting with a SQL keyword,
+    and finally a bare statement beginning at the start of a line, which may
+    span several lines and ends at the first top-level ``;`` or blank line.
+    """
+
+    _SCANNING, _IN_TAG, _IN_SQL_FENCE, _IN_FENCE = range(4)
+
+    def __init__(self):
+        self._text = ""
+        self._state = self._SCANNING
+        self._scan = 0
+        self._block_start = 0
+        self.tag_sql: Optional[str] = None
+        self.fenced_sql: Optional[str] = None
+        self.generic_fenced_sql: Optional[str] = None
+        # Bare statement fallback, collected line by line
+        self._line_start = 0
+        self._bare_lines: Optional[list] = None
+        self.bare_sql: Optional[str] = None
+        self._first_closed_reported = False
+
+    def feed(self, text: str) -> Optional[str]:
+        """Consume more response text; returns the SQL of the first closed tag/```sql block once"""
+        self._text += text
+        self._scan_blocks()
+        self._scan_lines()
+        if not self._first_closed_reported:
+            closed = self.tag_sql or self.fenced_sql
+            if closed:
+                self._first_closed_reported = True
+                return closed
+        return None
+
+    def finish(self) -> Optional[str]:
+        """Return the best SQL found once the response is complete"""
+        if self.bare_sql is None:
+            # Treat the unterminated last line as if the response ended with a newline
+            self._text += "\n"
+            self._scan_lines()
+            if self._bare_lines is not None and self.bare_sql is None:
+                self._close_bare()
+        return self.tag_sql or self.fenced_sql or self.generic_fenced_sql or self.bare_sql
+
+    def _scan_blocks(self):
+        text = self._text
+        while True:
+            if self._state == self._SCANNING:
+                match = _SQL_OPENER_RE.search(text, self._scan)
+                if match is None:
+                    # Keep a possible partial opener at the end for the next feed
+                    self._scan = max(self._scan, len(text) - _LONGEST_OPENER + 1)
+                    return
+                opener = match.group(0).lower()
+                if opener == '<final_sql_query_start>':
+                    self._state = self._IN_TAG
+                elif opener == '```sql\n':
+                    self._state = self._IN_SQL_FENCE
+                else:
+                    # A plain fence only counts when the block starts with a SQL keyword
+                    if len(text) - match.end() < _LONGEST_KEYWORD and not _SQL_KEYWORD_RE.match(text, match.end()):
+                        self._scan = match.start()
+                        return
+                    if not _SQL_KEYWORD_RE.match(text, match.end()):
+                        self._scan = match.end()
+                        continue
+                    self._state = self._IN_FENCE
+                self._block_start = self._scan = match.end()
+                continue
+
+            if self._state == self._IN_TAG:
+                match = _SQL_TAG_CLOSER_RE.search(text, self._scan)
+                end, resume = (match.start(), match.end()) if match else (-1, -1)
+                closer_length = len('<final_sql_query_end>')
+            else:
+                end = text.find(_SQL_FENCE_CLOSER, self._scan)
+                resume = end + len(_SQL_FENCE_CLOSER) if end != -1 else -1
+                closer_length = len(_SQL_FENCE_CLOSER)
+            if end == -1:
+                self._scan = max(self._scan, len(text) - closer_length + 1)
+                return
+            sql = text[self._block_start:end].strip()
+            if self._state == self._IN_TAG:
+                self.tag_sql = self.tag_sql or sql
+            elif self._state == self._IN_SQL_FENCE:
+                self.fenced_sql = self.fenced_sql or sql
+            else:
+                self.generic_fenced_sql = self.generic_fenced_sql or sql
+            self._state = self._SCANNING
+            self._scan = resume
+
+    def _scan_lines(self):
+        if self.bare_sql is not None:
+            return
+        text = self._text
+        while True:
+            newline = text.find('\n', self._line_start)
+            if newline == -1:
+                return
+            line = text[self._line_start:newline]
+            self._line_start = newline + 1
+            stripped = line.strip()
+            if self._bare_lines is None:
+                if stripped and stripped.upper().startswith(SQL_KEYWORDS):
+                    self._bare_lines = []
+                else:
+                    continue
+            if not stripped or stripped.startswith(('```', '<')):
+                self._close_bare()
+                return
+            self._bare_lines.append(line)
+            if ';' in line and len(split_sql_statements("\n".join(self._bare_lines) + "\n\x00")) > 1:
+                self._close_bare()
+                return
+
+    def _close_bare(self):
+        statements = split_sql_statements("\n".join(self._bare_lines or []))
+        self.bare_sql = statements[0] if statements else None
+        if self.bare_sql is None:
+            self._bare_lines = None
+
+def extract_sql_from_response(response: str) -> Optional[str]:
+    """Extract SQL query from LLM response"""
+    extractor = SqlStreamExtractor()
+    extractor.feed(response)
+    return extractor.finish()
+
+_SQL_TAG_OPEN = '<final_sql_query_start>'
+_SQL_TAG_CLOSE = '<final_sql_query_end>'
+_SCHEMA_JSON_RE = re.compile(r"Database Schema:\s*(\{.*\})\s*\Z", re.DOTALL)
+
+# One PostgreSQL SELECT (with joins, subqueries, set operations, CASE, casts and window
+# functions) inside the tags the rest of the pipeline extracts. Keywords are upper case.
+# {ctes}, {table} and {column} are filled in by sql_grammar.
+_SQL_GRAMMAR = r'''
+root ::= "<final_sql_query_start>\n" query ";"? "\n<final_sql_query_end>"
+query ::= {ctes}select-core (sp set-op sp select-core)* order-by? limit?
+set-op ::= "UNION" (sp "ALL")? | "INTERSECT" | "EXCEPT"
+select-core ::= "SELECT" sp ("DISTINCT" sp)? select-list (sp "FROM" sp from-list)? (sp "WHERE" sp expr)? (sp "GROUP BY" sp group-list)? (sp "HAVING" sp expr)?
+select-list ::= select-item ("," sp? select-item)*
+select-item ::= "*" | ident ".*" | expr (sp "AS" sp ident)?
+from-list ::= table-ref join* ("," sp? table-ref join*)*
+table-ref ::= table-name (sp ("AS" sp)? ident)? | "(" query ")" sp ("AS" sp)? ident
+join ::= sp (("LEFT" | "RIGHT" | "FULL") sp ("OUTER" sp)? | "INNER" sp)? "JOIN" sp table-ref sp "ON" sp expr
+group-list ::= group-item ("," sp? group-item)*
+group-item ::= expr | ident
+order-by ::= sp "ORDER BY" sp order-item ("," sp? order-item)*
+order-item ::= (expr | ident) (sp ("ASC" | "DESC"))? (sp "NULLS" sp ("FIRST" | "LAST"))?
+limit ::= sp "LIMIT" sp [0-9]+ (sp "OFFSET" sp [0-9]+)?
+expr ::= and-expr (sp "OR" sp and-expr)*
+and-expr ::= not-expr (sp "AND" sp not-expr)*
+not-expr ::= ("NOT" sp)? predicate
+predicate ::= value (sp? compare sp? value | sp "IS" sp ("NOT" sp)? "NULL" | sp ("NOT" sp)? "IN" sp? "(" (query | expr-list) ")" | sp ("NOT" sp)? "BETWEEN" sp value sp "AND" sp value | sp ("NOT" sp)? ("LIKE" | "ILIKE") sp value)?
+compare ::= "=" | "<>" | "!=" | "<=" | ">=" | "<" | ">"
+value ::= term (sp? ("+" | "-" | "*" | "/" | "%" | "||") sp? term)*
+term ::= "-"? primary ("::" type-name)?
+primary ::= number | string | "NULL" | "TRUE" | "FALSE" | "INTERVAL" sp string | case-expr | cast-expr | extract-expr | function-call | "EXISTS" sp? "(" query ")" | "(" query ")" | "(" expr ")" | column-ref
+function-call ::= ident "(" ("DISTINCT" sp)? ("*" | expr-list)? ")" (sp "FILTER" sp? "(" "WHERE" sp expr ")")? (sp "OVER" sp? "(" window ")")?
+window ::= ("PARTITION BY" sp expr-list)? (sp? "ORDER BY" sp order-item ("," sp? order-item)*)?
+case-expr ::= "CASE" (sp expr)? (sp "WHEN" sp expr sp "THEN" sp expr)+ (sp "ELSE" sp expr)? sp "END"
+cast-expr ::= "CAST(" expr sp "AS" sp type-name ")"
+extract-expr ::= "EXTRACT(" [A-Za-z]+ sp "FROM" sp expr ")"
+expr-list ::= expr ("," sp? expr)*
+column-ref ::= (ident ".")? column-name
+type-name ::= [A-Za-z_]+ ("(" [0-9, ]+ ")")? ("[]")?
+number ::= [0-9]+ ("." [0-9]+)?
+string ::= "'" ([^'] | "''")* "'"
+ident ::= [A-Za-z_] [A-Za-z0-9_]* | "\"" [^"]+ "\""
+sp ::= " " | "\n" " "*
+table-name ::= {table}
+column-name ::= {column}
+'''
+
+def _gbnf_literal(text: str) -> str:
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _identifier_spellings(name: str) -> list:
+    """How a (possibly schema-qualified) name may appear in SQL: each part bare or double-quoted"""
+    spellings = [""]
+    for part in name.split("."):
+        forms = [part, '"' + part.replace('"', '""') + '"']
+        spellings = [f"{prefix}.{form}" if prefix else form for prefix in spellings for form in forms]
+    return spellings
+
+@lru_cache(maxsize=64)
+def sql_grammar(tables: tuple = (), columns: tuple = ()) -> str:
+    """GBNF for one tagged SELECT; with tables and columns, only those names may be referenced
+    (aliases, output names and functions stay free). CTEs need free table names, so the
+    restricted grammar has no WITH."""
+    if tables and columns:
+        table_rule = " | ".join(_gbnf_literal(s) for name in tables for s in _identifier_spellings(name))
+        column_rule = " | ".join(_gbnf_literal(s) for name in columns for s in _identifier_spellings(name))
+        with_clause = ""
+    else:
+        table_rule = 'ident ("." ident)?'
+        column_rule = "ident"
+        with_clause = '("WITH" sp ident sp "AS" sp? "(" query ")" ("," sp? ident sp "AS" sp? "(" query ")")* sp)?'
+    return _SQL_GRAMMAR.format(ctes=with_clause, table=table_rule, column=column_rule).strip() + "\n"
+
+def schema_identifiers(messages: list) -> tuple:
+    """Table and column names of a JSON "Database Schema:" section in the system prompt"""
+    system = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "system"), "")
+    match = _SCHEMA_JSON_RE.search(system or "")
+    if not match:
+        return (), ()
+    try:
+        schema = json.loads(match.group(1))
+    except ValueError:
+        return (), ()
+    tables = schema.get("database_schema", schema) if isinstance(schema, dict) else None
+    if not isinstance(tables, dict):
+        return (), ()
+    columns = set()
+    for table in tables.values():
+        for column in (table.get("columns") or []) if isinstance(table, dict) else []:
+            if isinstance(column, dict) and column.get("name"):
+                columns.add(str(column["name"]))
+    return tuple(sorted(tables)), tuple(sorted(columns))
+
+class DecodingPlan:
+    """How one request is decoded: token budget, stop sequences and grammar"""
+
+    __slots__ = ("mode", "max_tokens", "stop", "grammar", "baseline_sample")
+
+    def __init__(self, mode: str, max_tokens: int, stop: Optional[list] = None, grammar: Optional[str] = None,
+                 baseline_sample: bool = False):
+        self.mode = mode
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.grammar = grammar
+        self.baseline_sample = baseline_sample
+
+    def completion_kwargs(self) -> dict:
+        kwargs = {"max_tokens": self.max_tokens, "temperature": 0}
+        if self.stop:
+            kwargs["stop"] = self.stop
+        return kwargs
+
+class UnknownDecodingModeError(Exception):
+    """Raised when a request asks for a decoding mode the server cannot run"""
+
+def plan_decoding(mode: Optional[str], messages: list, served) -> tuple:
+    """The decoding plan for a request and the messages to send (fast_sql asks for the SQL only)"""
+    mode = mode or DECODING_MODE
+    if mode not in DECODING_MODES:
+        raise UnknownDecodingModeError(f"Unknown decoding mode '{mode}' (available: {', '.join(DECODING_MODES)})")
+    max_tokens = int(DECODING_TOKEN_BUDGETS.get(mode, 2048))
+    if mode == "fast_sql":
+        if LlamaGrammar is None:
+            raise UnknownDecodingModeError("fast_sql decoding needs a llama-cpp-python build with grammar support")
+        tables, columns = schema_identifiers(messages) if DECODING_GRAMMAR_IDENTIFIERS else ((), ())
+        instruction = (f"\nAnswer with only the final SQL query between {_SQL_TAG_OPEN} and {_SQL_TAG_CLOSE}, "
+                       "without any reasoning.")
+        system_index = max((i for i, m in enumerate(messages) if m.get("role") == "system"), default=None)
+        messages = list(messages)
+        if system_index is None:
+            messages.insert(0, {"role": "system", "content": instruction.lstrip("\n")})
+        else:
+            messages[system_index] = {"role": "system", "content": messages[system_index]["content"] + instruction}
+        return DecodingPlan(mode, max_tokens, grammar=sql_grammar(tables, columns)), messages
+    if mode == "reasoning" and served.reasoning:
+        if decoding_baseline.wants_sample(served.name):
+            # Run unconstrained now and then to keep the tokens-saved estimate current
+            return DecodingPlan(mode, max_tokens, baseline_sample=True), messages
+        return DecodingPlan(mode, max_tokens, stop=[_SQL_TAG_CLOSE]), messages
+    return DecodingPlan(mode, max_tokens, baseline_sample=True), messages
+
+class DecodingBaseline:
+    """Running averages, per model, of how long unconstrained answers are and how many of their
+    tokens come after the SQL block. Tokens saved by a stop tag or the SQL grammar are
+    estimated against these."""
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self._total: Dict[str, float] = {}
+        self._tail: Dict[str, float] = {}
+
+    def _update(self, averages: dict, model: str, value: float):
+        current = averages.get(model)
+        averages[model] = value if current is None else current + self.alpha * (value - current)
+
+    def wants_sample(self, model: str) -> bool:
+        """Whether to run this request unconstrained: always until a model has an estimate"""
+        if DECODING_BASELINE_SAMPLE <= 0:
+            return False
+        return model not in self._tail or random.random() < DECODING_BASELINE_SAMPLE
+
+    def record(self, model: str, tokens: int, tail_tokens: Optional[int]):
+        self._update(self._total, model, tokens)
+        if tail_tokens is not None:
+            self._update(self._tail, model, tail_tokens)
+
+    def saved(self, model: str, plan: DecodingPlan, tokens: int, cut_at_tag: bool) -> Optional[float]:
+        if plan.grammar is not None:
+            total = self._total.get(model)
+            return max(0.0, total - tokens) if total is not None else None
+        if cut_at_tag:
+            return self._tail.get(model)
+        return 0.0
+
+    def expected(self, model: str, plan: DecodingPlan) -> Optional[float]:
+        """Estimated length of a complete answer under ``plan``"""
+        total = self._total.get(model)
+        if total is None or plan.grammar is not None:
+            return None
+        return total - self._tail.get(model, 0.0) if plan.stop else total
+
+    def stats(self) -> dict:
+        return {
+            model: {"tokens": round(total, 1), "tail_tokens": round(self._tail[model], 1) if model in self._tail else None}
+            for model, total in self._total.items()
+        }
+
+decoding_baseline = DecodingBaseline()
+
+def record_abandoned_work(phase: str, reason: str, seconds: float = 0.0, model: Optional[str] = None,
+                          tokens: int = 0, plan: Optional[DecodingPlan] = None):
+    """Count work thrown away by a stop request, a disconnect or a superseded speculative query"""
+    CANCELLATIONS.inc(phase=phase, reason=reason)
+    if seconds > 0:
+        WASTED_SECONDS.inc(seconds, phase=phase, reason=reason)
+    if model is None:
+        return
+    if tokens:
+        WASTED_TOKENS.inc(tokens, model=model, reason=reason)
+    expected = decoding_baseline.expected(model, plan) if plan is not None else None
+    if expected is not None and expected > tokens:
+        AVOIDED_TOKENS.inc(expected - tokens, model=model, reason=reason)
+
+def cancel_reason(error: BaseException) -> str:
+    """The reason a task was cancelled with (see Task.cancel), "disconnect" by default"""
+    return str(error.args[0]) if isinstance(error, asyncio.CancelledError) and error.args else "disconnect"
+
+class _PrefixCacheEntry:
+    """A saved llama.cpp state plus the prompt evaluation time it took to build"""
+
+    def __init__(self, state, size: int, prompt_eval_time: float, owner: Optional[str] = None):
+        self.state = state
+        self.size = size
+        self.prompt_eval_time = prompt_eval_time
+        self.owner = owner
+
+class PromptPrefixCache:
+    """LRU store of llama.cpp states keyed on the system prompt (domain + schema).
+
+    Every request repeats the same large system prompt, so after the first
+    request for a domain the model state holding that prefix is saved. Later
+    requests with the same prefix restore it and llama.cpp only evaluates the
+    tokens past the longest common prefix. Entries are evicted least recently
+    used first once ``max_bytes`` is exceeded. Shared by all inference slots,
+    so access is guarded by a thread lock.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _PrefixCacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.ttft_saved_total = 0.0
+
+    @staticmethod
+    def key_for(messages: list, model_id: str) -> Optional[str]:
+        """Hash the system messages (which embed the domain schema) for a given model"""
+        system_parts = [m.get("content", "") for m in messages if m.get("role") == "system"]
+        if not system_parts:
+            return None
+        digest = hashlib.sha256(model_id.encode("utf-8"))
+        for part in system_parts:
+            digest.update(b"\x00" + part.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str, touch: bool = True) -> Optional[_PrefixCacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and touch:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, state, prompt_eval_time: float, owner: Optional[str] = None):
+        size = int(getattr(state, "llama_state_size", 0) or 0)
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            self._entries[key] = _PrefixCacheEntry(state, size, prompt_eval_time, owner)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+
+    def record(self, hit: bool, ttft_saved: float = 0.0):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.ttft_saved_total += ttft_saved
+            else:
+                self.misses += 1
+
+    def clear(self, owner: Optional[str] = None):
+        """Drop every entry, or only those saved by one model"""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if owner is None or entry.owner == owner:
+                    del self._entries[key]
+                    self._bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "ttft_saved_total": round(self.ttft_saved_total, 3)
+            }
+
+# Initialize prompt prefix cache shared by the inference slots
+prefix_cache = PromptPrefixCache(PREFIX_CACHE_MAX_BYTES)
+
+class InferenceWorker:
+    """Dedicated thread that owns one Llama instance and all its blocking calls.
+
+    Model loading and token generation run on a single worker thread so the
+    asyncio event loop keeps serving other sockets, pings and stop requests
+    while a generation is in progress. Tokens are handed back to the calling
+    coroutine through an asyncio queue.
+    """
+
+    def __init__(self, slot: int = 0, model_name: str = "default"):
+        self.slot = slot
+        self.model_name = model_name
+        self.llm: Optional[Llama] = None
+        # Prefix key whose state is currently in this slot's KV cache
+        self._resident_prefix: Optional[str] = None
+        # Parsed GBNF grammars by text, only touched on the inference thread
+        self._grammars: OrderedDict = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"inference-{model_name}-{slot}")
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking callable on the inference thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+
+    async def load(self, **kwargs):
+        """Load the model on the inference thread if it is not resident yet"""
+        if self.llm is None:
+            self.llm = await self.run(Llama.from_pretrained, **kwargs)
+
+    async def unload(self):
+        """Drop the model and free its native buffers after any in-flight call"""
+        if self.llm is not None:
+            self.llm = None
+            self._resident_prefix = None
+            await self.run(gc.collect)
+
+    async def reset_context(self):
+        """Forget the tokens in the KV cache but keep the weights loaded"""
+        if self.llm is not None:
+            await self.run(self.llm.reset)
+            self._resident_prefix = None
+
+    def _restore_prefix(self, model, prefix_key: Optional[str]) -> Optional[_PrefixCacheEntry]:
+        """Make sure the KV cache starts with the prefix state; returns the cache entry on a hit"""
+        if not prefix_key:
+            return None
+        if self._resident_prefix == prefix_key:
+            # The previous request on this slot used the same prefix; llama.cpp reuses it as is
+            return prefix_cache.get(prefix_key) or _PrefixCacheEntry(None, 0, 0.0)
+        entry = prefix_cache.get(prefix_key)
+        if entry is not None:
+            model.load_state(entry.state)
+            self._resident_prefix = prefix_key
+        return entry
+
+    def _grammar(self, text: str):
+        grammar = self._grammars.get(text)
+        if grammar is None:
+            grammar = self._grammars[text] = LlamaGrammar.from_string(text, verbose=False)
+            while len(self._grammars) > 16:
+                self._grammars.popitem(last=False)
+        else:
+            self._grammars.move_to_end(text)
+        return grammar
+
+    async def stream_chat_completion(self, messages, should_stop=None, prefix_key=None,
+                                     generation_info: Optional[dict] = None, grammar: Optional[str] = None,
+                                     **kwargs):
+        """Yield streamed completion chunks produced on the inference thread.
+
+        ``should_stop`` is polled between tokens on the worker thread so a stop
+        request takes effect within one token. Closing the async generator
+        (e.g. the consumer breaks out or is cancelled) also stops generation.
+        With a ``prefix_key`` the saved state for that prompt prefix is restored
+        first (or saved afterwards on a miss); ``generation_info`` receives the
+        cache outcome and prompt evaluation time. ``grammar`` is GBNF text that
+        constrains decoding; it is parsed once per worker and reused.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        info = generation_info if generation_info is not None else {}
+
+        def produce():
+            model = self.llm
+            save_prefix = False
+            try:
+                if model is None:
+                    raise RuntimeError("Model is not loaded")
+                if cancelled.is_set() or (should_stop and should_stop()):
+                    # Stopped or abandoned while queued: skip the prompt evaluation entirely
+                    return
+                start = time.time()
+                prompt_eval_time = None
+                entry = self._restore_prefix(model, prefix_key)
+                if grammar is not None:
+                    kwargs["grammar"] = self._grammar(grammar)
+                for chunk in model.create_chat_completion(messages=messages, stream=True, **kwargs):
+                    if prompt_eval_time is None:
+                        prompt_eval_time = time.time() - start
+                        info["prompt_eval_time"] = prompt_eval_time
+                    if cancelled.is_set() or (should_stop and should_stop()):
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+                if prefix_key and prompt_eval_time is not None:
+                    if entry is not None:
+                        ttft_saved = max(0.0, entry.prompt_eval_time - prompt_eval_time) if entry.state is not None else 0.0
+                        prefix_cache.record(True, ttft_saved)
+                        info["prefix_cache"] = "hit"
+                        info["ttft_saved"] = ttft_saved
+                    else:
+                        prefix_cache.record(False)
+                        info["prefix_cache"] = "miss"
+                        info["ttft_saved"] = 0.0
+                        save_prefix = True
+                    self._resident_prefix = prefix_key
+            except Exception as e:
+                self._resident_prefix = None
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, _STREAM_END)
+
+            # Saving happens after the stream end is posted so it never delays the client
+            if save_prefix:
+                try:
+                    prefix_cache.put(prefix_key, model.save_state(), info["prompt_eval_time"], self.model_name)
+                except Exception as e:
+                    logger.warning(f"Failed to save prompt prefix state: {e}")
+
+        loop.run_in_executor(self._executor, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+
+    def shutdown(self):
+        """Stop accepting new work and release the worker thread"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class QueueFullError(Exception):
+    """Raised when the generation waiting room has no space left"""
+
+class RequestWithdrawn(Exception):
+    """Raised in a queued request that was stopped before it got an inference slot"""
+
+class _QueueTicket:
+    """A request waiting for an inference slot"""
+
+    def __init__(self, key: str, future: asyncio.Future, on_position=None):
+        self.key = key
+        self.future = future
+        self.on_position = on_position
+        self.last_position = None
+
+class GenerationScheduler:
+    """Admission control and per-user fair scheduling in front of the inference workers.
+
+    Requests wait in a bounded queue and are granted free slots round-robin
+    across user ids, so one user submitting many requests cannot starve the
+    others. Each slot is an independent Llama instance on its own thread;
+    weights are memory-mapped, so extra slots mostly cost their KV cache and
+    decode concurrently with each other.
+    """
+
+    def __init__(self, workers: list, max_queued: int):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._idle = list(reversed(workers))
+        self._waiting: "OrderedDict[str, deque]" = OrderedDict()
+        self._queued = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    @property
+    def busy_slots(self) -> int:
+        return len(self.workers) - len(self._idle)
+
+    @asynccontextmanager
+    async def acquire(self, key: str, on_position=None):
+        """Wait for a free inference worker; ``on_position`` receives queue position updates"""
+        worker = await self._acquire(key, on_position)
+        try:
+            yield worker
+        finally:
+            self._release(worker)
+
+    async def _acquire(self, key: str, on_position):
+        if self._idle and not self._queued:
+            return self._idle.pop()
+        if self._queued >= self.max_queued:
+            raise QueueFullError(f"Server is busy ({self._queued} requests waiting). Please try again shortly.")
+
+        ticket = _QueueTicket(key, asyncio.get_running_loop().create_future(), on_position)
+        self._waiting.setdefault(key, deque()).append(ticket)
+        self._queued += 1
+        await self._notify_positions()
+        try:
+            return await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Granted a slot just as we were cancelled; hand it back
+                self._release(ticket.future.result())
+            else:
+                self._discard(ticket)
+            raise
+
+    def withdraw(self, key: str) -> int:
+        """Take a client's waiting requests out of the queue; returns how many there were"""
+        queue = self._waiting.pop(key, None)
+        if not queue:
+            return 0
+        self._queued -= len(queue)
+        for ticket in queue:
+            if not ticket.future.done():
+                ticket.future.set_exception(RequestWithdrawn(key))
+        asyncio.ensure_future(self._notify_positions())
+        return len(queue)
+
+    def _discard(self, ticket: _QueueTicket):
+        queue = self._waiting.get(ticket.key)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self._queued -= 1
+            if not queue:
+                del self._waiting[ticket.key]
+
+    def _release(self, worker: InferenceWorker):
+        self._idle.append(worker)
+        granted = False
+        while self._idle and self._waiting:
+            key, queue = next(iter(self._waiting.items()))
+            ticket = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            if ticket.future.done():
+                continue
+            ticket.future.set_result(self._idle.pop())
+            granted = True
+        if granted and self._queued:
+            asyncio.ensure_future(self._notify_positions())
+
+    def _dispatch_order(self) -> list:
+        """Waiting tickets in the order they will be granted (round-robin across users)"""
+        queues = list(self._waiting.values())
+        order = []
+        depth = 0
+        while True:
+            level = [queue[depth] for queue in queues if depth < len(queue)]
+            if not level:
+                return order
+            order.extend(level)
+            depth += 1
+
+    async def _notify_positions(self):
+        for position, ticket in enumerate(self._dispatch_order(), 1):
+            if ticket.on_position and ticket.last_position != position:
+                ticket.last_position = position
+                try:
+                    await ticket.on_position(position)
+                except Exception as e:
+                    logger.debug(f"Failed to send queue position: {e}")
+
+class UnknownModelError(KeyError):
+    """Raised when a request names a model that is not in the registry"""
+
+class ServedModel:
+    """One registry entry: its inference slots, their scheduler, residency and metrics.
+
+    Residency steps "unloaded" -> "loaded" -> (soft idle) "soft" -> (idle)
+    "unloaded". In the soft state the extra slots and this model's saved
+    prefix states are released while one copy of the weights stays resident;
+    a request then reloads the released slots from the page cache.
+    """
+
+    def __init__(self, name: str, repo: str, filename: str, reasoning: bool = True,
+                 size_mb: Optional[float] = None):
+        self.name = name
+        self.repo = repo
+        self.filename = filename
+        self.reasoning = reasoning
+        # Estimated until the GGUF file has been loaded once and measured
+        self.size_bytes = int(size_mb * 1024 * 1024) if size_mb else 0
+        self.workers = [InferenceWorker(slot, name) for slot in range(INFERENCE_SLOTS)]
+        self.scheduler = GenerationScheduler(self.workers, MAX_QUEUED_REQUESTS)
+        self.state = "unloaded"
+        self.last_activity: Optional[float] = None
+        self._load_task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.soft_unloads = 0
+        self.unloads = 0
+        self.last_load_time: Optional[float] = None
+        self.load_time = Histogram()
+        self.unload_time = Histogram()
+
+    @property
+    def model_id(self) -> str:
+        """Identify the model for cache keys"""
+        return f"{self.repo}/{self.filename}"
+
+    @property
+    def is_loaded(self) -> bool:
+        return any(worker.llm is not None for worker in self.workers)
+
+    @property
+    def is_loading(self) -> bool:
+        return self._load_task is not None and not self._load_task.done()
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.scheduler.busy_slots or self.scheduler.queue_depth)
+
+    def touch(self):
+        self.last_activity = asyncio.get_event_loop().time()
+
+    def count_tokens(self, text: str) -> int:
+        """Token count from this model's tokenizer, or an estimate while it is not loaded"""
+        llm = self.workers[0].llm
+        if llm is not None:
+            try:
+                return len(llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+            except Exception as e:
+                logger.debug(f"Tokenizer unavailable, estimating token count: {e}")
+        return len(text) // 4 + 1
+
+    def context_size(self) -> int:
+        """Context window of the loaded slots, or the one they will be loaded with"""
+        llm = self.workers[0].llm
+        return llm.n_ctx() if llm is not None else MODEL_N_CTX
+
+    def load_kwargs(self) -> dict:
+        """Arguments passed to Llama.from_pretrained for every inference slot"""
+        load_kwargs = {
+            "repo_id": self.repo,
+            "filename": self.filename,
+            "use_mmap": MODEL_USE_MMAP,
+            "use_mlock": MODEL_USE_MLOCK,
+            "n_ctx": MODEL_N_CTX
+        }
+        if INFERENCE_SLOTS > 1 or SERVER_WORKERS > 1:
+            # Split the cores between slots and workers so parallel decodes do not oversubscribe the CPU
+            load_kwargs["n_threads"] = max(1, (os.cpu_count() or 1) // (INFERENCE_SLOTS * SERVER_WORKERS))
+        return load_kwargs
+
+    async def _load_slots(self):
+        missing = [worker for worker in self.workers if worker.llm is None]
+        if not missing:
+            self.state = "loaded"
+            return
+
+        warm = self.state == "soft"
+        logger.info(f"Loading model '{self.name}' into {len(missing)} slot(s){' from the page cache' if warm else ''}...")
+        start = time.time()
+        try:
+            load_kwargs = self.load_kwargs()
+            for worker in missing:
+                await worker.load(**load_kwargs)
+        except Exception as e:
+            logger.error(f"Failed to load model '{self.name}': {e}")
+            raise
+        elapsed = time.time() - start
+        model_path = getattr(missing[0].llm, "model_path", None)
+        if model_path and os.path.exists(model_path):
+            self.size_bytes = os.path.getsize(model_path)
+        self.loads += 1
+        self.last_load_time = round(elapsed, 3)
+        self.load_time.observe(elapsed)
+        self.state = "loaded"
+        self.touch()
+        logger.info(f"Model '{self.name}' loaded and ready for inference ({INFERENCE_SLOTS} slot(s)) in {elapsed:.2f}s.")
+
+    async def load(self):
+        """Load the model into every inference slot; concurrent callers share one load"""
+        if self.state == "loaded" and all(worker.llm is not None for worker in self.workers):
+            return
+        if self._load_task is None or self._load_task.done():
+            self._load_task = asyncio.create_task(self._load_slots())
+        # Shielded so a client disconnecting mid-load does not abort it for everyone else
+        await asyncio.shield(self._load_task)
+
+    async def soft_unload(self):
+        """Release per-slot context memory and saved prefix states, keeping one copy of the weights"""
+        if self.state != "loaded":
+            return
+        logger.info(f"Model '{self.name}' idle: releasing extra slots and cached prompt states...")
+        start = time.time()
+        for worker in self.workers[1:]:
+            await worker.unload()
+        await self.workers[0].reset_context()
+        prefix_cache.clear(self.name)
+        elapsed = time.time() - start
+        self.soft_unloads += 1
+        self.unload_time.observe(elapsed)
+        self.state = "soft"
+
+    async def unload(self):
+        """Unload the model to free memory"""
+        if self.is_loaded:
+            logger.info(f"Unloading model '{self.name}' to free memory...")
+            start = time.time()
+            for worker in self.workers:
+                await worker.unload()
+            prefix_cache.clear(self.name)
+            elapsed = time.time() - start
+            self.unloads += 1
+            self.unload_time.observe(elapsed)
+            logger.info(f"Model '{self.name}' unloaded in {elapsed:.2f}s.")
+        self.state = "unloaded"
+
+    def status(self) -> Dict[str, Any]:
+        """Residency, scheduling and load/unload timings"""
+        return {
+            "model": self.model_id,
+            "reasoning": self.reasoning,
+            "state": self.state,
+            "size_bytes": self.size_bytes,
+            "loaded_slots": sum(1 for worker in self.workers if worker.llm is not None),
+            "slots": INFERENCE_SLOTS,
+            "busy_slots": self.scheduler.busy_slots,
+            "queue_depth": self.scheduler.queue_depth,
+            "loads": self.loads,
+            "soft_unloads": self.soft_unloads,
+            "unloads": self.unloads,
+            "last_load_time": self.last_load_time,
+            "load_time": self.load_time.snapshot(),
+            "unload_time": self.unload_time.snapshot()
+        }
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown()
+
+class ModelRegistry:
+    """Named models, the routing policy between them and a RAM budget for residency.
+
+    A request either names a model or is routed by its domain (MODEL_ROUTES).
+    Before a model is loaded, the least recently used models that are not
+    generating are unloaded until the resident weights fit ``budget_bytes``.
+    Weights are memory-mapped, so an evicted model that is needed again
+    usually reloads from the page cache.
+    """
+
+    def __init__(self, specs: Dict[str, dict], default: str, routes: Dict[str, str], budget_bytes: int):
+        # Kept in least recently used first order
+        self.models: "OrderedDict[str, ServedModel]" = OrderedDict()
+        for name, spec in specs.items():
+            self.models[name] = ServedModel(
+                name,
+                spec["repo"],
+                spec["file"],
+                reasoning=spec.get("reasoning", True),
+                size_mb=spec.get("size_mb")
+            )
+        if default not in self.models:
+            raise ValueError(f"DEFAULT_MODEL '{default}' is not in the model registry")
+        self.default_name = default
+        self.routes = routes
+        self.budget_bytes = budget_bytes
+        self.evictions = 0
+
+    @property
+    def default(self) -> ServedModel:
+        return self.models[self.default_name]
+
+    def get(self, name: str) -> ServedModel:
+        if name not in self.models:
+            raise UnknownModelError(f"Unknown model '{name}'. Available models: {', '.join(self.models)}")
+        return self.models[name]
+
+    def route(self, requested: Optional[str] = None, domain: Optional[str] = None) -> ServedModel:
+        """Pick the model for a request: an explicit name wins, then the domain route"""
+        if requested:
+            return self.get(requested)
+        name = (domain and self.routes.get(domain)) or self.routes.get("default") or self.default_name
+        return self.models.get(name, self.default)
+
+    def resident_bytes(self) -> int:
+        return sum(model.size_bytes for model in self.models.values() if model.is_loaded)
+
+    async def ensure_loaded(self, model: ServedModel, touch: bool = True):
+        """Load a model, evicting least recently used idle models to stay under the budget.
+
+        ``touch=False`` leaves an already resident model's recency alone (used
+        when a connection opens without asking for anything yet).
+        """
+        if model.state == "loaded" and not touch:
+            return
+        self.models.move_to_end(model.name)
+        model.touch()
+        if model.state == "loaded":
+            return
+        if not model.is_loaded:
+            await self._make_room(model, model.size_bytes)
+        await model.load()
+        # The real size is only known after the first load
+        await self._make_room(model, 0)
+
+    async def _make_room(self, model: ServedModel, needed: int):
+        if self.budget_bytes <= 0:
+            return
+        for other in list(self.models.values()):
+            if self.resident_bytes() + needed <= self.budget_bytes:
+                return
+            if other is model or not other.is_loaded or other.busy or other.is_loading:
+                continue
+            logger.info(f"Evicting model '{other.name}' to stay within the model RAM budget")
+            await other.unload()
+            self.evictions += 1
+        if self.resident_bytes() + needed > self.budget_bytes:
+            logger.warning(f"Model RAM budget exceeded while loading '{model.name}': other models are busy")
+
+    async def unload_all(self):
+        for model in self.models.values():
+            await model.unload()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "default": self.default_name,
+            "routes": self.routes,
+            "idle_timeout": IDLE_TIMEOUT,
+            "soft_idle_timeout": MODEL_SOFT_IDLE_TIMEOUT,
+            "use_mmap": MODEL_USE_MMAP,
+            "use_mlock": MODEL_USE_MLOCK,
+            "budget_bytes": self.budget_bytes,
+            "resident_bytes": self.resident_bytes(),
+            "evictions": self.evictions,
+            "models": {name: model.status() for name, model in self.models.items()}
+        }
+
+    def shutdown(self):
+        for model in self.models.values():
+            model.shutdown()
+
+# Initialize the model registry (each model owns its inference workers and scheduler)
+model_registry = ModelRegistry(
+    {**DEFAULT_MODEL_REGISTRY, **MODEL_REGISTRY},
+    DEFAULT_MODEL,
+    MODEL_ROUTES,
+    int(MODEL_RAM_BUDGET_MB * 1024 * 1024)
+)
+
+def is_model_loaded() -> bool:
+    """Check whether any registered model has a resident slot"""
+    return any(model.is_loaded for model in model_registry.models.values())
+
+def get_model_status() -> Dict[str, Any]:
+    """Residency, routing and load/unload timings of the registered models"""
+    return model_registry.status()
+
+async def load_model(name: Optional[str] = None, touch: bool = True):
+    """Load a registered model (the default one unless named)"""
+    model = model_registry.get(name) if name else model_registry.default
+    await model_registry.ensure_loaded(model, touch)
+
+async def unload_model():
+    """Unload every model to free memory"""
+    await model_registry.unload_all()
+
+async def unload_idle_models():
+    """Step each model down to soft and then full unload as it stays idle"""
+    if session_store.any_busy():
+        return
+    now = asyncio.get_event_loop().time()
+    for model in list(model_registry.models.values()):
+        if model.busy or model.is_loading or not model.last_activity:
+            continue
+        idle = now - model.last_activity
+        if model.state in ("loaded", "soft") and idle > IDLE_TIMEOUT:
+            await model.unload()
+        elif model.state == "loaded" and idle > MODEL_SOFT_IDLE_TIMEOUT:
+            await model.soft_unload()
+
+async def monitor_idle_time():
+    """Check for idle models every MODEL_IDLE_CHECK_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(MODEL_IDLE_CHECK_INTERVAL)
+        try:
+            await unload_idle_models()
+        except Exception as e:
+            logger.error(f"Idle model check failed: {e}")
+
+def generation_totals_by_model() -> Dict[str, Dict[str, Any]]:
+    """Requests, tokens and generation time per registry model"""
+    totals = {}
+    for (model,), histogram in GENERATION_TIME.series.items():
+        totals[model] = {
+            "requests": histogram.count,
+            "total_tokens": int(TOKENS.value(model=model) or 0),
+            "total_time": round(histogram.sum, 3)
+        }
+    return totals
+
+_QUESTION_TOKEN_RE = re.compile(r"[a-z0-9_]+")
+
+def normalize_question(question: str) -> str:
+    """Lowercase and strip punctuation/whitespace differences from a question"""
+    return " ".join(_QUESTION_TOKEN_RE.findall(question.lower()))
+
+# Words that can differ between two questions without changing the SQL they ask for
+_QUESTION_FILLER_WORDS = frozenset(
+    "a an the please me us i we you can could would will show give list tell find get display return "
+    "what which is are was were do does of for to in on all each every".split()
+)
+
+class _ResponseCacheEntry:
+    """A cached model response for one normalized question"""
+
+    def __init__(self, fingerprint: str, question: str, response: str, created_at: float):
+        self.fingerprint = fingerprint
+        self.question = question
+        self.response = response
+        self.created_at = created_at
+        self.tokens = frozenset(question.split())
+        self.content = self.tokens - _QUESTION_FILLER_WORDS
+
+class ResponseCache:
+    """Cache of complete model responses keyed by (schema fingerprint, question).
+
+    Generation runs at temperature 0, so the same question against the same
+    system prompt always produces the same answer. Lookups try an exact match
+    on the normalized question first. With ``similarity`` below 1.0 it then
+    tries a near-duplicate within the same fingerprint: token Jaccard
+    similarity of at least ``similarity`` and the same words apart from
+    filler, so "north"/"south" or a different number never match. Entries expire after ``ttl`` seconds and are evicted
+    least recently used beyond ``max_entries``. With ``path`` set, entries are
+    also written through to a SQLite file and reloaded on startup.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, similarity: float, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.path = path
+        self._entries: "OrderedDict[tuple, _ResponseCacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        if path:
+            try:
+                self._load()
+            except Exception as e:
+                logger.warning(f"Could not load response cache from {path}: {e}")
+
+    @staticmethod
+    def split_messages(messages: list, model_id: str):
+        """Return (fingerprint, normalized question) for a chat request"""
+        if not messages or messages[-1].get("role") != "user":
+            return None, None
+        digest = hashlib.sha256(model_id.encode("utf-8"))
+        for message in messages[:-1]:
+            digest.update(f"\x00{message.get('role')}\x00{message.get('content', '')}".encode("utf-8"))
+        return digest.hexdigest(), normalize_question(messages[-1].get("content", ""))
+
+    def _expired(self, entry: _ResponseCacheEntry, now: float) -> bool:
+        return self.ttl > 0 and now - entry.created_at > self.ttl
+
+    def get(self, messages: list, model_id: str) -> Optional[str]:
+        fingerprint, question = self.split_messages(messages, model_id)
+        if not fingerprint or not question or self.max_entries <= 0:
+            return None
+        now = time.time()
+        entry = self._entries.get((fingerprint, question))
+        if entry is not None and self._expired(entry, now):
+            self._entries.pop((fingerprint, question), None)
+            entry = None
+        if entry is None and self.similarity < 1.0:
+            entry = self._nearest(fingerprint, question, now)
+            if entry is not None:
+                self.near_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end((entry.fingerprint, entry.question))
+        return entry.response
+
+    def _nearest(self, fingerprint: str, question: str, now: float) -> Optional[_ResponseCacheEntry]:
+        tokens = frozenset(question.split())
+        content = tokens - _QUESTION_FILLER_WORDS
+        best, best_score = None, self.similarity
+        for entry in self._entries.values():
+            if entry.fingerprint != fingerprint or entry.content != content or self._expired(entry, now):
+                continue
+            union = len(tokens | entry.tokens)
+            score = len(tokens & entry.tokens) / union if union else 0.0
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    async def put(self, messages: list, model_id: str, response: str):
+        fingerprint, question = self.split_messages(messages, model_id)
+        if not fingerprint or not question or self.max_entries <= 0:
+            return
+        entry = _ResponseCacheEntry(fingerprint, question, response, time.time())
+        self._entries[(fingerprint, question)] = entry
+        self._entries.move_to_end((fingerprint, question))
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False)[0])
+        if self.path:
+            try:
+                await asyncio.to_thread(self._persist, entry, evicted)
+            except Exception as e:
+                logger.warning(f"Could not persist response cache entry: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "fingerprint TEXT, question TEXT, response TEXT, created_at REAL, "
+            "PRIMARY KEY (fingerprint, question))"
+        )
+        return connection
+
+    def _load(self):
+        connection = self._connect()
+        try:
+            cutoff = time.time() - self.ttl if self.ttl > 0 else 0
+            connection.execute("DELETE FROM response_cache WHERE created_at < ?", (cutoff,))
+            connection.commit()
+            rows = connection.execute(
+                "SELECT fingerprint, question, response, created_at FROM response_cache "
+                "ORDER BY created_at DESC LIMIT ?", (self.max_entries,)
+            ).fetchall()
+        finally:
+            connection.close()
+        for fingerprint, question, response, created_at in reversed(rows):
+            self._entries[(fingerprint, question)] = _ResponseCacheEntry(fingerprint, question, response, created_at)
+        logger.info(f"Loaded {len(rows)} cached responses from {self.path}")
+
+    def _persist(self, entry: _ResponseCacheEntry, evicted: list):
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (entry.fingerprint, entry.question, entry.response, entry.created_at)
+            )
+            connection.executemany(
+                "DELETE FROM response_cache WHERE fingerprint = ? AND question = ?", evicted
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "entries": len(self._entries)
+        }
+
+# Initialize response cache
+response_cache = ResponseCache(
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_PATH
+)
+
+class Session:
+    """State for one client key; slots keep the per-session footprint small"""
+
+    __slots__ = ("key", "system", "messages", "stop_requested", "generating", "sql_task", "last_seen")
+
+    def __init__(self, key: str, messages: Optional[list] = None):
+        self.key = key
+        self.restore(messages)
+        self.stop_requested = False
+        self.generating = False
+        # The query a finished generation is running, cancelled by a stop request
+        self.sql_task: Optional[asyncio.Task] = None
+        self.last_seen = time.time()
+
+    @property
+    def busy(self) -> bool:
+        return self.generating or (self.sql_task is not None and not self.sql_task.done())
+
+    def request_stop(self) -> Optional[str]:
+        """Stop the running generation or cancel its query; returns which one, if any, was running"""
+        self.stop_requested = True
+        if self.sql_task is not None and not self.sql_task.done():
+            self.sql_task.cancel("stop")
+            return "sql"
+        return "generation" if self.generating else None
+
+    def restore(self, messages: Optional[list]):
+        """Replace the conversation context with persisted messages"""
+        messages = list(messages or [])
+        # The stored system prompt is persisted as a leading system message
+        self.system = messages.pop(0)["content"] if messages and messages[0].get("role") == "system" else None
+        self.messages = messages
+
+class SessionBackend:
+    """Persistence interface for SessionStore's conversation context (flags are never
+    persisted). The base class stores nothing; subclass it for other stores."""
+
+    def load(self, key: str) -> Optional[list]:
+        return None
+
+    def save(self, key: str, messages: list, last_seen: float):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def prune(self, cutoff: float):
+        pass
+
+class SqliteSessionBackend(SessionBackend):
+    """Conversation context kept in a SQLite file"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, messages TEXT, last_seen REAL)"
+        )
+        return connection
+
+    def load(self, key: str) -> Optional[list]:
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT messages FROM sessions WHERE key = ?", (key,)).fetchone()
+        finally:
+            connection.close()
+        return json.loads(row[0]) if row else None
+
+    def save(self, key: str, messages: list, last_seen: float):
+        connection = self._connect()
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (key, json.dumps(messages), last_seen)
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+    def delete(self, key: str):
+        connection = self._connect()
+        try:
+            connection.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def prune(self, cutoff: float):
+        connection = self._connect()
+        try:
+            connection.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,))
+            connection.commit()
+        finally:
+            connection.close()
+
+class SessionStore:
+    """Bounded, TTL-evicting map from client key to Session.
+
+    Lookups that only read (stop requests, disconnects) never create
+    sessions, so arbitrary ids sent by clients do not allocate state.
+    Sessions idle longer than ``ttl`` are expired, and beyond
+    ``max_entries`` the least recently used session that is not busy is
+    evicted. An optional backend persists conversation context; backend
+    calls run in a thread. A ``shared`` backend is also written by other
+    worker processes, so cached sessions are refreshed from it on acquire.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, backend: Optional[SessionBackend] = None,
+                 shared: bool = False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.shared = shared and backend is not None
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return self.ttl > 0 and not session.busy and now - session.last_seen > self.ttl
+
+    def peek(self, key: str) -> Optional[Session]:
+        """Existing live session for a key, without creating or touching it"""
+        session = self._sessions.get(key)
+        if session is not None and self._expired(session, time.time()):
+            self._sessions.pop(key, None)
+            self.expirations += 1
+            return None
+        return session
+
+    async def acquire(self, key: str) -> Session:
+        """Session for a key, restoring persisted context or creating it as needed"""
+        session = self.peek(key)
+        if session is None:
+            messages = None
+            if self.backend is not None:
+                try:
+                    messages = await asyncio.to_thread(self.backend.load, key)
+                except Exception as e:
+                    logger.warning(f"Could not load session {key}: {e}")
+            # Another request may have created it while the backend was read
+            session = self._sessions.get(key) or Session(key, messages)
+            self._sessions[key] = session
+            self._evict(key)
+        elif self.shared and not session.generating:
+            # The user's last turn may have been answered by another worker
+            try:
+                messages = await asyncio.to_thread(self.backend.load, key)
+                if messages is not None:
+                    session.restore(messages)
+            except Exception as e:
+                logger.warning(f"Could not refresh session {key}: {e}")
+        session.last_seen = time.time()
+        self._sessions.move_to_end(key)
+        return session
+
+    def _evict(self, keep: str):
+        while len(self._sessions) > self.max_entries:
+            for key, session in self._sessions.items():
+                if key != keep and not session.busy:
+                    del self._sessions[key]
+                    self.evictions += 1
+                    break
+            else:
+                return
+
+    async def persist(self, session: Session):
+        if self.backend is None:
+            return
+        try:
+            stored = ([{"role": "system", "content": session.system}] if session.system else []) + session.messages
+            await asyncio.to_thread(self.backend.save, session.key, stored, session.last_seen)
+        except Exception as e:
+            logger.warning(f"Could not persist session {session.key}: {e}")
+
+    async def discard(self, key: str, forget: bool = False):
+        """Drop a session from memory (and from the backend with ``forget``)"""
+        self._sessions.pop(key, None)
+        if forget and self.backend is not None:
+            try:
+                await asyncio.to_thread(self.backend.delete, key)
+            except Exception as e:
+                logger.warning(f"Could not delete session {key}: {e}")
+
+    def any_busy(self) -> bool:
+        return any(session.busy for session in self._sessions.values())
+
+    async def expire(self):
+        """Drop idle sessions from memory and the backend"""
+        now = time.time()
+        for key, session in list(self._sessions.items()):
+            if self._expired(session, now):
+                del self._sessions[key]
+                self.expirations += 1
+        if self.ttl > 0 and self.backend is not None:
+            try:
+                await asyncio.to_thread(self.backend.prune, now - self.ttl)
+            except Exception as e:
+                logger.warning(f"Could not prune stored sessions: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+class ControlStore:
+    """Control state shared by the worker processes, kept in a SQLite file.
+
+    Each running generation for a user id has a row naming the worker that
+    owns it, so one user generates on one worker at a time and a stop sent
+    over any connection reaches the worker doing the work. Workers also
+    register their metrics endpoint here for the supervisor to scrape.
+    Calls block; run them in a thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS generations "
+            "(key TEXT PRIMARY KEY, worker INTEGER, token TEXT, stop INTEGER, started REAL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS workers (worker INTEGER PRIMARY KEY, pid INTEGER, metrics_port INTEGER)"
+        )
+        return connection
+
+    def _write(self, statement: str, params=()) -> int:
+        connection = self._connect()
+        try:
+            cursor = connection.execute(statement, params)
+            connection.commit()
+            return cursor.rowcount
+        finally:
+            connection.close()
+
+    def claim(self, key: str, worker: int, token: str) -> bool:
+        """Take ownership of the user's generation; False while another one runs"""
+        return self._write(
+            "INSERT OR IGNORE INTO generations VALUES (?, ?, ?, 0, ?)", (key, worker, token, time.time())
+        ) == 1
+
+    def release(self, key: str, token: str):
+        self._write("DELETE FROM generations WHERE key = ? AND token = ?", (key, token))
+
+    def request_stop(self, key: str) -> bool:
+        """Flag the user's running generation, wherever it runs"""
+        return self._write("UPDATE generations SET stop = 1 WHERE key = ?", (key,)) > 0
+
+    def stop_requests(self, worker: int) -> list:
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT key FROM generations WHERE worker = ? AND stop = 1", (worker,)
+            ).fetchall()
+        finally:
+            connection.close()
+        return [row[0] for row in rows]
+
+    def register_worker(self, worker: int, pid: int, metrics_port: Optional[int]):
+        self._write("INSERT OR REPLACE INTO workers VALUES (?, ?, ?)", (worker, pid, metrics_port))
+
+    def workers(self) -> list:
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT worker, pid, metrics_port FROM workers ORDER BY worker").fetchall()
+        finally:
+            connection.close()
+
+    def clear_worker(self, worker: int):
+        """Forget a worker that exited and the generations it owned"""
+        self._write("DELETE FROM generations WHERE worker = ?", (worker,))
+        self._write("DELETE FROM workers WHERE worker = ?", (worker,))
+
+    def reset(self):
+        self._write("DELETE FROM generations")
+        self._write("DELETE FROM workers")
+
+control_store = ControlStore(CONTROL_STORE_PATH) if CONTROL_STORE_PATH else None
+
+# Initialize the session store; worker processes share conversation context through the control file
+session_store = SessionStore(
+    SESSION_MAX_ENTRIES,
+    SESSION_TTL,
+    SqliteSessionBackend(SESSION_STORE_PATH or CONTROL_STORE_PATH) if SESSION_STORE_PATH or CONTROL_STORE_PATH else None,
+    shared=control_store is not None
+)
+
+# String and numeric literals in generated SQL, masked before it is recorded
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+class TrafficRecorder:
+    """Append anonymized request envelopes to a JSONL file for later replay.
+
+    No message text or user id is written: ids and texts become salted
+    hashes (equal questions and system prompts keep equal digests, so a
+    replay reproduces cache and prefix reuse), texts are reduced to their
+    length, and literals in the generated SQL are masked.
+    """
+
+    def __init__(self, path: Optional[str], sample: float = 1.0, salt: Optional[str] = None):
+        self.path = path
+        self.sample = sample
+        self.salt = (salt or os.urandom(16).hex()).encode("utf-8")
+        self.recorded = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def digest(self, text: str) -> str:
+        return hmac.new(self.salt, text.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+    def start(self, key: str, data: dict, domain: Optional[str], model: str) -> Optional[Dict[str, Any]]:
+        """Begin an envelope for a chat request, or None when this request is not recorded"""
+        if not self.path or random.random() >= self.sample:
+            return None
+        return {
+            "ts": round(time.time(), 3),
+            "client": self.digest(key),
+            "domain": domain,
+            "model": model,
+            "delta": bool(data.get("delta")),
+            "messages": [
+                {
+                    "role": m.get("role"),
+                    "chars": len(m.get("content", "")),
+                    "digest": self.digest(normalize_question(m.get("content", "")))
+                }
+                for m in data.get("messages", [])
+            ]
+        }
+
+    @staticmethod
+    def mask_sql(sql: Optional[str]) -> Optional[str]:
+        return _SQL_LITERAL_RE.sub("?", sql) if sql else sql
+
+    def _append(self, line: str):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    async def write(self, envelope: Dict[str, Any]):
+        try:
+            await asyncio.to_thread(self._append, json.dumps(envelope, default=str))
+            self.recorded += 1
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Could not record request to {self.path}: {e}")
+
+traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_PATH, TRAFFIC_RECORD_SAMPLE, TRAFFIC_RECORD_SALT)
+
+# Encoders for the non-JSON values asyncpg returns, looked up by exact type first
+# since this runs once per cell. Numeric values go out as text to keep full precision.
+_VALUE_ENCODERS = {
+    decimal.Decimal: str,
+    datetime.datetime: datetime.datetime.isoformat,
+    datetime.date: datetime.date.isoformat,
+    datetime.time: datetime.time.isoformat,
+    datetime.timedelta: datetime.timedelta.total_seconds,
+    uuid.UUID: str,
+    bytes: lambda value: "\\x" + value.hex(),
+    asyncpg.Record: dict,
+    set: list,
+    frozenset: list,
+}
+
+def _encode_default(value):
+    """Encode the values asyncpg returns that have no JSON (or msgpack) type"""
+    encode = _VALUE_ENCODERS.get(type(value))
+    if encode is not None:
+        return encode(value)
+    for value_type, encode in _VALUE_ENCODERS.items():
+        if isinstance(value, value_type):
+            return encode(value)
+    if isinstance(value, (bytearray, memoryview)):
+        return "\\x" + bytes(value).hex()
+    # Network addresses, ranges, geometric types
+    return str(value)
+
+_json_encoder = json.JSONEncoder(default=_encode_default, ensure_ascii=False, separators=(",", ":"))
+
+class FrameDecodeError(ValueError):
+    """Raised when an incoming frame cannot be decoded"""
+
+class FrameCodec:
+    """How frames are encoded for one websocket subprotocol.
+
+    A ``columnar`` codec sends result rows as value arrays matching the
+    ``columns`` list instead of one dict per row repeating every column name.
+    """
+
+    def __init__(self, name: Optional[str], dumps, columnar: bool):
+        self.name = name
+        self.dumps = dumps
+        self.columnar = columnar
+
+    def encode(self, payload: dict):
+        return self.dumps(payload)
+
+    def rows(self, records: list) -> list:
+        """Shape fetched records as this codec sends them"""
+        if self.columnar:
+            return [tuple(record) for record in records]
+        return [dict(record) for record in records]
+
+    def result(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Shape a DatabaseManager.execute_query result for sending"""
+        if result.get("data") is None:
+            return result
+        shaped = dict(result)
+        records = shaped.pop("data")
+        if self.columnar:
+            shaped["rows"] = self.rows(records)
+        else:
+            shaped.pop("columns", None)
+            shaped["data"] = self.rows(records)
+        return shaped
+
+LEGACY_FRAME_CODEC = FrameCodec(None, _json_encoder.encode, columnar=False)
+# Subprotocols in order of preference when a client offers several
+FRAME_CODECS = {}
+if msgpack is not None:
+    FRAME_CODECS["edgequery.msgpack"] = FrameCodec(
+        "edgequery.msgpack", partial(msgpack.packb, default=_encode_default, datetime=False), columnar=True
+    )
+FRAME_CODECS["edgequery.json"] = FrameCodec("edgequery.json", _json_encoder.encode, columnar=True)
+
+def select_subprotocol(connection, subprotocols):
+    """Pick the preferred framing the client offers; no subprotocol keeps legacy JSON"""
+    for name in FRAME_CODECS:
+        if name in subprotocols:
+            return name
+    return None
+
+def frame_codec(websocket) -> FrameCodec:
+    return FRAME_CODECS.get(getattr(websocket, "subprotocol", None), LEGACY_FRAME_CODEC)
+
+async def send_frame(websocket, payload: dict) -> int:
+    """Encode a frame for the connection's negotiated subprotocol and send it; returns its size"""
+    frame = frame_codec(websocket).encode(payload)
+    await websocket.send(frame)
+    return len(frame)
+
+def decode_frame(message) -> dict:
+    """Decode a client frame: binary frames are msgpack, text frames JSON"""
+    if isinstance(message, (bytes, bytearray)):
+        if msgpack is None:
+            raise FrameDecodeError("Binary frames need the msgpack subprotocol")
+        try:
+            return msgpack.unpackb(message)
+        except Exception as e:
+            raise FrameDecodeError(f"Invalid msgpack: {str(e)}")
+    try:
+        return json.loads(message)
+    except json.JSONDecodeError as e:
+        raise FrameDecodeError(f"Invalid JSON: {str(e)}")
+
+class SelectivePerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that leaves small messages uncompressed.
+
+    RFC 7692 marks each compressed message with RSV1, so a sender may skip
+    compression per message; for frames of a few dozen bytes the deflate
+    overhead costs more than it saves.
+    """
+
+    def __init__(self, *args, min_size: int = WS_COMPRESSION_MIN_BYTES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def encode(self, frame):
+        if frame.fin and frame.opcode in (Opcode.TEXT, Opcode.BINARY) and len(frame.data) < self.min_size:
+            return frame
+        return super().encode(frame)
+
+class SelectiveDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiates permessage-deflate and hands out SelectivePerMessageDeflate"""
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, SelectivePerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings
+        )
+
+def websocket_extensions() -> list:
+    if not WS_COMPRESSION:
+        return []
+    return [SelectiveDeflateFactory(
+        server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        compress_settings={"level": WS_DEFLATE_LEVEL, "memLevel": WS_DEFLATE_MEM_LEVEL}
+    )]
+
+class StreamCoalescer:
+    """Batch streamed tokens into ``chunk`` frames.
+
+    The first token is sent immediately so time to first token is unaffected.
+    After that, tokens are buffered and flushed when the buffer reaches
+    ``max_bytes`` or ``max_delay`` seconds after the first buffered token,
+    whichever comes first. Frames keep the ``{"type": "chunk", "content": ...}``
+    shape, so clients simply receive longer content strings.
+    """
+
+    def __init__(self, websocket, max_delay: float = STREAM_FLUSH_INTERVAL, max_bytes: int = STREAM_FLUSH_BYTES):
+        self.websocket = websocket
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.frames_sent = 0
+        self._buffer = []
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, content: str):
+        """Queue a token for sending, flushing if the frame budget is reached"""
+        self._buffer.append(content)
+        self._size += len(content.encode("utf-8"))
+        if self.frames_sent == 0 or self._size >= self.max_bytes or self.max_delay <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, lambda: asyncio.ensure_future(self._flush_on_timer())
+            )
+
+    async def _flush_on_timer(self):
+        try:
+            await self.flush()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def flush(self):
+        """Send everything buffered so far as a single chunk frame"""
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._buffer:
+                return
+            content = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self.frames_sent += 1
+            await send_frame(self.websocket, {
+                "type": "chunk",
+                "content": content
+            })
+
+    def discard(self):
+        """Drop any buffered tokens without sending them"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._buffer = []
+        self._size = 0
+
+async def handle_connection(websocket):
+    """Handle WebSocket connections"""
+    user_id = None
+    chat_task: Optional[asyncio.Task] = None
+
+    async def report_db_status(ready, message):
+        await send_frame(websocket, {
+            "type": "status" if ready else "warning",
+            "content": message
+        })
+
+    ACTIVE_CONNECTIONS.inc()
+    try:
+        # Load model for local chat (normally already resident from the startup load)
+        if model_registry.default.state != "loaded":
+            await send_frame(websocket, {"type": "status", "content": "Loading model..."})
+        await load_model(touch=False)
+        await send_frame(websocket, {"type": "status", "content": "Model loaded and ready for inference."})
+
+        # Database readiness is reported as it changes; chat does not wait for it
+        db_manager.add_status_listener(report_db_status)
+        if db_manager.pool is None:
+            if db_manager.connection_string:
+                db_manager.ensure_pool_started()
+                await send_frame(websocket, {
+                    "type": "status",
+                    "content": "Connecting to the database in the background. You can start chatting now."
+                })
+            else:
+                await send_frame(websocket, {
+                    "type": "warning", 
+                    "content": "Database connection failed: POSTGRES_CONNECTION_STRING is not set. Server will continue without database functionality."
+                })
+
+        # Handle messages
+        async for message in websocket:
+            try:
+                data = decode_frame(message)
+                
+                if "user_id" in data:
+                    user_id = data["user_id"]
+
+                if data.get("action") == "stop_generation":
+                    key = connection_key(websocket, user_id)
+                    session = session_store.peek(key)
+                    stopped = session is not None
+                    running = stop_session(session) if session is not None else None
+                    if control_store is not None and user_id and running is None:
+                        # The generation may be running on another worker
+                        stopped = await asyncio.to_thread(control_store.request_stop, key) or stopped
+                    if stopped:
+                        await send_frame(websocket, {
+                            "type": "status",
+                            "content": "Query cancelled by user request" if running == "sql"
+                            else "Generation stopped by user request"
+                        })
+                    continue
+
+                if data.get("action") == "reset_context":
+                    session = session_store.peek(connection_key(websocket, user_id))
+                    if session is not None:
+                        session.messages.clear()
+                        await session_store.persist(session)
+                    await send_frame(websocket, {
+                        "type": "status",
+                        "content": "Conversation context cleared"
+                    })
+                    continue
+
+                if data.get("action") == "configure_pool":
+                    await handle_configure_pool(websocket, data)
+                    continue
+
+                if data.get("action") == "configure_model":
+                    await handle_configure_model(websocket, data)
+                    continue
+
+                if data.get("action") == "fetch_next_page":
+                    await handle_fetch_next_page(websocket, data, connection_key(websocket, user_id))
+                    continue
+
+                if "messages" in data:
+                    if chat_task and not chat_task.done():
+                        await send_frame(websocket, {
+                            "type": "warning",
+                            "content": "A response is already being generated. Stop it or wait for it to finish."
+                        })
+                        continue
+                    # Run generation as a task so stop requests on this socket are still read
+                    chat_task = asyncio.create_task(process_chat_message(websocket, data, user_id))
+                    
+            except FrameDecodeError as e:
+                await send_frame(websocket, {
+                    "type": "error",
+                    "content": str(e)
+                })
+            except Exception as e:
+                logger.error(f"Error handling message: {e}")
+                ERRORS.inc(kind="message")
+                await send_frame(websocket, {
+                    "type": "error", 
+                    "content": f"Error processing message: {str(e)}"
+                })
+
+    except websockets.exceptions.ConnectionClosedOK:
+        logger.info("Client disconnected normally.")
+    except Exception as e:
+        logger.error(f"Connection error: {e}")
+        ERRORS.inc(kind="connection")
+        try:
+            await send_frame(websocket, {
+                "type": "error",
+                "content": f"Connection error: {str(e)}"
+            })
+        except:
+            pass
+    finally:
+        ACTIVE_CONNECTIONS.inc(-1)
+        db_manager.remove_status_listener(report_db_status)
+        if chat_task and not chat_task.done():
+            # Aborts the inference loop or cancels the running query (asyncpg sends the
+            # server a cancel request) and returns its connection to the pool
+            chat_task.cancel("disconnect")
+            await asyncio.gather(chat_task, return_exceptions=True)
+        await close_result_cursor(connection_key(websocket, user_id))
+        session = session_store.peek(connection_key(websocket, user_id))
+        if session is not None:
+            session.generating = False
+            session.stop_requested = False
+            if not user_id:
+                # Nobody can come back to an anonymous connection's context
+                await session_store.discard(session.key)
+
+async def process_chat_message(websocket, data, user_id):
+    """Run a chat request outside the receive loop and report failures to the client"""
+    key = connection_key(websocket, user_id)
+    claim = None
+    try:
+        if control_store is not None and user_id:
+            claim = uuid.uuid4().hex
+            if not await asyncio.to_thread(control_store.claim, key, WORKER_INDEX, claim):
+                claim = None
+                await send_frame(websocket, {
+                    "type": "warning",
+                    "content": "A response is already being generated for this user. Stop it or wait for it to finish."
+                })
+                return
+        await handle_chat_request(websocket, data, user_id)
+    except websockets.exceptions.ConnectionClosed:
+        logger.info("Client disconnected during generation.")
+    except Exception as e:
+        logger.error(f"Error handling message: {e}")
+        try:
+            await send_frame(websocket, {
+                "type": "error",
+                "content": f"Error processing message: {str(e)}"
+            })
+        except websockets.exceptions.ConnectionClosed:
+            pass
+    finally:
+        if claim is not None:
+            try:
+                await asyncio.to_thread(control_store.release, key, claim)
+            except Exception as e:
+                logger.warning(f"Could not release generation for {key}: {e}")
 
 async def handle_chat_request(websocket, data, user_id):
     """Handle chat completion requests"""
-    global last_activity, token_generation_metrics
-    
-    if user_id:
-        stop_generation[user_id] = False
-        active_generations[user_id] = True
+    session = await session_store.acquire(connection_key(websocket, user_id))
+    incoming = data["messages"]
+    system_parts = [m.get("content", "") for m in incoming if m.get("role") == "system"]
+    if system_parts:
+        # Remembered so later delta requests can leave the (large) schema prompt out
+        session.system = system_parts[-1]
+    if data.get("delta"):
+        new_messages = [
+            {"role": m.get("role", "user"), "content": m.get("content", "")}
+            for m in incoming if m.get("role") != "system"
+        ]
+        if not new_messages:
+            await send_frame(websocket, {
+                "type": "error",
+                "content": "A delta request needs at least one new message"
+            })
+            return
+        system = [{"role": "system", "content": session.system}] if session.system else []
+        # The stored messages keep their cached token counts
+        messages = system + session.messages + new_messages
+        new_turn = len(new_messages)
+        domain_source = system
+    else:
+        messages = incoming
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=0)
+        new_turn = len(messages) - last_user
+        domain_source = messages
 
-    last_activity = asyncio.get_event_loop().time()
-    messages = data["messages"]
-    
-    await websocket.send(json.dumps({
+    domain = data.get("domain") or extract_domain_name(domain_source)
+    try:
+        served = model_registry.route(data.get("model"), domain)
+    except UnknownModelError as e:
+        await send_frame(websocket, {
+            "type": "error",
+            "content": str(e.args[0])
+        })
+        return
+    if (data.get("schema_source") or SCHEMA_SOURCE) == "server":
+        question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+        messages, schema_info = await apply_server_schema(messages, domain, question)
+        if schema_info is not None:
+            logger.info(f"Schema prompt: {len(schema_info['tables'])}/{schema_info['total_tables']} tables, "
+                        f"{schema_info['chars']} chars (client sent {schema_info['client_chars']})")
+            await send_frame(websocket, {
+                "type": "status",
+                "content": f"Using {len(schema_info['tables'])} of {schema_info['total_tables']} tables from the database schema",
+                "schema": {
+                    "fingerprint": schema_info["fingerprint"],
+                    "tables": schema_info["tables"]
+                }
+            })
+    try:
+        decoding, messages = plan_decoding(data.get("decoding_mode"), messages, served)
+    except UnknownDecodingModeError as e:
+        await send_frame(websocket, {
+            "type": "error",
+            "content": str(e.args[0])
+        })
+        return
+    messages = fit_prompt_messages(messages, new_turn, served, prompt_token_budget(served, decoding.max_tokens))
+    # Answers differ between modes, so only the default mode shares cache entries with older ones
+    cache_model_id = served.model_id if decoding.mode == "reasoning" else f"{served.model_id}:{decoding.mode}"
+    trace = traffic_recorder.start(session.key, data, domain, served.name)
+
+    session.stop_requested = False
+    session.generating = True
+
+    served.touch()
+
+    await send_frame(websocket, {
         "type": "status",
         "content": "Processing your request..."
-    }))
-    await websocket.send(json.dumps({
+    })
+    await send_frame(websocket, {
         "type": "hold", 
         "content": "Please wait while I generate the response..."
-    }))
+    })
 
     full_response = ""
     token_count = 0
     session_start_time = time.time()
     first_token_time = None
     token_times = []
+    response_generator = None
     
-    try:
-        # Generate response
-        response_generator = llm.create_chat_completion(
-            messages=messages,
-            stream=True,
-            max_tokens=2048,
-            temperature=0,
-        )
-        
-        for chunk in response_generator:
-            if user_id and stop_generation.get(user_id, False):
-                await websocket.send(json.dumps({
-                    "type": "status",
-                    "content": "Generation stopped by user"
-                }))
-                break
+    queue_wait = 0.0
+    # When an inference slot was handed to this request
+    generation_started = None
+    speculation: Optional[SpeculativeSqlExecution] = None
+    sql_info = {}
+    sql_extractor = SqlStreamExtractor()
+    coalescer = StreamCoalescer(websocket)
+    generation_info = {}
+    prefix_key = PromptPrefixCache.key_for(messages, served.model_id)
+    queue_key = connection_key(websocket, user_id)
+
+    async def report_queue_position(position):
+        await send_frame(websocket, {
+            "type": "status",
+            "content": f"Waiting for a free model slot (position {position} in queue)...",
+            "queue_position": position
+        })
+    
+    stopped = False
+    failed = False
+    queue_full = False
+    extraction_time = 0.0
+    finish_reason = None
+    # Tokens generated when the SQL block closed; the rest of an unconstrained answer is its tail
+    closed_at_token = None
+    cut_at_tag = False
+
+    def extract(content):
+        nonlocal extraction_time, speculation, closed_at_token
+        extraction_start = time.perf_counter()
+        closed_sql = sql_extractor.feed(content)
+        extraction_time += time.perf_counter() - extraction_start
+        if closed_sql and closed_at_token is None:
+            closed_at_token = token_count
+        # Run a read as soon as its block is closed instead of after the tail; a write waits
+        # for the end of generation, since a stop or a changed final query cannot undo it
+        if SQL_SPECULATIVE_EXECUTION and speculation is None and closed_sql and is_read_statement(closed_sql):
+            speculation = SpeculativeSqlExecution(
+                websocket, closed_sql, session.key, domain, execution_info=sql_info
+            )
+
+    cached_response = response_cache.get(messages, cache_model_id)
+    if cached_response is not None:
+        # Deterministic generation: replay the stored answer instead of running the model
+        logger.info("Serving response from NL->SQL response cache")
+        await send_frame(websocket, {
+            "type": "status",
+            "content": "Answer served from cache"
+        })
+        await coalescer.add(cached_response)
+        await coalescer.flush()
+        full_response = cached_response
+        extraction_start = time.perf_counter()
+        sql_extractor.feed(cached_response)
+        extraction_time += time.perf_counter() - extraction_start
+        session.generating = False
+        session.stop_requested = False
+    else:
+        try:
+            if served.state != "loaded":
+                # Not resident yet, or released by the idle policy or the RAM budget
+                await send_frame(websocket, {"type": "status", "content": f"Loading model '{served.name}'..."})
+            await model_registry.ensure_loaded(served)
+            async with served.scheduler.acquire(queue_key, report_queue_position) as worker:
+                queue_wait = time.time() - session_start_time
+                QUEUE_WAIT.observe(queue_wait, model=served.name)
+                generation_started = time.time()
+                try:
+                    # Generate response on the inference thread; tokens arrive through an async queue
+                    response_generator = worker.stream_chat_completion(
+                        messages,
+                        should_stop=lambda: session.stop_requested,
+                        prefix_key=prefix_key,
+                        generation_info=generation_info,
+                        grammar=decoding.grammar,
+                        **decoding.completion_kwargs()
+                    )
                 
-            if "choices" in chunk and len(chunk["choices"]) > 0:
-                if "delta" in chunk["choices"][0] and "content" in chunk["choices"][0]["delta"]:
-                    current_time = time.time()
-                    content = chunk["choices"][0]["delta"]["content"]
-                    full_response += content
-                    token_count += 1
-                    
-                    # Record first token time (Time to First Token - TTFT)
-                    if first_token_time is None:
-                        first_token_time = current_time
-                        ttft = first_token_time - session_start_time
-                    
-                    # Record inter-token time
-                    if len(token_times) > 0:
-                        inter_token_time = current_time - token_times[-1]
-                    else:
-                        inter_token_time = current_time - session_start_time
-                    
-                    token_times.append(current_time)
-                    
-                    await websocket.send(json.dumps({
-                        "type": "chunk",
-                        "content": content
-                    }))
-                    await asyncio.sleep(0.05)  # Slight delay for smoother streaming
+                    async for chunk in response_generator:
+                        if session.stop_requested:
+                            await coalescer.flush()
+                            await send_frame(websocket, {
+                                "type": "status",
+                                "content": "Generation stopped by user"
+                            })
+                            break
+                        
+                        if "choices" in chunk and len(chunk["choices"]) > 0:
+                            if "delta" in chunk["choices"][0] and "content" in chunk["choices"][0]["delta"]:
+                                current_time = time.time()
+                                content = chunk["choices"][0]["delta"]["content"]
+                                full_response += content
+                                token_count += 1
+                            
+                                # Record first token time (Time to First Token - TTFT)
+                                if first_token_time is None:
+                                    first_token_time = current_time
+                                    ttft = first_token_time - session_start_time
+                                    TTFT.observe(ttft, model=served.name, domain=domain or "unknown")
+                            
+                                # Record inter-token time
+                                if len(token_times) > 0:
+                                    inter_token_time = current_time - token_times[-1]
+                                    INTER_TOKEN.observe(inter_token_time, model=served.name)
+                                else:
+                                    inter_token_time = current_time - session_start_time
+                            
+                                token_times.append(current_time)
+                            
+                                await coalescer.add(content)
+                                extract(content)
+                            finish_reason = chunk["choices"][0].get("finish_reason") or finish_reason
+
+                    if (decoding.stop and finish_reason == "stop" and not session.stop_requested
+                            and _SQL_TAG_OPEN in full_response and _SQL_TAG_CLOSE not in full_response):
+                        # llama.cpp drops the stop sequence; put the closing tag back for the client and extractor
+                        cut_at_tag = True
+                        full_response += _SQL_TAG_CLOSE
+                        await coalescer.add(_SQL_TAG_CLOSE)
+                        extract(_SQL_TAG_CLOSE)
+                    # Deliver the tail of the stream before the completion frames
+                    await coalescer.flush()
+                finally:
+                    coalescer.discard()
+                    # Stop the worker thread before the slot is handed to the next request
+                    if response_generator is not None:
+                        await response_generator.aclose()
                     
-    except Exception as e:
-        logger.error(f"Error during generation: {e}")
-        await websocket.send(json.dumps({
-            "type": "error",
-            "content": f"Error during generation: {str(e)}"
-        }))
-        full_response = f"Error: {str(e)}"
-    finally:
-        if user_id:
-            active_generations[user_id] = False
-            stop_generation[user_id] = False
+        except RequestWithdrawn:
+            # Stopped while waiting for a slot; the stop flag makes this a "stopped" outcome
+            pass
+        except QueueFullError as e:
+            logger.warning(f"Rejected generation request: {e}")
+            await send_frame(websocket, {
+                "type": "error",
+                "content": str(e)
+            })
+            full_response = ""
+            failed = True
+            queue_full = True
+            ERRORS.inc(kind="queue_full")
+        except (asyncio.CancelledError, websockets.exceptions.ConnectionClosed) as e:
+            # Before ``except Exception``, which ConnectionClosed would otherwise match.
+            # The client went away: the worker thread stops at the next token and the slot is free
+            if speculation is not None:
+                await speculation.discard(cancel_reason(e))
+            record_abandoned_work(
+                "generation" if generation_started else "queue", cancel_reason(e),
+                seconds=time.time() - generation_started if generation_started else 0.0,
+                model=served.name, tokens=token_count, plan=decoding
+            )
+            raise
+        except Exception as e:
+            logger.error(f"Error during generation: {e}")
+            ERRORS.inc(kind="generation")
+            await send_frame(websocket, {
+                "type": "error",
+                "content": f"Error during generation: {str(e)}"
+            })
+            full_response = f"Error: {str(e)}"
+            failed = True
+        finally:
+            stopped = session.stop_requested
+            session.generating = False
+            session.stop_requested = False
+
+        if full_response and not stopped and not failed:
+            await response_cache.put(messages, cache_model_id, full_response)
 
     # Calculate and log timing metrics
     session_end_time = time.time()
     total_session_time = session_end_time - session_start_time
+    extraction_start = time.perf_counter()
+    final_sql = sql_extractor.finish()
+    SQL_EXTRACTION.observe(extraction_time + time.perf_counter() - extraction_start)
+    if cached_response is not None:
+        outcome = "cached"
+    elif failed:
+        outcome = "queue_full" if queue_full else "failed"
+    else:
+        outcome = "stopped" if stopped else "completed"
+    REQUESTS.inc(model=served.name, domain=domain or "unknown", outcome=outcome)
+    if stopped:
+        record_abandoned_work(
+            "generation" if token_count else "queue", "stop",
+            seconds=session_end_time - generation_started if generation_started else 0.0,
+            model=served.name, tokens=token_count, plan=decoding
+        )
+    tokens_saved = None
+    if cached_response is None and not failed:
+        if stopped:
+            finish = "stopped"
+        elif cut_at_tag:
+            finish = "stop_tag"
+        elif finish_reason == "length":
+            finish = "length"
+        else:
+            finish = "eos"
+        DECODING_REQUESTS.inc(model=served.name, mode=decoding.mode, finish=finish)
+        if decoding.baseline_sample and finish == "eos":
+            tail_tokens = token_count - closed_at_token if closed_at_token is not None else None
+            decoding_baseline.record(served.name, token_count, tail_tokens)
+        elif not stopped:
+            tokens_saved = decoding_baseline.saved(served.name, decoding, token_count, cut_at_tag)
+            if tokens_saved:
+                DECODING_TOKENS_SAVED.inc(tokens_saved, model=served.name, mode=decoding.mode)
+
+    # Remember the exchange in the client's session
+    if outcome in ("completed", "cached"):
+        question = data.get("message") or messages[-1].get("content", "")
+        update_user_context(session.key, question, is_user=True)
+        update_user_context(session.key, compact_assistant_turn(final_sql, full_response, served.reasoning), is_user=False)
+        await session_store.persist(session)
     
     if token_count > 0 and total_session_time > 0:
         # Calculate metrics
@@ -560,163 +4207,1003 @@ async def handle_chat_request(websocket, data, user_id):
             median_inter_token_time = total_session_time
         
         # Update global metrics
-        token_generation_metrics["total_tokens"] += token_count
-        token_generation_metrics["total_time"] += total_session_time
-        token_generation_metrics["session_times"].append(total_session_time)
-        token_generation_metrics["last_session_tokens"] = token_count
-        token_generation_metrics["last_session_time"] = total_session_time
-        token_generation_metrics["last_session_avg_time_per_token"] = avg_time_per_token
-        
-        # Keep only last 50 session times for rolling average
-        if len(token_generation_metrics["session_times"]) > 50:
-            token_generation_metrics["session_times"] = token_generation_metrics["session_times"][-50:]
+        TOKENS.inc(token_count, model=served.name)
+        GENERATION_TIME.observe(total_session_time, model=served.name)
+        recent_session_times.append(total_session_time)
         
         # Calculate overall averages
-        overall_avg_time_per_token = token_generation_metrics["total_time"] / token_generation_metrics["total_tokens"]
-        rolling_avg_session_time = statistics.mean(token_generation_metrics["session_times"])
+        total_tokens = int(TOKENS.total())
+        total_time = GENERATION_TIME.merged().sum
+        overall_avg_time_per_token = total_time / total_tokens
+        rolling_avg_session_time = statistics.mean(recent_session_times)
         
-        # Log detailed metrics
-        logger.info("=" * 60)
-        logger.info("TOKEN GENERATION METRICS")
-        logger.info("=" * 60)
-        logger.info(f"Session Stats:")
-        logger.info(f"  • Tokens generated: {token_count}")
-        logger.info(f"  • Total time: {total_session_time:.3f}s")
-        logger.info(f"  • Time to first token (TTFT): {ttft:.3f}s" if first_token_time else "  • Time to first token: N/A")
-        logger.info(f"  • Average time per token: {avg_time_per_token:.3f}s")
-        logger.info(f"  • Tokens per second: {tokens_per_second:.2f}")
-        logger.info(f"  • Average inter-token time: {avg_inter_token_time:.3f}s")
-        logger.info(f"  • Median inter-token time: {median_inter_token_time:.3f}s")
-        logger.info(f"Overall Stats:")
-        logger.info(f"  • Total tokens generated: {token_generation_metrics['total_tokens']}")
-        logger.info(f"  • Total generation time: {token_generation_metrics['total_time']:.3f}s")
-        logger.info(f"  • Overall avg time per token: {overall_avg_time_per_token:.3f}s")
-        logger.info(f"  • Overall tokens per second: {token_generation_metrics['total_tokens'] / token_generation_metrics['total_time']:.2f}")
-        logger.info(f"  • Rolling avg session time (last 50): {rolling_avg_session_time:.3f}s")
-        logger.info("=" * 60)
+        logger.info(
+            f"Generated {token_count} tokens with '{served.name}' in {total_session_time:.3f}s "
+            f"({tokens_per_second:.2f} tok/s, TTFT {f'{ttft:.3f}s' if first_token_time else 'n/a'})"
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("=" * 60)
+            logger.debug("TOKEN GENERATION METRICS")
+            logger.debug("=" * 60)
+            logger.debug(f"Session Stats:")
+            logger.debug(f"  • Model: {served.name} ({served.model_id})")
+            logger.debug(f"  • Tokens generated: {token_count}")
+            logger.debug(f"  • Total time: {total_session_time:.3f}s")
+            logger.debug(f"  • Time to first token (TTFT): {ttft:.3f}s" if first_token_time else "  • Time to first token: N/A")
+            logger.debug(f"  • Queue wait: {queue_wait:.3f}s")
+            logger.debug(f"  • Prefix cache: {generation_info.get('prefix_cache', 'n/a')} (TTFT saved: {generation_info.get('ttft_saved', 0.0):.3f}s)")
+            logger.debug(f"  • Average time per token: {avg_time_per_token:.3f}s")
+            logger.debug(f"  • Tokens per second: {tokens_per_second:.2f}")
+            logger.debug(f"  • Average inter-token time: {avg_inter_token_time:.3f}s")
+            logger.debug(f"  • Median inter-token time: {median_inter_token_time:.3f}s")
+            logger.debug(f"Overall Stats:")
+            logger.debug(f"  • Total tokens generated: {total_tokens}")
+            logger.debug(f"  • Total generation time: {total_time:.3f}s")
+            logger.debug(f"  • Overall avg time per token: {overall_avg_time_per_token:.3f}s")
+            logger.debug(f"  • Overall tokens per second: {total_tokens / total_time:.2f}")
+            logger.debug(f"  • Rolling avg session time (last 50): {rolling_avg_session_time:.3f}s")
+            logger.debug("=" * 60)
         
         # Send metrics to client
-        await websocket.send(json.dumps({
+        await send_frame(websocket, {
             "type": "generation_metrics",
             "metrics": {
                 "session": {
+                    "model": served.name,
                     "tokens": token_count,
                     "total_time": round(total_session_time, 3),
                     "avg_time_per_token": round(avg_time_per_token, 3),
                     "tokens_per_second": round(tokens_per_second, 2),
                     "ttft": round(ttft, 3) if first_token_time else None,
+                    "queue_wait": round(queue_wait, 3),
                     "avg_inter_token_time": round(avg_inter_token_time, 3),
-                    "median_inter_token_time": round(median_inter_token_time, 3)
+                    "median_inter_token_time": round(median_inter_token_time, 3),
+                    "frames_sent": coalescer.frames_sent,
+                    "speculative_sql_lead": round(session_end_time - speculation.started_at, 3) if speculation else None,
+                    "prefix_cache": generation_info.get("prefix_cache"),
+                    "ttft_saved": round(generation_info.get("ttft_saved", 0.0), 3),
+                    "decoding_mode": decoding.mode,
+                    "tokens_saved": round(tokens_saved, 1) if tokens_saved is not None else None
                 },
                 "overall": {
-                    "total_tokens": token_generation_metrics["total_tokens"],
-                    "total_time": round(token_generation_metrics["total_time"], 3),
+                    "total_tokens": total_tokens,
+                    "total_time": round(total_time, 3),
                     "avg_time_per_token": round(overall_avg_time_per_token, 3),
-                    "tokens_per_second": round(token_generation_metrics["total_tokens"] / token_generation_metrics["total_time"], 2),
-                    "rolling_avg_session_time": round(rolling_avg_session_time, 3)
+                    "tokens_per_second": round(total_tokens / total_time, 2),
+                    "rolling_avg_session_time": round(rolling_avg_session_time, 3),
+                    "ttft": TTFT.merged().snapshot(),
+                    "inter_token": INTER_TOKEN.merged().snapshot(),
+                    "queue_wait": QUEUE_WAIT.merged().snapshot(),
+                    "prefix_cache": prefix_cache.stats(),
+                    "response_cache": response_cache.stats(),
+                    "decoding_baseline": decoding_baseline.stats(),
+                    "model": get_model_status(),
+                    "models": generation_totals_by_model()
                 }
             }
-        }))
+        })
 
     # Send completion
-    await websocket.send(json.dumps({
+    await send_frame(websocket, {
         "type": "release_hold",
         "content": "Response generation complete"
-    }))
-    await websocket.send(json.dumps({
+    })
+    await send_frame(websocket, {
         "type": "complete",
         "content": full_response
-    }))
+    })
+
+    if trace is not None:
+        trace.update({
+            "prompt_chars": sum(len(m.get("content", "")) for m in messages),
+            "outcome": outcome,
+            "queue_wait": round(queue_wait, 3),
+            "ttft": round(first_token_time - session_start_time, 3) if first_token_time else None,
+            "generation_time": round(total_session_time, 3),
+            "tokens": token_count,
+            "response_chars": len(full_response),
+            "prefix_cache": generation_info.get("prefix_cache"),
+            "decoding_mode": decoding.mode,
+            "sql": TrafficRecorder.mask_sql(final_sql)
+        })
 
     # Handle SQL execution if applicable
-    if full_response and not stop_generation.get(user_id, False):
-        await handle_sql_execution(websocket, full_response, user_id)
-
-async def handle_sql_execution(websocket, response, user_id):
-    """Handle SQL query execution from LLM response"""
-    if not db_manager.pool:
-        sql_query = extract_sql_from_response(response)
-        if sql_query:
-            await websocket.send(json.dumps({
-                "type": "warning",
-                "content": "SQL query detected but database connection is not available"
-            }))
-        return
+    execute_sql = full_response and not stopped and not failed
+    try:
+        if speculation is not None:
+            if execute_sql and final_sql == speculation.sql_query:
+                logger.info(f"Speculative SQL execution started {time.time() - speculation.started_at:.3f}s before generation ended")
+                await speculation.commit(session)
+                return
+            # Stopped, failed, or the model changed its final query after all
+            await speculation.discard()
+            sql_info.clear()
+        if execute_sql:
+            await run_sql_phase(session, websocket, asyncio.create_task(handle_sql_execution(
+                websocket, full_response, session.key, domain=domain, sql_query=final_sql, execution_info=sql_info
+            )), final_sql)
+    finally:
+        if trace is not None:
+            trace["sql_execution"] = sql_info or None
+            await traffic_recorder.write(trace)
+
+class DeferredSender:
+    """Websocket stand-in that holds outgoing frames until released.
+
+    Lets SQL execution start while the model is still streaming without its
+    frames interleaving with the chunk stream; after ``release`` frames pass
+    straight through in their original order.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.subprotocol = getattr(websocket, "subprotocol", None)
+        self._frames = []
+        self._released = False
+
+    async def send(self, message):
+        if self._released:
+            await self.websocket.send(message)
+        else:
+            self._frames.append(message)
+
+    async def release(self):
+        while self._frames:
+            await self.websocket.send(self._frames.pop(0))
+        self._released = True
+
+class SpeculativeSqlExecution:
+    """SQL execution started from a closed SQL block before generation finished"""
+
+    def __init__(self, websocket, sql_query, key, domain, execution_info: Optional[dict] = None):
+        self.sql_query = sql_query
+        # Taken from the real socket: an open result cursor is stored under it for "Load more rows"
+        self.key = key
+        self.started_at = time.time()
+        self.sender = DeferredSender(websocket)
+        self.info = execution_info if execution_info is not None else {}
+        self.task = asyncio.create_task(handle_sql_execution(
+            self.sender, sql_query, key, domain=domain, sql_query=sql_query, execution_info=self.info
+        ))
+
+    async def commit(self, session: Session):
+        """Deliver the buffered frames and let execution finish in place"""
+        await self.sender.release()
+        await run_sql_phase(session, self.sender, self.task, self.sql_query)
+
+    async def discard(self, reason: str = "speculation"):
+        """Cancel execution and drop anything it produced"""
+        if not self.task.done():
+            self.task.cancel(reason)
+        elif not self.task.cancelled():
+            # It already ran to completion for nothing
+            record_abandoned_work("sql", reason, seconds=self.info.get("time") or 0.0)
+        await asyncio.gather(self.task, return_exceptions=True)
+        await close_result_cursor(self.key)
+
+async def run_sql_phase(session: Session, websocket, task: asyncio.Task, sql_query: Optional[str]):
+    """Wait for a request's query, which a stop request may cancel through the session"""
+    session.sql_task = task
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not task.cancelled() or asyncio.current_task().cancelling():
+            raise
+        await send_frame(websocket, {
+            "type": "release_hold",
+            "content": "SQL execution stopped"
+        })
+        await send_frame(websocket, {
+            "type": "sql_result",
+            "query": sql_query,
+            "result": {"success": False, "error": "Query cancelled by user request", "data": None}
+        })
+    finally:
+        session.sql_task = None
 
-    sql_query = extract_sql_from_response(response)
+async def handle_sql_execution(websocket, response, key, domain=None, sql_query=None,
+                               execution_info: Optional[dict] = None):
+    """Handle SQL query execution from LLM response.
+
+    ``key`` is the client's connection_key, which an open result cursor is
+    stored under; ``websocket`` may be a DeferredSender, so the key is not
+    derived from it. ``execution_info`` receives the outcome, duration and
+    result size.
+    """
+    info = execution_info if execution_info is not None else {}
+    sql_query = sql_query or extract_sql_from_response(response)
     if not sql_query:
         return
 
-    await websocket.send(json.dumps({
+    # Only now does the request depend on the database; give a pending connection a chance
+    if db_manager.pool is None and db_manager.is_initializing:
+        await send_frame(websocket, {
+            "type": "status",
+            "content": "Waiting for the database connection..."
+        })
+    if not await db_manager.wait_for_pool(DB_READY_TIMEOUT):
+        info["outcome"] = "unavailable"
+        await send_frame(websocket, {
+            "type": "warning",
+            "content": "SQL query detected but database connection is not available"
+        })
+        return
+
+    await send_frame(websocket, {
         "type": "status",
         "content": "Executing SQL query on database..."
-    }))
-    await websocket.send(json.dumps({
+    })
+    await send_frame(websocket, {
         "type": "hold",
         "content": "Please wait while I execute the SQL query..."
-    }))
+    })
+
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        limits = query_limits_for(domain)
+        cache_key = None
+        if sql_result_cache.enabled and sql_result_cache.cacheable(sql_query):
+            cache_key = sql_result_cache.key_for(sql_query, limits)
+            cached = await sql_result_cache.get(cache_key)
+            if cached is not None:
+                outcome = "cached"
+                await send_frame(websocket, {
+                    "type": "release_hold",
+                    "content": "SQL execution complete"
+                })
+                info["rows"] = len(cached.rows)
+                info["bytes"] = await send_frame(websocket, {
+                    "type": "sql_result",
+                    "query": cached.query,
+                    "result": frame_codec(websocket).result({
+                        "success": True,
+                        "columns": cached.columns,
+                        "data": cached.rows,
+                        "row_count": len(cached.rows),
+                        "cached": True,
+                        "error": None
+                    })
+                })
+                return
+
+        # Vet the generated statement and its planner estimates before it touches a connection for long
+        try:
+            checked = await db_manager.check_query(sql_query, limits)
+        except Exception as e:
+            if isinstance(e, QueryRejected):
+                logger.warning(f"Rejected generated SQL: {e}")
+                outcome = "rejected"
+                rejection = {"success": False, "error": f"❌ Query rejected: {str(e)}", "data": None}
+            else:
+                rejection = db_manager.error_result(e)
+            await send_frame(websocket, {
+                "type": "release_hold",
+                "content": "SQL execution complete"
+            })
+            await send_frame(websocket, {
+                "type": "sql_result",
+                "query": sql_query,
+                "result": rejection
+            })
+            return
+        if checked["rewritten"]:
+            await send_frame(websocket, {
+                "type": "status",
+                "content": f"Query limited to {limits['max_rows']} rows (planner estimated {checked['estimated_rows']} rows)"
+            })
+        sql_query = checked["query"]
+        statement_timeout_ms = limits.get("statement_timeout_ms")
+
+        cache_token = None
+        if cache_key is not None and checked["is_read"]:
+            relations = checked["relations"]
+            if relations is None:
+                try:
+                    relations = (await db_manager.explain_query(sql_query, statement_timeout_ms))["relations"]
+                except Exception:
+                    pass  # the query itself reports the error
+            cache_token = await sql_result_cache.begin(relations)
+
+        if SQL_STREAM_RESULTS and checked["is_read"]:
+            records = [] if cache_token is not None else None
+            streamed = await execute_streaming_query(
+                websocket, sql_query, key,
+                statement_timeout_ms=statement_timeout_ms, read_only=checked["read_only"], info=info,
+                records=records
+            )
+            outcome = "ok" if streamed else "error"
+            if streamed and records is not None and info.get("truncated") is False:
+                columns = list(records[0].keys()) if records else []
+                sql_result_cache.put(cache_key, cache_token, sql_query, columns, records, info["bytes"])
+            return
+
+        try:
+            query_result = await db_manager.execute_query(
+                sql_query, statement_timeout_ms=statement_timeout_ms, read_only=checked["read_only"]
+            )
+            outcome = "ok" if query_result.get("success") else "error"
+            await send_frame(websocket, {
+                "type": "release_hold",
+                "content": "SQL execution complete"
+            })
+            info["rows"] = query_result.get("row_count") or 0
+            info["bytes"] = await send_frame(websocket, {
+                "type": "sql_result",
+                "query": sql_query,
+                "result": frame_codec(websocket).result(query_result)
+            })
+            if query_result.get("success") and sql_result_cache.enabled:
+                if checked["is_read"]:
+                    sql_result_cache.put(
+                        cache_key, cache_token, sql_query, query_result["columns"], query_result["data"], info["bytes"]
+                    )
+                else:
+                    await sql_result_cache.publish(checked["relations"])
+        except Exception as e:
+            logger.error(f"SQL execution error: {e}")
+            await send_frame(websocket, {
+                "type": "release_hold",
+                "content": "SQL execution failed"
+            })
+            await send_frame(websocket, {
+                "type": "sql_error",
+                "query": sql_query,
+                "error": str(e)
+            })
+    except asyncio.CancelledError as e:
+        # asyncpg sends the server a cancel request for the running statement and the
+        # connection goes back to the pool as the context managers unwind
+        outcome = "cancelled"
+        record_abandoned_work("sql", cancel_reason(e), seconds=time.perf_counter() - started)
+        raise
+    finally:
+        info["outcome"] = outcome
+        info["time"] = round(time.perf_counter() - started, 3)
+        SQL_EXECUTION.observe(time.perf_counter() - started, domain=domain or "unknown", outcome=outcome)
+        if outcome not in ("ok", "cached", "cancelled"):
+            ERRORS.inc(kind="sql_rejected" if outcome == "rejected" else "sql")
+
+def connection_key(websocket, user_id) -> str:
+    """Key per-client state on the user id, falling back to the socket (and process, since
+    worker processes share persisted sessions)"""
+    return user_id or f"connection-{os.getpid()}-{id(websocket)}"
+
+def stop_session(session: Session) -> Optional[str]:
+    """Stop a client's generation, taking it out of the queue if it has no slot yet, or cancel
+    the query it is running; returns which of the two was running, if any"""
+    running = session.request_stop()
+    if running == "generation":
+        for served in model_registry.models.values():
+            served.scheduler.withdraw(session.key)
+    return running
 
+async def close_result_cursor(key: str):
+    """Release the open result cursor for a client, if any"""
+    result_cursor = open_result_cursors.pop(key, None)
+    if result_cursor:
+        await result_cursor.close()
+
+async def execute_streaming_query(websocket, sql_query, key, statement_timeout_ms=None, read_only=False,
+                                  info: Optional[dict] = None, records: Optional[list] = None) -> bool:
+    """Run a SELECT through a server-side cursor and stream the first pages; False if it failed to open"""
+    await close_result_cursor(key)
     try:
-        query_result = await db_manager.execute_query(sql_query)
-        await websocket.send(json.dumps({
+        result_cursor = await db_manager.open_cursor(
+            sql_query, statement_timeout_ms=statement_timeout_ms, read_only=read_only
+        )
+    except Exception as e:
+        await send_frame(websocket, {
             "type": "release_hold",
             "content": "SQL execution complete"
-        }))
-        await websocket.send(json.dumps({
-            "type": "sql_result", 
+        })
+        await send_frame(websocket, {
+            "type": "sql_result",
             "query": sql_query,
-            "result": query_result
-        }))
+            "result": db_manager.error_result(e)
+        })
+        return False
+
+    await send_frame(websocket, {
+        "type": "release_hold",
+        "content": "SQL execution complete"
+    })
+    await stream_result_pages(websocket, result_cursor, key, info, records)
+    return True
+
+async def stream_result_pages(websocket, result_cursor: ResultCursor, key: str, info: Optional[dict] = None,
+                             records: Optional[list] = None):
+    """Send ``sql_result_chunk`` pages until the result ends or the row/byte budget is spent.
+
+    When the budget runs out first, the cursor stays open and the last frame
+    has ``truncated`` set; the client can send a ``fetch_next_page`` action
+    with the ``cursor_id`` to continue. ``info`` receives the rows and bytes
+    sent, and ``records`` the fetched records.
+    """
+    codec = frame_codec(websocket)
+    rows_sent = 0
+    bytes_sent = 0
+    try:
+        while True:
+            page_size = max(1, min(QUERY_PAGE_SIZE, QUERY_MAX_ROWS - rows_sent))
+            page = await result_cursor.fetch_page(page_size)
+            if records is not None:
+                records.extend(page)
+            rows = codec.rows(page)
+            payload = {
+                "type": "sql_result_chunk",
+                "query": result_cursor.query,
+                "cursor_id": result_cursor.cursor_id,
+                "page": result_cursor.pages_sent + 1,
+                "columns": result_cursor.columns or [],
+                "rows": rows,
+                "rows_sent": result_cursor.rows_sent + len(rows),
+                "done": result_cursor.exhausted,
+                "truncated": False
+            }
+            frame = codec.encode(payload)
+            rows_sent += len(rows)
+            bytes_sent += len(frame)
+            result_cursor.rows_sent += len(rows)
+            result_cursor.pages_sent += 1
+            budget_spent = rows_sent >= QUERY_MAX_ROWS or bytes_sent >= QUERY_MAX_BYTES
+            if not result_cursor.exhausted and budget_spent:
+                payload["truncated"] = True
+                frame = codec.encode(payload)
+            await websocket.send(frame)
+            if result_cursor.exhausted or budget_spent:
+                break
+    except asyncio.CancelledError:
+        # Not kept for fetch_next_page: release the connection now
+        open_result_cursors.pop(key, None)
+        await result_cursor.close()
+        raise
     except Exception as e:
-        logger.error(f"SQL execution error: {e}")
-        await websocket.send(json.dumps({
-            "type": "release_hold",
-            "content": "SQL execution failed"
-        }))
-        await websocket.send(json.dumps({
-            "type": "sql_error",
-            "query": sql_query,
-            "error": str(e)
-        }))
+        logger.error(f"SQL streaming error: {e}")
+        if info is not None:
+            info.update(rows=rows_sent, bytes=bytes_sent)
+        open_result_cursors.pop(key, None)
+        await result_cursor.close()
+        await send_frame(websocket, {
+            "type": "sql_result",
+            "query": result_cursor.query,
+            "result": db_manager.error_result(e)
+        })
+        return
+
+    if info is not None:
+        info.update(rows=rows_sent, bytes=bytes_sent, truncated=not result_cursor.exhausted)
+    if result_cursor.exhausted:
+        open_result_cursors.pop(key, None)
+        await result_cursor.close()
+    else:
+        open_result_cursors[key] = result_cursor
+
+async def handle_fetch_next_page(websocket, data, key):
+    """Continue streaming an open, truncated result"""
+    result_cursor = open_result_cursors.get(key)
+    if not result_cursor or result_cursor.cursor_id != data.get("cursor_id"):
+        await send_frame(websocket, {
+            "type": "warning",
+            "content": "This result is no longer available. Please run the query again."
+        })
+        return
+    await stream_result_pages(websocket, result_cursor, key)
+
+async def handle_configure_pool(websocket, data):
+    """Apply runtime pool settings sent by an operator holding DB_ADMIN_TOKEN"""
+    token = data.get("token") or ""
+    if not DB_ADMIN_TOKEN or not hmac.compare_digest(str(token), DB_ADMIN_TOKEN):
+        await send_frame(websocket, {
+            "type": "error",
+            "content": "Not authorized to configure the database pool"
+        })
+        return
+    try:
+        await db_manager.reconfigure_pool(**data.get("settings", {}))
+    except Exception as e:
+        await send_frame(websocket, {
+            "type": "error",
+            "content": f"Pool configuration failed: {str(e)}"
+        })
+        return
+    await send_frame(websocket, {
+        "type": "status",
+        "content": "Database pool reconfigured",
+        "pool_status": await db_manager.get_pool_status()
+    })
+
+async def handle_configure_model(websocket, data):
+    """Change models, routing or the idle policy (operator holding MODEL_ADMIN_TOKEN).
+
+    ``settings`` may contain idle_timeout, soft_idle_timeout, routes,
+    default_model, and model (a registry name, default model if omitted)
+    with model_repo/model_file to point that entry at other weights.
+    """
+    global IDLE_TIMEOUT, MODEL_SOFT_IDLE_TIMEOUT
+    token = data.get("token") or ""
+    if not MODEL_ADMIN_TOKEN or not hmac.compare_digest(str(token), MODEL_ADMIN_TOKEN):
+        await send_frame(websocket, {
+            "type": "error",
+            "content": "Not authorized to configure the model"
+        })
+        return
+    settings = data.get("settings", {})
+    try:
+        idle_timeout = float(settings.get("idle_timeout", IDLE_TIMEOUT))
+        soft_idle_timeout = float(settings.get("soft_idle_timeout", MODEL_SOFT_IDLE_TIMEOUT))
+        if idle_timeout <= 0 or soft_idle_timeout <= 0:
+            raise ValueError("idle timeouts must be positive")
+        IDLE_TIMEOUT, MODEL_SOFT_IDLE_TIMEOUT = idle_timeout, soft_idle_timeout
+
+        if "routes" in settings:
+            model_registry.routes = dict(settings["routes"])
+        if "default_model" in settings:
+            model_registry.default_name = model_registry.get(settings["default_model"]).name
+
+        model = model_registry.get(settings.get("model") or model_registry.default_name)
+        new_repo = settings.get("model_repo", model.repo)
+        new_file = settings.get("model_file", model.filename)
+        if (new_repo, new_file) != (model.repo, model.filename):
+            logger.info(f"Switching model '{model.name}' to {new_repo}/{new_file}")
+            previous = (model.repo, model.filename)
+            was_loaded = model.is_loaded
+            # Requests already decoding keep their instance until they finish
+            await model.unload()
+            model.repo, model.filename = new_repo, new_file
+            model.size_bytes = 0
+            try:
+                if was_loaded:
+                    await model_registry.ensure_loaded(model)
+            except Exception:
+                await model.unload()
+                model.repo, model.filename = previous
+                await model_registry.ensure_loaded(model)
+                raise
+    except Exception as e:
+        await send_frame(websocket, {
+            "type": "error",
+            "content": f"Model configuration failed: {str(e)}"
+        })
+        return
+    await send_frame(websocket, {
+        "type": "status",
+        "content": "Model reconfigured",
+        "model_status": get_model_status()
+    })
+
+async def monitor_sessions():
+    """Expire idle sessions"""
+    while True:
+        await asyncio.sleep(max(1.0, min(60.0, SESSION_TTL / 2)))
+        await session_store.expire()
+
+async def monitor_control_state():
+    """Apply stop requests that other workers recorded for generations running here, and
+    stop this worker if its supervisor is gone"""
+    while True:
+        await asyncio.sleep(CONTROL_POLL_INTERVAL)
+        if SUPERVISOR_PID is not None and os.getppid() != SUPERVISOR_PID:
+            logger.warning("Supervisor exited; shutting down")
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        if not session_store.any_busy():
+            continue
+        try:
+            keys = await asyncio.to_thread(control_store.stop_requests, WORKER_INDEX)
+        except Exception as e:
+            logger.warning(f"Could not read stop requests: {e}")
+            continue
+        for key in keys:
+            session = session_store.peek(key)
+            if session is not None and session.busy:
+                stop_session(session)
+
+async def monitor_result_cursors():
+    """Close result cursors that have been left idle"""
+    while True:
+        await asyncio.sleep(max(1.0, QUERY_CURSOR_IDLE_TIMEOUT / 2))
+        now = time.time()
+        for key, result_cursor in list(open_result_cursors.items()):
+            if now - result_cursor.last_used > QUERY_CURSOR_IDLE_TIMEOUT:
+                logger.info(f"Closing idle result cursor {result_cursor.cursor_id}")
+                await close_result_cursor(key)
+
+def collect_runtime_metrics():
+    """Copy live model, pool and cache state into the metrics registry before it is rendered"""
+    for name, model in model_registry.models.items():
+        metrics.gauge("model_resident", "1 while a model has weights loaded", ("model",)).set(int(model.is_loaded), model=name)
+        metrics.gauge("model_busy_slots", "Inference slots currently generating", ("model",)).set(model.scheduler.busy_slots, model=name)
+        metrics.gauge("model_queue_depth", "Requests waiting for an inference slot", ("model",)).set(model.scheduler.queue_depth, model=name)
+        metrics.histogram("model_load_seconds", "Model load time", ("model",)).attach(model.load_time, model=name)
+        metrics.histogram("model_unload_seconds", "Model soft and full unload time", ("model",)).attach(model.unload_time, model=name)
+
+    metrics.histogram("db_pool_acquire_seconds", "Time waiting for a pooled connection").attach(db_manager.acquire_wait)
+    metrics.histogram("db_query_seconds", "Database query latency").attach(db_manager.query_latency)
+    metrics.gauge("db_pool_ready", "1 while the database pool is available").set(int(db_manager.pool is not None))
+    metrics.gauge("db_connections_in_use", "Pooled connections checked out").set(db_manager.limiter.in_use)
+    metrics.gauge("db_connection_limit", "Current adaptive connection limit").set(db_manager.limiter.limit)
+    metrics.gauge("db_acquire_waiters", "Callers waiting for a pooled connection").set(db_manager.limiter.waiters)
+
+    cache_events = metrics.counter("cache_events_total", "Cache lookups by cache and result", ("cache", "result"))
+    prefix_stats = prefix_cache.stats()
+    cache_events.set(prefix_stats["hits"], cache="prefix", result="hit")
+    cache_events.set(prefix_stats["misses"], cache="prefix", result="miss")
+    response_stats = response_cache.stats()
+    cache_events.set(response_stats["hits"], cache="response", result="hit")
+    cache_events.set(response_stats["near_hits"], cache="response", result="near_hit")
+    cache_events.set(response_stats["misses"], cache="response", result="miss")
+    sql_stats = sql_result_cache.stats()
+    cache_events.set(sql_stats["hits"], cache="sql", result="hit")
+    cache_events.set(sql_stats["misses"], cache="sql", result="miss")
+    cache_events.set(sql_stats["stale"], cache="sql", result="stale")
+    metrics.counter("sql_cache_invalidations_total", "Cached SQL results dropped because a table changed").set(sql_stats["invalidations"])
+    metrics.gauge("sql_cache_entries", "Cached SQL results").set(sql_stats["entries"])
+    metrics.gauge("sql_cache_bytes", "Frame bytes of the cached SQL results").set(sql_stats["bytes"])
+    metrics.gauge("sql_cache_listening", "1 while the SQL cache receives table change notifications").set(int(sql_stats["listening"]))
+    metrics.gauge("open_result_cursors", "Truncated SQL results held open for paging").set(len(open_result_cursors))
+    session_stats = session_store.stats()
+    metrics.gauge("sessions", "Client sessions held in memory").set(session_stats["sessions"])
+    metrics.counter("session_evictions_total", "Sessions evicted by the size cap").set(session_stats["evictions"])
+    metrics.counter("session_expirations_total", "Sessions expired by the idle TTL").set(session_stats["expirations"])
+    if traffic_recorder.path:
+        metrics.counter("traffic_recorded_total", "Requests appended to the traffic recording").set(traffic_recorder.recorded)
+        metrics.counter("traffic_record_failures_total", "Requests that could not be recorded").set(traffic_recorder.failures)
+
+metrics.add_collector(collect_runtime_metrics)
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, render=None):
+    """Minimal HTTP/1.0 responder for GET /metrics; ``render`` replaces this process's registry"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Skip the headers; nothing in them matters here
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] in ("GET", "HEAD") and parts[1].split("?")[0] == "/metrics":
+            status = "200 OK"
+            body = (await render() if render else metrics.render()).encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+            content_type = "text/plain; charset=utf-8"
+        headers = (
+            f"HTTP/1.0 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1")
+        writer.write(headers if parts and parts[0] == "HEAD" else headers + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
 
 def update_user_context(user_id, message, is_user=True):
     """Update user context with new message"""
+    session = session_store.peek(user_id)
+    if session is None:
+        return
     role = "user" if is_user else "assistant"
-    user_contexts[user_id].append({"role": role, "content": message})
-    if len(user_contexts[user_id]) > MAX_CONTEXT_MESSAGES:
-        user_contexts[user_id] = user_contexts[user_id][-MAX_CONTEXT_MESSAGES:]
+    session.messages.append({"role": role, "content": message[:SESSION_MAX_MESSAGE_CHARS]})
+    if len(session.messages) > MAX_CONTEXT_MESSAGES:
+        del session.messages[:-MAX_CONTEXT_MESSAGES]
 
 def get_context_messages(user_id):
     """Get context messages for user"""
-    return user_contexts[user_id]
+    session = session_store.peek(user_id)
+    return [{"role": m["role"], "content": m["content"]} for m in session.messages] if session is not None else []
+
+def compact_assistant_turn(sql: Optional[str], response: str, reasoning: bool = True) -> str:
+    """What an answer contributes to later prompts: its final SQL, without the reasoning"""
+    if not sql:
+        return response[:SESSION_MAX_MESSAGE_CHARS]
+    if reasoning:
+        return f"<final_sql_query_start>\n{sql}\n<final_sql_query_end>"
+    return f"```sql\n{sql}\n```"
+
+def _message_tokens(model, message: dict) -> int:
+    tokens = message.get("tokens")
+    if tokens is None:
+        # A few extra tokens for the chat template's role header and end-of-turn marker
+        tokens = message["tokens"] = model.count_tokens(message.get("content", "")) + 4
+    return tokens
+
+def summarize_turns(messages: list, budget: int, model) -> Optional[dict]:
+    """Fold dropped turns into one recap message of earlier questions and their SQL"""
+    turns = []
+    for message in messages:
+        line = f"{'Q' if message['role'] == 'user' else 'A'}: {' '.join(message['content'].split())[:300]}"
+        if message["role"] == "user" or not turns:
+            turns.append([line])
+        else:
+            turns[-1].append(line)
+    kept = []
+    for turn in reversed(turns):
+        cost = sum(model.count_tokens(line) + 1 for line in turn)
+        if cost > budget:
+            break
+        kept.append("\n".join(turn))
+        budget -= cost
+    if not kept:
+        return None
+    return {"role": "user", "content": "Earlier in this conversation:\n" + "\n".join(reversed(kept))}
+
+def prompt_token_budget(model, max_tokens: int) -> int:
+    """Tokens a prompt may use: PROMPT_TOKEN_BUDGET, capped by what the model's context window
+    leaves after the answer"""
+    return min(PROMPT_TOKEN_BUDGET, model.context_size() - max_tokens)
+
+def fit_prompt_messages(messages: list, new_turn: int, model, budget: int) -> list:
+    """System prompt + the most recent history that fits the token budget + the new turn
+    (the last ``new_turn`` messages).
+
+    The system prompt always comes first and unchanged, so prompt prefix
+    caching keeps working however much history is trimmed. Turns are
+    dropped oldest first and never split. The system prompt and the new turn
+    are always sent, even when they alone exceed the budget.
+    """
+    split = len(messages) - new_turn
+    system = [m for m in messages[:split] if m.get("role") == "system"]
+    history = [m for m in messages[:split] if m.get("role") != "system"]
+    new_messages = messages[split:]
+    budget -= sum(_message_tokens(model, m) for m in system + new_messages)
+
+    kept = []
+    for message in reversed(history):
+        cost = _message_tokens(model, message)
+        if cost > budget:
+            break
+        kept.append(message)
+        budget -= cost
+    kept.reverse()
+    while kept and kept[0]["role"] != "user":
+        budget += _message_tokens(model, kept.pop(0))
+
+    prompt = list(system)
+    dropped = history[:len(history) - len(kept)]
+    if dropped and CONTEXT_SUMMARIZE and budget > 0:
+        summary = summarize_turns(dropped, budget, model)
+        if summary is not None:
+            prompt.append(summary)
+    prompt.extend(kept)
+    prompt.extend(new_messages)
+    return [{"role": m.get("role"), "content": m.get("content", "")} for m in prompt]
+
+def serve_websocket(host: str = "0.0.0.0", port: int = 8000, reuse_port: bool = False):
+    """Start the chat websocket server with its keepalive, compression and framing settings"""
+    return websockets.serve(
+        handle_connection,
+        host,
+        port,
+        ping_interval=20,
+        ping_timeout=10,
+        compression=None,
+        extensions=websocket_extensions(),
+        subprotocols=list(FRAME_CODECS),
+        select_subprotocol=select_subprotocol,
+        reuse_port=reuse_port
+    )
 
 async def main():
     """Main server function"""
-    # Initialize database connection
-    try:
-        await db_manager.initialize_pool()
-        pool_status = await db_manager.get_pool_status()
-        logger.info(f"Database connection established successfully. Status: {pool_status}")
-    except Exception as e:
-        logger.warning(f"Could not initialize database connection: {e}")
+    # Initialize database connection in the background; the server accepts clients right away
+    if db_manager.ensure_pool_started() is None:
+        logger.warning("POSTGRES_CONNECTION_STRING is not set")
         logger.info("Server will continue without database functionality")
 
-    # Start idle monitoring
+    # Load the model up front so the first client does not pay for it
+    if MODEL_EAGER_LOAD:
+        eager_load = asyncio.create_task(load_model())
+        eager_load.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    # Expose metrics next to the websocket server. Workers listen on a private port that the
+    # supervisor scrapes and serves on METRICS_PORT.
+    metrics_server = None
+    metrics_port = None
+    if METRICS_PORT:
+        host, port = ("127.0.0.1", 0) if control_store is not None else (METRICS_HOST, METRICS_PORT)
+        try:
+            metrics_server = await asyncio.start_server(handle_metrics_request, host, port)
+            metrics_port = metrics_server.sockets[0].getsockname()[1]
+            logger.info(f"Metrics available at http://{host}:{metrics_port}/metrics")
+        except OSError as e:
+            logger.warning(f"Metrics endpoint disabled: {e}")
+    if control_store is not None:
+        await asyncio.to_thread(control_store.clear_worker, WORKER_INDEX)
+        await asyncio.to_thread(control_store.register_worker, WORKER_INDEX, os.getpid(), metrics_port)
+        asyncio.create_task(monitor_control_state())
+
+    # Start idle and health monitoring
     asyncio.create_task(monitor_idle_time())
+    asyncio.create_task(monitor_result_cursors())
+    asyncio.create_task(monitor_sessions())
+    asyncio.create_task(db_manager.monitor_health())
+    if sql_result_cache.enabled and db_manager.connection_string:
+        asyncio.create_task(sql_result_cache.listen())
+    if DB_POOL_ADAPTIVE:
+        asyncio.create_task(db_manager.adapt_pool_size())
 
-    # Start WebSocket server
+    # Start WebSocket server; SIGTERM closes it so the pool and models shut down cleanly
     try:
-        server = await websockets.serve(
-            handle_connection, 
-            "0.0.0.0", 
-            8000,
-            ping_interval=20,
-            ping_timeout=10
-        )
-        logger.info("WebSocket server listening on ws://0.0.0.0:8000")
+        server = await serve_websocket(SERVER_HOST, SERVER_PORT, reuse_port=control_store is not None)
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        except NotImplementedError:
+            pass
+        logger.info(f"WebSocket server listening on ws://{SERVER_HOST}:{SERVER_PORT}")
         await server.wait_closed()
     finally:
+        if metrics_server is not None:
+            metrics_server.close()
         await db_manager.close_pool()
+        model_registry.shutdown()
+
+def run_worker(index: int):
+    """Entry point of a worker process started by the supervisor"""
+    global WORKER_INDEX, SUPERVISOR_PID
+    WORKER_INDEX = index
+    SUPERVISOR_PID = os.getppid()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+def _add_worker_label(line: str, worker: int) -> str:
+    brace = line.find("{")
+    space = line.rfind(" ")
+    if 0 <= brace < space:
+        return f'{line[:brace + 1]}worker="{worker}",{line[brace + 1:]}'
+    return f'{line[:space]}{{worker="{worker}"}}{line[space:]}'
+
+def _sample_value(text: str):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def merge_worker_metrics(pages: Dict[int, str]) -> str:
+    """Combine the metric pages of several workers.
+
+    Counters and histograms are summed series by series, so the merged page
+    reads like one server's. Gauges (model state, pool size, queue depth) are
+    point-in-time values that do not add up; each worker's sample is kept with
+    a worker label instead.
+    """
+    families: "OrderedDict[str, tuple]" = OrderedDict()
+    kinds: Dict[str, str] = {}
+    for worker, page in sorted(pages.items()):
+        name = None
+        for line in page.splitlines():
+            if line.startswith("# "):
+                parts = line.split(" ", 3)
+                name = parts[2]
+                header, _samples = families.setdefault(name, ([], {}))
+                if line not in header:
+                    header.append(line)
+                if parts[1] == "TYPE" and len(parts) > 3:
+                    kinds[name] = parts[3]
+            elif line and name is not None:
+                samples = families[name][1]
+                if kinds.get(name) in ("counter", "histogram"):
+                    series, _, value = line.rpartition(" ")
+                    samples[series] = samples.get(series, 0) + _sample_value(value)
+                else:
+                    samples[_add_worker_label(line, worker)] = None
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(line if value is None else f"{line} {value}" for line, value in samples.items())
+    return "\n".join(lines) + "\n"
+
+async def scrape_worker_metrics(port: int) -> str:
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 2)
+    try:
+        writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 5)
+    finally:
+        writer.close()
+    return response.split(b"\r\n\r\n", 1)[-1].decode("utf-8")
+
+async def supervise(workers: int):
+    """Run ``workers`` server processes on one port, restart the ones that exit and serve
+    their combined metrics"""
+    global control_store
+    path = CONTROL_STORE_PATH or os.path.join(tempfile.gettempdir(), f"edgequery-control-{os.getpid()}.sqlite")
+    # Workers are spawned fresh and read the control file location from the environment
+    os.environ["CONTROL_STORE_PATH"] = path
+    control_store = ControlStore(path)
+    await asyncio.to_thread(control_store.reset)
+
+    supervisor_metrics = MetricsRegistry()
+    alive = supervisor_metrics.gauge("workers_alive", "Worker processes running")
+    restarts = supervisor_metrics.counter("worker_restarts_total", "Worker processes restarted after exiting")
+
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    started = {}
+    backoff = {index: 1.0 for index in range(workers)}
+
+    def start(index: int):
+        process = context.Process(target=run_worker, args=(index,), name=f"edgequery-worker-{index}")
+        process.start()
+        processes[index] = process
+        started[index] = time.time()
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    async def render() -> str:
+        pages = {}
+        for index, _pid, port in await asyncio.to_thread(control_store.workers):
+            if port:
+                try:
+                    pages[index] = await scrape_worker_metrics(port)
+                except (OSError, asyncio.TimeoutError, UnicodeDecodeError) as e:
+                    logger.warning(f"Could not scrape metrics from worker {index}: {e}")
+        alive.set(sum(process.is_alive() for process in processes.values()))
+        return supervisor_metrics.render() + merge_worker_metrics(pages)
+
+    metrics_server = None
+    if METRICS_PORT:
+        try:
+            metrics_server = await asyncio.start_server(
+                partial(handle_metrics_request, render=render), METRICS_HOST, METRICS_PORT
+            )
+            logger.info(f"Metrics for all workers available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.warning(f"Metrics endpoint disabled: {e}")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    for index in range(workers):
+        start(index)
+    logger.info(f"Supervising {workers} workers on ws://{SERVER_HOST}:{SERVER_PORT}")
+    try:
+        while not stopping.is_set():
+            for index, process in list(processes.items()):
+                if process.is_alive() or process.exitcode is None:
+                    continue
+                # Crash loops back off; a worker that ran for a while restarts right away
+                if time.time() - started[index] > 60:
+                    backoff[index] = 1.0
+                delay = backoff[index]
+                backoff[index] = min(delay * 2, 60.0)
+                logger.warning(f"Worker {index} exited with code {process.exitcode}; restarting in {delay:.0f}s")
+                await asyncio.to_thread(control_store.clear_worker, index)
+                restarts.inc()
+                del processes[index]
+                loop.call_later(delay, lambda index=index: stopping.is_set() or start(index))
+            try:
+                await asyncio.wait_for(stopping.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        logger.info("Stopping workers")
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            await asyncio.to_thread(process.join, 15)
+            if process.is_alive():
+                process.kill()
+        if metrics_server is not None:
+            metrics_server.close()
+        if not CONTROL_STORE_PATH:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if SERVER_WORKERS > 1:
+        asyncio.run(supervise(SERVER_WORKERS))
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,13 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+try:
+    import llama_cpp  # noqa: F401
+except ImportError:
+    # server.py imports llama_cpp at module level; the benchmark stub stands in without a model
+    from pipeline_bench import install_stub_llama
+    install_stub_llama()
@@ -0,0 +1,748 @@
+import asyncio
+import datetime
+import decimal
+import json
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+import server
+
+class IdleModel:
+    """Just enough of ServedModel for the idle monitor"""
+
+    def __init__(self, idle: float):
+        self.busy = False
+        self.is_loading = False
+        self.state = "loaded"
+        self.last_activity = asyncio.get_event_loop().time() - idle
+
+    async def soft_unload(self):
+        self.state = "soft"
+
+    async def unload(self):
+        self.state = "unloaded"
+
+@pytest.fixture
+def idle_models(monkeypatch):
+    monkeypatch.setattr(server, "session_store", server.SessionStore(16, 60))
+    monkeypatch.setattr(server, "MODEL_IDLE_CHECK_INTERVAL", 0)
+    monkeypatch.setattr(server, "MODEL_SOFT_IDLE_TIMEOUT", 10)
+    monkeypatch.setattr(server, "IDLE_TIMEOUT", 100)
+    models = OrderedDict()
+    monkeypatch.setattr(server.model_registry, "models", models)
+    return models
+
+async def run_idle_monitor_once():
+    monitor = asyncio.create_task(server.monitor_idle_time())
+    for _ in range(5):
+        await asyncio.sleep(0)
+    monitor.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await monitor
+
+def test_idle_monitor_unloads_idle_models(idle_models):
+    async def run():
+        idle_models["soft"] = IdleModel(idle=50)
+        idle_models["full"] = IdleModel(idle=500)
+        idle_models["recent"] = IdleModel(idle=1)
+        await run_idle_monitor_once()
+        return {name: model.state for name, model in idle_models.items()}
+
+    assert asyncio.run(run()) == {"soft": "soft", "full": "unloaded", "recent": "loaded"}
+
+def test_idle_monitor_waits_while_a_session_is_busy(idle_models):
+    async def run():
+        idle_models["full"] = IdleModel(idle=500)
+        session = server.Session("user")
+        session.generating = True
+        server.session_store._sessions["user"] = session
+        await run_idle_monitor_once()
+        return idle_models["full"].state
+
+    assert asyncio.run(run()) == "loaded"
+
+@pytest.fixture
+def cost_gate(monkeypatch):
+    """check_query with the planner replaced by fixed estimates; returns the EXPLAINed queries"""
+    explained = []
+
+    async def explain_query(query, statement_timeout_ms=None):
+        explained.append(query)
+        rows = 10 if query.startswith("SELECT * FROM (") else 5000
+        return {"cost": 100.0, "rows": rows, "relations": ["public.sales"], "writes": False}
+
+    monkeypatch.setattr(server, "SQL_COST_GATE", True)
+    monkeypatch.setattr(server.db_manager, "explain_query", explain_query)
+    return explained
+
+def test_check_query_wraps_a_statement_that_has_its_own_limit(cost_gate):
+    statement = "SELECT region, volume FROM sales ORDER BY volume DESC LIMIT 5000"
+    checked = asyncio.run(server.db_manager.check_query(statement + ";", {"max_rows": 100}))
+
+    assert checked["rewritten"]
+    assert checked["query"] == f"SELECT * FROM (\n{statement}\n) AS limited LIMIT 100"
+    assert cost_gate == [statement, checked["query"]]
+
+@pytest.mark.skipif(not server.POSTGRES_CONNECTION_STRING, reason="needs POSTGRES_CONNECTION_STRING")
+def test_limited_statement_with_limit_offset_and_fetch_parses():
+    async def run():
+        await server.db_manager.initialize_pool()
+        try:
+            return await server.db_manager.check_query(
+                "SELECT g FROM generate_series(1, 100000) g ORDER BY g OFFSET 5 FETCH FIRST 50000 ROWS ONLY",
+                {"max_rows": 10}
+            )
+        finally:
+            await server.db_manager.close_pool()
+
+    checked = asyncio.run(run())
+    assert checked["rewritten"] and checked["query"].endswith(") AS limited LIMIT 10")
+
+@pytest.mark.parametrize("query, keyword", [
+    ("WITH d AS (DELETE FROM sales RETURNING *) SELECT * FROM d", "DELETE"),
+    ("WITH n AS (SELECT 1 AS id) INSERT INTO sales (id) SELECT id FROM n", "INSERT"),
+    ("SELECT * INTO sales_copy FROM sales", "SELECT INTO"),
+])
+def test_reads_that_write_are_classified_as_writes(monkeypatch, query, keyword):
+    monkeypatch.setattr(server, "SQL_ALLOW_WRITES", False)
+    with pytest.raises(server.QueryRejected):
+        server.classify_sql(query)
+    monkeypatch.setattr(server, "SQL_ALLOW_WRITES", True)
+    assert server.classify_sql(query) == (query, keyword)
+
+@pytest.mark.parametrize("query", [
+    "WITH top AS (SELECT * FROM sales ORDER BY volume DESC LIMIT 5) SELECT * FROM top",
+    "SELECT 'insert into' AS note, \"update\" FROM sales",
+    "SELECT * FROM sales FOR UPDATE",
+    "SELECT * FROM sales FOR NO KEY UPDATE",
+])
+def test_plain_reads_stay_reads(query):
+    assert server.classify_sql(query)[1] in server.READ_STATEMENTS
+
+def test_check_query_treats_a_modifying_plan_as_a_write(monkeypatch):
+    # A write the keyword scan cannot see is still caught from the plan's ModifyTable node
+    async def explain_query(query, statement_timeout_ms=None):
+        return {"cost": 100.0, "rows": 5000, "relations": ["public.sales"], "writes": True}
+
+    monkeypatch.setattr(server, "SQL_COST_GATE", True)
+    monkeypatch.setattr(server.db_manager, "explain_query", explain_query)
+    monkeypatch.setattr(server, "SQL_ALLOW_WRITES", False)
+    with pytest.raises(server.QueryRejected):
+        asyncio.run(server.db_manager.check_query("SELECT * FROM sales", {}))
+    monkeypatch.setattr(server, "SQL_ALLOW_WRITES", True)
+    checked = asyncio.run(server.db_manager.check_query("SELECT * FROM sales", {"max_rows": 100}))
+    assert not checked["is_read"] and not checked["read_only"] and not checked["rewritten"]
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM sales", True),
+    ("WITH top AS (SELECT 1) SELECT * FROM top", True),
+    ("UPDATE sales SET volume = 0", False),
+    ("WITH d AS (DELETE FROM sales RETURNING *) SELECT * FROM d", False),
+    ("SELECT 1; SELECT 2", False),
+])
+def test_only_reads_are_run_speculatively(monkeypatch, query, expected):
+    monkeypatch.setattr(server, "SQL_ALLOW_WRITES", True)
+    assert server.is_read_statement(query) is expected
+
+def test_escape_strings_do_not_hide_a_second_statement(monkeypatch):
+    monkeypatch.setattr(server, "SQL_ALLOW_WRITES", True)
+    query = "UPDATE t SET a = E'\\''; DROP TABLE x; SELECT '"
+    assert server.split_sql_statements(query)[:2] == ["UPDATE t SET a = E'\\''", "DROP TABLE x"]
+    with pytest.raises(server.QueryRejected):
+        server.classify_sql(query)
+
+def test_escape_strings_are_skipped_when_looking_for_writes():
+    assert server.data_modifying_keyword("SELECT e'it\\'s a delete' AS note FROM sales") is None
+    assert server.data_modifying_keyword("WITH d AS (DELETE FROM t WHERE a = E'\\'') SELECT 1") == "DELETE"
+
+def ask(question):
+    return [{"role": "system", "content": "Domain: Sales"}, {"role": "user", "content": question}]
+
+def test_response_cache_is_exact_only_by_default():
+    assert server.RESPONSE_CACHE_SIMILARITY == 1.0
+    cache = server.ResponseCache(16, 0, server.RESPONSE_CACHE_SIMILARITY)
+    asyncio.run(cache.put(ask("Total sales by region for the north stores in 2023"), "m", "north"))
+
+    assert cache.get(ask("total sales by region for the NORTH stores in 2023?"), "m") == "north"
+    assert cache.get(ask("Total sales by region for the south stores in 2023"), "m") is None
+
+@pytest.mark.parametrize("question", [
+    "List all orders placed before 2023 sorted by total in descending order",
+    "List all orders placed after 2023 sorted by total in ascending order",
+    "List all orders placed before 2024 sorted by total in ascending order",
+])
+def test_near_duplicates_must_share_every_meaningful_word(question):
+    cache = server.ResponseCache(16, 0, 0.5)
+    asyncio.run(cache.put(ask("List all orders placed before 2023 sorted by total in ascending order"), "m", "sql"))
+    assert cache.get(ask(question), "m") is None
+
+def test_near_duplicates_may_differ_in_filler_words():
+    cache = server.ResponseCache(16, 0, 0.7)
+    asyncio.run(cache.put(ask("Please show total sales by region"), "m", "sql"))
+    assert cache.get(ask("show the total sales by region"), "m") == "sql"
+    assert cache.near_hits == 1
+
+class WordModel:
+    """Counts one token per word and has a fixed context window"""
+
+    def __init__(self, n_ctx=4096):
+        self.n_ctx = n_ctx
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+    def context_size(self):
+        return self.n_ctx
+
+def conversation(turns):
+    messages = [{"role": "system", "content": "schema " * 10}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * 20})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "word " * 20})
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+def test_full_history_requests_are_trimmed_to_the_budget(monkeypatch):
+    monkeypatch.setattr(server, "CONTEXT_SUMMARIZE", False)
+    model = WordModel()
+    prompt = server.fit_prompt_messages(conversation(20), 1, model, 200)
+
+    assert prompt[0]["role"] == "system" and prompt[-1]["content"] == "latest question"
+    assert prompt[1]["role"] == "user" and prompt[1]["content"].startswith("question 17 ")
+    assert sum(model.count_tokens(m["content"]) + 4 for m in prompt) <= 200
+    assert all(set(m) == {"role", "content"} for m in prompt)
+
+def test_system_prompt_and_new_turn_are_kept_over_budget():
+    prompt = server.fit_prompt_messages(conversation(3), 1, WordModel(), 5)
+    assert [m["role"] for m in prompt] == ["system", "user"]
+
+def test_prompt_budget_leaves_room_for_the_answer(monkeypatch):
+    monkeypatch.setattr(server, "PROMPT_TOKEN_BUDGET", 2048)
+    assert server.prompt_token_budget(WordModel(n_ctx=4096), 384) == 2048
+    assert server.prompt_token_budget(WordModel(n_ctx=2048), 1024) == 1024
+
+def test_scheduler_grants_slots_round_robin_across_users():
+    async def run():
+        scheduler = server.GenerationScheduler(["slot"], max_queued=10)
+        granted = []
+
+        async def request(key, name):
+            async with scheduler.acquire(key):
+                granted.append(name)
+                await asyncio.sleep(0)
+
+        async with scheduler.acquire("a"):
+            tasks = [asyncio.create_task(request(key, name))
+                     for key, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1"), ("b", "b2")]]
+            await asyncio.sleep(0)
+            assert scheduler.queue_depth == 6 and scheduler.busy_slots == 1
+        await asyncio.gather(*tasks)
+        return granted, scheduler.queue_depth, scheduler.busy_slots
+
+    assert asyncio.run(run()) == (["a1", "b1", "c1", "a2", "b2", "a3"], 0, 0)
+
+def test_scheduler_rejects_requests_beyond_the_queue_bound():
+    async def run():
+        scheduler = server.GenerationScheduler(["slot"], max_queued=2)
+        async with scheduler.acquire("a"):
+            waiting = [asyncio.create_task(scheduler._acquire(key, None)) for key in ("b", "c")]
+            await asyncio.sleep(0)
+            with pytest.raises(server.QueueFullError):
+                await scheduler._acquire("d", None)
+            for task in waiting:
+                task.cancel()
+            await asyncio.gather(*waiting, return_exceptions=True)
+            return scheduler.queue_depth
+
+    assert asyncio.run(run()) == 0
+
+def test_withdraw_fails_a_users_queued_requests():
+    async def run():
+        scheduler = server.GenerationScheduler(["slot"], max_queued=10)
+        async with scheduler.acquire("a"):
+            mine = [asyncio.create_task(scheduler._acquire("b", None)) for _ in range(2)]
+            other = asyncio.create_task(scheduler._acquire("c", None))
+            await asyncio.sleep(0)
+            assert scheduler.withdraw("b") == 2
+            assert scheduler.withdraw("b") == 0
+            results = await asyncio.gather(*mine, return_exceptions=True)
+            assert scheduler.queue_depth == 1
+        assert await other == "slot"
+        return results
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, server.RequestWithdrawn) for result in results)
+
+def feed_in_pieces(text, size):
+    extractor = server.SqlStreamExtractor()
+    closed = [sql for sql in (extractor.feed(text[i:i + size]) for i in range(0, len(text), size)) if sql]
+    return closed, extractor.finish()
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 1000])
+def test_extractor_finds_blocks_whose_markers_are_split_across_chunks(size):
+    tagged = "Reasoning first.\n<final_sql_query_start>\nSELECT 1;\n<final_sql_query_end>\nDone."
+    assert feed_in_pieces(tagged, size) == (["SELECT 1;"], "SELECT 1;")
+    fenced = "Here it is:\n```sql\nSELECT region FROM sales\n```\n"
+    assert feed_in_pieces(fenced, size) == (["SELECT region FROM sales"], "SELECT region FROM sales")
+
+def test_extractor_prefers_the_tag_block_over_an_earlier_fence():
+    response = ("```sql\nSELECT draft\n```\nOn reflection:\n"
+                "<final_sql_query_start>SELECT final<final_sql_query_end>")
+    closed, final = feed_in_pieces(response, 4)
+    assert closed == ["SELECT draft"]
+    assert final == "SELECT final"
+    assert server.extract_sql_from_response(response) == "SELECT final"
+
+def test_extractor_falls_back_to_plain_fences_and_bare_statements():
+    assert feed_in_pieces("```\nSELECT 2\n```", 3) == ([], "SELECT 2")
+    response = "```\nnot sql\n```\nSELECT 3\nFROM t;\nmore text"
+    assert feed_in_pieces(response, 3) == ([], "SELECT 3\nFROM t")
+    assert server.extract_sql_from_response(response) == "SELECT 3\nFROM t"
+
+def test_split_ignores_semicolons_in_strings_comments_and_dollar_quotes():
+    query = (
+        "SELECT ';' AS a, \"semi;colon\" FROM t -- trailing; comment\n"
+        "WHERE b = $$x; y$$ AND c = $tag$;$tag$ /* block; comment */;\n"
+        "SELECT 2;"
+    )
+    assert server.split_sql_statements(query) == [
+        "SELECT ';' AS a, \"semi;colon\" FROM t \nWHERE b = $$x; y$$ AND c = $tag$;$tag$",
+        "SELECT 2"
+    ]
+    assert server.split_sql_statements(" ; -- only a comment\n ;") == []
+
+
+RESULT_ROW = (
+    7,
+    decimal.Decimal("12345678901234567890.125"),
+    datetime.datetime(2024, 3, 1, 12, 30, tzinfo=datetime.timezone.utc),
+    datetime.date(2024, 3, 1),
+    uuid.UUID(int=42),
+)
+RESULT_COLUMNS = ["id", "amount", "sold_at", "sold_on", "buyer"]
+ENCODED_ROW = [7, "12345678901234567890.125", "2024-03-01T12:30:00+00:00", "2024-03-01",
+               "00000000-0000-0000-0000-00000000002a"]
+
+def result_frame(codec):
+    # Stands in for asyncpg Records, which convert to both tuples and dicts
+    record = RESULT_ROW if codec.columnar else dict(zip(RESULT_COLUMNS, RESULT_ROW))
+    return {
+        "type": "sql_result",
+        "result": codec.result({"success": True, "columns": RESULT_COLUMNS, "data": [record], "error": None})
+    }
+
+def test_json_codecs_encode_database_values_losslessly():
+    columnar = server.FRAME_CODECS["edgequery.json"]
+    decoded = server.decode_frame(columnar.encode(result_frame(columnar)))
+    assert decoded["result"]["columns"] == RESULT_COLUMNS
+    assert decoded["result"]["rows"] == [ENCODED_ROW]
+
+    legacy = server.LEGACY_FRAME_CODEC
+    decoded = json.loads(legacy.encode(result_frame(legacy)))
+    assert decoded["result"]["data"] == [dict(zip(RESULT_COLUMNS, ENCODED_ROW))]
+
+def test_msgpack_codec_round_trips_database_values():
+    pytest.importorskip("msgpack")
+    codec = server.FRAME_CODECS["edgequery.msgpack"]
+    frame = codec.encode(result_frame(codec))
+    assert isinstance(frame, bytes)
+    assert server.decode_frame(frame)["result"]["rows"] == [ENCODED_ROW]
+
+def test_small_frames_are_sent_uncompressed():
+    from websockets.frames import Frame, Opcode
+
+    extension = server.SelectivePerMessageDeflate(False, False, 15, 15, {}, min_size=64)
+    small = Frame(Opcode.TEXT, b'{"type":"chunk","content":"x"}')
+    assert extension.encode(small) is small
+
+    large = Frame(Opcode.TEXT, json.dumps({"rows": [ENCODED_ROW] * 20}).encode())
+    compressed = extension.encode(large)
+    assert compressed.rsv1 and len(compressed.data) < len(large.data)
+
+class WatermarkDb:
+    """The one DatabaseManager call the SQL result cache makes without triggers"""
+
+    def __init__(self):
+        self.watermark = "100:100:"
+
+    async def write_watermark(self):
+        return self.watermark
+
+def result_cache(max_bytes=1 << 20):
+    return server.SqlResultCache(WatermarkDb(), 16, max_bytes, 0, triggers=False, channel="changes")
+
+async def cache_result(cache, query, tables, size=10):
+    key = cache.key_for(query, {"max_rows": 100})
+    cache.put(key, await cache.begin(tables), query, ["n"], [{"n": 1}], size)
+    return key
+
+@pytest.mark.parametrize("query, cacheable", [
+    ("SELECT region, sum(volume) FROM sales GROUP BY region", True),
+    ("SELECT * FROM sales WHERE sold_at > now() - interval '1 day'", False),
+    ("SELECT * FROM sales WHERE sold_on = CURRENT_DATE", False),
+    ("SELECT random(), nextval('ids')", False),
+])
+def test_result_cache_skips_volatile_queries(query, cacheable):
+    assert server.SqlResultCache.cacheable(query) is cacheable
+
+def test_result_cache_keys_ignore_formatting_but_not_limits():
+    key = server.SqlResultCache.key_for
+    assert key("select *\n  FROM Sales;", {"max_rows": 100}) == key("SELECT * FROM sales", {"max_rows": 100})
+    assert key("SELECT * FROM sales WHERE region = 'North'", {}) != key("SELECT * FROM sales WHERE region = 'north'", {})
+    assert key("SELECT * FROM sales", {"max_rows": 100}) != key("SELECT * FROM sales", {"max_rows": 10})
+
+def test_result_cache_invalidates_by_table():
+    async def run():
+        cache = result_cache()
+        sales = await cache_result(cache, "SELECT * FROM sales", ["public.sales"])
+        joined = await cache_result(cache, "SELECT * FROM sales JOIN regions USING (id)", ["public.sales", "public.regions"])
+        regions = await cache_result(cache, "SELECT * FROM regions", ["public.regions"])
+        cache.invalidate(["public.sales"])
+        hits = [await cache.get(key) is not None for key in (sales, joined, regions)]
+        cache.invalidate()
+        return hits, await cache.get(regions)
+
+    assert asyncio.run(run()) == ([False, False, True], None)
+
+def test_result_cache_drops_results_read_before_a_change():
+    async def run():
+        cache = result_cache()
+        token = await cache.begin(["public.sales"])
+        cache.invalidate(["public.sales"])
+        key = cache.key_for("SELECT * FROM sales", {})
+        cache.put(key, token, "SELECT * FROM sales", ["n"], [], 10)
+        raced = await cache.get(key)
+
+        key = await cache_result(cache, "SELECT * FROM sales", ["public.sales"])
+        cache.db.watermark = "100:101:"
+        return raced, await cache.get(key), cache.stale
+
+    assert asyncio.run(run()) == (None, None, 1)
+
+def test_result_cache_skips_results_over_its_byte_budget():
+    async def run():
+        cache = result_cache(max_bytes=100)
+        key = await cache_result(cache, "SELECT * FROM sales", ["public.sales"], size=101)
+        return await cache.get(key)
+
+    assert asyncio.run(run()) is None
+
+@pytest.mark.parametrize("truncated, cached", [(False, True), (True, False)])
+def test_only_complete_streamed_results_are_cached(monkeypatch, truncated, cached):
+    cache = result_cache()
+    query = "SELECT * FROM sales"
+
+    async def check_query(sql, limits):
+        return {"query": sql, "is_read": True, "read_only": True, "rewritten": False, "relations": ["public.sales"]}
+
+    async def execute_streaming_query(websocket, sql, key, info=None, records=None, **kwargs):
+        records.extend([{"n": 1}, {"n": 2}])
+        info.update(rows=2, bytes=20, truncated=truncated)
+        return True
+
+    async def wait_for_pool(timeout):
+        return True
+
+    monkeypatch.setattr(server, "sql_result_cache", cache)
+    monkeypatch.setattr(server, "SQL_STREAM_RESULTS", True)
+    monkeypatch.setattr(server, "execute_streaming_query", execute_streaming_query)
+    monkeypatch.setattr(server.db_manager, "check_query", check_query)
+    monkeypatch.setattr(server.db_manager, "wait_for_pool", wait_for_pool)
+
+    class Socket:
+        async def send(self, frame):
+            pass
+
+    asyncio.run(server.handle_sql_execution(Socket(), query, "client", sql_query=query))
+    assert (len(cache._entries) == 1) is cached
+
+def table(name, columns, primary_key=("id",), foreign_keys=(), comment=None):
+    schema = server._TableSchema(f"public.{name}", comment)
+    schema.columns = [(column, "integer", None) for column in columns]
+    schema.primary_key = primary_key
+    schema.foreign_keys = [(columns_, f"public.{reference}", ("id",)) for columns_, reference in foreign_keys]
+    return schema
+
+def shop_schema():
+    return server.DatabaseSchema(("public",), [
+        table("customers", ["id", "name", "city"]),
+        table("products", ["id", "title", "price", "category"]),
+        # Shares no words with questions about customers and products, only their keys
+        table("purchases", ["id", "buyer", "item", "quantity", "paid_at"],
+              foreign_keys=[(("buyer",), "customers"), (("item",), "products")]),
+        table("employees", ["id", "name", "department_id", "salary"],
+              foreign_keys=[(("department_id",), "departments")]),
+        table("departments", ["id", "title", "budget"]),
+        table("warehouses", ["id", "city", "capacity"]),
+        table("shipments", ["id", "warehouse_id", "shipped_at"],
+              foreign_keys=[(("warehouse_id",), "warehouses")]),
+    ], 0.0)
+
+def test_schema_pruning_keeps_the_matching_tables_and_the_table_joining_them():
+    schema = shop_schema()
+    names = lambda tables: [t.name.split(".")[1] for t in tables]
+
+    chosen = names(schema.select("Which customers bought products in the Toys category?", 4))
+    assert chosen[:2] in (["customers", "products"], ["products", "customers"])
+    assert chosen[2:] == ["purchases"]
+
+    assert set(names(schema.select("Which customers bought products in the Toys category?", 2))) == {
+        "customers", "products"
+    }
+    assert names(schema.select("Average salary per department", 4))[:2] == ["employees", "departments"]
+    assert len(schema.select("hello there", 4)) == len(schema.tables)
+
+def test_schema_prompt_describes_only_the_selected_tables():
+    schema = shop_schema()
+    tables = schema.select("Which customers bought products in the Toys category?", 4)
+    described = json.loads(schema.prompt(tables, "Which customers bought products?", 3))["database_schema"]
+
+    assert set(described) == {"public.customers", "public.products", "public.purchases"}
+    # Wide tables keep their keys within the column budget
+    assert [c["name"] for c in described["public.purchases"]["columns"]] == ["id", "buyer", "item"]
+    assert described["public.purchases"]["foreign_keys"] == [
+        "buyer -> public.customers(id)", "item -> public.products(id)"
+    ]
+
+@pytest.mark.skipif(not server.POSTGRES_CONNECTION_STRING, reason="needs POSTGRES_CONNECTION_STRING")
+def test_schema_catalog_introspects_keys_and_comments():
+    ddl = """
+        DROP SCHEMA IF EXISTS edgequery_test CASCADE;
+        CREATE SCHEMA edgequery_test;
+        CREATE TABLE edgequery_test.customers (id int PRIMARY KEY, name text);
+        CREATE TABLE edgequery_test.products (id int PRIMARY KEY, title varchar(80));
+        CREATE TABLE edgequery_test.purchases (
+            id int PRIMARY KEY,
+            buyer int REFERENCES edgequery_test.customers (id),
+            item int REFERENCES edgequery_test.products (id),
+            paid_at timestamp
+        );
+        COMMENT ON TABLE edgequery_test.products IS 'Items for sale';
+    """
+
+    async def run():
+        await server.db_manager.initialize_pool()
+        try:
+            async with server.db_manager.acquire() as connection:
+                await connection.execute(ddl)
+            try:
+                return await server.SchemaCatalog(server.db_manager, 60).get(("edgequery_test",))
+            finally:
+                async with server.db_manager.acquire() as connection:
+                    await connection.execute("DROP SCHEMA edgequery_test CASCADE")
+        finally:
+            await server.db_manager.close_pool()
+
+    schema = asyncio.run(run())
+    purchases = schema.by_name["edgequery_test.purchases"]
+    assert purchases.primary_key == ("id",)
+    assert sorted(purchases.foreign_keys) == [
+        (("buyer",), "edgequery_test.customers", ("id",)),
+        (("item",), "edgequery_test.products", ("id",)),
+    ]
+    assert ("paid_at", "TIMESTAMP", None) in purchases.columns
+    assert schema.by_name["edgequery_test.products"].comment == "Items for sale"
+    chosen = {t.name for t in schema.select("names of customers and the products they bought", 3)}
+    assert chosen == set(schema.by_name)
+
+class Served:
+    """The ServedModel attributes plan_decoding reads"""
+
+    def __init__(self, reasoning=True):
+        self.name = "test"
+        self.reasoning = reasoning
+
+SCHEMA_SYSTEM = 'Domain: Shop\nDatabase Schema: {"database_schema":{"public.sales":{"columns":[{"name":"region","type":"TEXT"},{"name":"volume","type":"INT"}]}}}'
+
+@pytest.fixture
+def decoding(monkeypatch):
+    monkeypatch.setattr(server, "DECODING_MODE", "reasoning")
+    monkeypatch.setattr(server, "DECODING_TOKEN_BUDGETS", {"reasoning": 2048, "fast_sql": 384, "full": 1024})
+    monkeypatch.setattr(server.decoding_baseline, "wants_sample", lambda model: False)
+    return [{"role": "system", "content": SCHEMA_SYSTEM}, {"role": "user", "content": "Volume by region"}]
+
+def test_reasoning_mode_stops_at_the_closing_tag(decoding):
+    plan, messages = server.plan_decoding(None, decoding, Served())
+    assert (plan.mode, plan.max_tokens, plan.stop, plan.grammar) == ("reasoning", 2048, ["<final_sql_query_end>"], None)
+    assert plan.completion_kwargs() == {"max_tokens": 2048, "temperature": 0, "stop": ["<final_sql_query_end>"]}
+    assert messages is decoding
+
+    plan, _ = server.plan_decoding("reasoning", decoding, Served(reasoning=False))
+    assert plan.stop is None
+
+def test_full_mode_is_unconstrained(decoding):
+    plan, messages = server.plan_decoding("full", decoding, Served())
+    assert (plan.max_tokens, plan.stop, plan.grammar) == (1024, None, None)
+    assert "stop" not in plan.completion_kwargs()
+
+def test_fast_sql_mode_constrains_to_the_schema(decoding):
+    plan, messages = server.plan_decoding("fast_sql", decoding, Served())
+    assert (plan.mode, plan.max_tokens, plan.stop) == ("fast_sql", 384, None)
+    assert '"public.sales"' in plan.grammar and '"\\"region\\""' in plan.grammar
+    assert "WITH" not in plan.grammar
+    assert messages[0]["content"].startswith(SCHEMA_SYSTEM) and "without any reasoning" in messages[0]["content"]
+    assert decoding[0]["content"] == SCHEMA_SYSTEM
+
+def test_unavailable_decoding_modes_are_refused(decoding, monkeypatch):
+    with pytest.raises(server.UnknownDecodingModeError):
+        server.plan_decoding("creative", decoding, Served())
+    monkeypatch.setattr(server, "LlamaGrammar", None)
+    with pytest.raises(server.UnknownDecodingModeError):
+        server.plan_decoding("fast_sql", decoding, Served())
+
+def test_sql_grammar_wraps_one_select_in_the_tags():
+    free = server.sql_grammar()
+    restricted = server.sql_grammar(("sales.orders",), ("id",))
+    for grammar in (free, restricted):
+        assert grammar.startswith('root ::= "<final_sql_query_start>\\n" query')
+        assert "column-name ::=" in grammar and "table-name ::=" in grammar
+    assert '("WITH" sp ident' in free and "WITH" not in restricted
+    assert 'table-name ::= "sales.orders" | "sales.\\"orders\\"" | "\\"sales\\".orders" | "\\"sales\\".\\"orders\\""' in restricted
+    assert server.schema_identifiers([{"role": "system", "content": SCHEMA_SYSTEM}]) == (("public.sales",), ("region", "volume"))
+
+def acquire_all(store, *keys):
+    async def run():
+        return [await store.acquire(key) for key in keys]
+    return asyncio.run(run())
+
+def test_session_store_evicts_the_least_recently_used():
+    store = server.SessionStore(2, 0)
+    acquire_all(store, "a", "b", "a", "c")
+    assert list(store._sessions) == ["a", "c"]
+    assert store.stats() == {"sessions": 2, "evictions": 1, "expirations": 0}
+
+def test_session_store_never_evicts_busy_sessions():
+    async def run():
+        store = server.SessionStore(2, 0)
+        generating, querying = await store.acquire("a"), await store.acquire("b")
+        generating.generating = True
+        querying.sql_task = asyncio.ensure_future(asyncio.sleep(10))
+        try:
+            # Both are busy, so the new session stays over the cap instead
+            await store.acquire("c")
+            assert list(store._sessions) == ["a", "b", "c"]
+            querying.sql_task.cancel()
+            await asyncio.sleep(0)
+            await store.acquire("d")
+            return list(store._sessions)
+        finally:
+            querying.sql_task.cancel()
+    assert asyncio.run(run()) == ["a", "d"]
+
+def test_session_store_expires_idle_sessions(monkeypatch):
+    store = server.SessionStore(10, 60)
+    idle, busy = acquire_all(store, "idle", "busy")
+    busy.generating = True
+    now = server.time.time()
+    idle.last_seen = busy.last_seen = now - 120
+    assert store.peek("busy") is busy
+
+    async def expire_later():
+        monkeypatch.setattr(server.time, "time", lambda: now + 1)
+        await store.expire()
+    asyncio.run(expire_later())
+    assert list(store._sessions) == ["busy"] and store.expirations == 1
+    assert store.peek("idle") is None
+
+def test_sqlite_session_backend_round_trip(tmp_path):
+    backend = server.SqliteSessionBackend(str(tmp_path / "sessions.db"))
+
+    async def run():
+        store = server.SessionStore(10, 60, backend)
+        session = await store.acquire("user")
+        session.system = "Database Schema: {}"
+        session.messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+        await store.persist(session)
+
+        restarted = server.SessionStore(10, 60, backend)
+        restored = await restarted.acquire("user")
+        assert restored is not session
+        assert (restored.system, restored.messages) == (session.system, session.messages)
+        assert not restored.generating and not restored.stop_requested
+
+        await restarted.discard("user", forget=True)
+        return backend.load("user")
+    assert asyncio.run(run()) is None
+
+    backend.save("old", [{"role": "user", "content": "hi"}], 100.0)
+    backend.save("new", [{"role": "user", "content": "hi"}], 300.0)
+    backend.prune(200.0)
+    assert backend.load("old") is None and backend.load("new") is not None
+
+def worker_page(requests, latencies, loaded):
+    registry = server.MetricsRegistry()
+    registry.counter("requests_total", "Requests", ("type",)).inc(requests, type="chat")
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for latency in latencies:
+        histogram.observe(latency)
+    registry.gauge("model_loaded", "Model resident").set(loaded)
+    return registry.render()
+
+def test_merge_worker_metrics_sums_counters_and_histograms():
+    merged = server.merge_worker_metrics({
+        1: worker_page(2, [0.05, 0.5], 1),
+        0: worker_page(3, [2.0], 0)
+    }).splitlines()
+    assert merged == [
+        "# HELP edgequery_requests_total Requests",
+        "# TYPE edgequery_requests_total counter",
+        'edgequery_requests_total{type="chat"} 5.0',
+        "# HELP edgequery_latency_seconds Latency",
+        "# TYPE edgequery_latency_seconds histogram",
+        'edgequery_latency_seconds_bucket{le="0.1"} 1',
+        'edgequery_latency_seconds_bucket{le="1.0"} 2',
+        'edgequery_latency_seconds_bucket{le="+Inf"} 3',
+        "edgequery_latency_seconds_sum 2.55",
+        "edgequery_latency_seconds_count 3",
+        "# HELP edgequery_model_loaded Model resident",
+        "# TYPE edgequery_model_loaded gauge",
+        'edgequery_model_loaded{worker="0"} 0',
+        'edgequery_model_loaded{worker="1"} 1',
+    ]
+
+class RecordingSocket:
+    """Collects the content of the chunk frames sent to it"""
+
+    def __init__(self):
+        self.chunks = []
+
+    async def send(self, frame):
+        self.chunks.append(server.decode_frame(frame)["content"])
+
+def test_stream_coalescer_flushes_by_size():
+    async def run():
+        socket = RecordingSocket()
+        coalescer = server.StreamCoalescer(socket, max_delay=60, max_bytes=8)
+        for token in ["SELECT", " *", " FROM", " sales", ";"]:
+            await coalescer.add(token)
+        # The first token goes out alone, the rest once 8 bytes are buffered
+        assert socket.chunks == ["SELECT", " * FROM sales"]
+        await coalescer.flush()
+        return socket.chunks, coalescer.frames_sent
+    assert asyncio.run(run()) == (["SELECT", " * FROM sales", ";"], 3)
+
+def test_stream_coalescer_flushes_by_time():
+    async def run():
+        socket = RecordingSocket()
+        coalescer = server.StreamCoalescer(socket, max_delay=0.02, max_bytes=1024)
+        for token in ["a", "b", "c"]:
+            await coalescer.add(token)
+        assert socket.chunks == ["a"]
+        await asyncio.sleep(0.1)
+        assert socket.chunks == ["a", "bc"]
+        await coalescer.add("d")
+        coalescer.discard()
+        await asyncio.sleep(0.1)
+        return socket.chunks
+    assert asyncio.run(run()) == ["a", "bc"]
+
+def test_stream_coalescer_without_delay_sends_every_token():
+    async def run():
+        socket = RecordingSocket()
+        coalescer = server.StreamCoalescer(socket, max_delay=0, max_bytes=1024)
+        for token in ["a", "b", "c"]:
+            await coalescer.add(token)
+        return socket.chunks
+    assert asyncio.run(run()) == ["a", "b", "c"]